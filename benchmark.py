@@ -0,0 +1,263 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import http_client
+import ingest_file
+import send_messages
+from convert import download_epub, epub_to_text
+
+# Latency, jitter (seconds) and share of 503 responses of each mocked endpoint
+DEFAULT_PROFILE = {
+    'ingest': {'latency': 0.05, 'jitter': 0.02, 'error_rate': 0.0},
+    'chat': {'latency': 0.2, 'jitter': 0.05, 'error_rate': 0.0},
+    'download': {'latency': 0.0, 'jitter': 0.0, 'error_rate': 0.0},
+}
+REPLY_TOKENS = 50
+BENCHMARK_BOOKS = ['2413', '2600', '8600']
+
+
+class MockPrivateGPTHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for the PrivateGPT ingest and chat endpoints and for the Gutenberg download URL. """
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real server
+
+    def _delay(self, endpoint):
+        """ Sleep for the endpoint's latency and return True if this request should fail. """
+        profile = self.server.profile[endpoint]
+        time.sleep(max(0.0, random.gauss(profile['latency'], profile['jitter'])))
+        if random.random() < profile['error_rate']:
+            self._send(503, b'{"detail": "Service unavailable"}')
+            return True
+        return False
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        # Uploads are drained in blocks so the mock's own memory stays flat
+        remaining = int(self.headers.get('Content-Length', 0))
+        blocks = []
+        while remaining > 0:
+            block = self.rfile.read(min(remaining, 1 << 16))
+            if not block:
+                break
+            remaining -= len(block)
+            if self.path.endswith('/chat/completions'):
+                blocks.append(block)
+        return b''.join(blocks)
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.endswith('/ingest/file'):
+            if not self._delay('ingest'):
+                self._send(200, json.dumps({'data': [{'doc_id': str(uuid.uuid4())}]}).encode('utf-8'))
+        elif self.path.endswith('/chat/completions'):
+            if self._delay('chat'):
+                return
+            sources = [{'document': {'doc_metadata': {'window': 'A mocked reference window.'}}}]
+            tokens = [f'token{n} ' for n in range(REPLY_TOKENS)]
+            if json.loads(body or b'{}').get('stream'):
+                events = [f"data: {json.dumps({'choices': [{'delta': {'content': token}, 'sources': sources}]})}\n\n"
+                          for token in tokens]
+                self._send(200, (''.join(events) + 'data: [DONE]\n\n').encode('utf-8'), 'text/event-stream')
+            else:
+                reply = {'choices': [{'message': {'content': ''.join(tokens)}, 'sources': sources}]}
+                self._send(200, json.dumps(reply).encode('utf-8'))
+        else:
+            self._send(404, b'{}')
+
+    def do_GET(self):
+        # /ebooks/<id>.epub.noimages is served from the bundled EPUBs
+        book_id = os.path.basename(self.path).split('.')[0]
+        path = os.path.join(self.server.documents_path, f'{book_id}.epub')
+        if not os.path.exists(path):
+            self._send(404, b'')
+            return
+        if self._delay('download'):
+            return
+        with open(path, 'rb') as f:
+            self._send(200, f.read(), 'application/epub+zip')
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def mock_server(profile=None, documents_path='../client/documents'):
+    """ Run the mock PrivateGPT server on a free local port and yield its base URL. """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockPrivateGPTHandler)
+    server.daemon_threads = True
+    server.profile = {endpoint: dict(DEFAULT_PROFILE[endpoint], **(profile or {}).get(endpoint, {}))
+                      for endpoint in DEFAULT_PROFILE}
+    server.documents_path = documents_path
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def record_requests():
+    """ Time every HTTP request the client sends and collect (seconds, status code or error name). """
+    samples = []
+    lock = threading.Lock()
+    original = http_client.request
+
+    def timed(method, url, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = original(method, url, *args, **kwargs)
+            outcome = response.status_code
+            return response
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            with lock:
+                samples.append((time.perf_counter() - started, outcome))
+
+    http_client.request = timed
+    try:
+        yield samples
+    finally:
+        http_client.request = original
+
+
+def summarize(name, samples, elapsed, units, peak_memory, payload_bytes=0):
+    """ Turn request samples into the latency percentiles, throughput and memory of one scenario. """
+    latencies = np.array([seconds for seconds, _ in samples]) * 1000
+    errors = sum(1 for _, outcome in samples if outcome != 200)
+    summary = {
+        'scenario': name,
+        'requests': len(samples),
+        'errors': errors,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'seconds': elapsed,
+        'throughput_per_s': units / elapsed if elapsed else None,
+        'peak_memory_mb': peak_memory / (1024 * 1024),
+    }
+    if payload_bytes:
+        summary['mb_per_s'] = payload_bytes / (1024 * 1024) / elapsed if elapsed else None
+    return summary
+
+
+def measure(name, run, units, payload_bytes=0):
+    """ Run one scenario quietly and return its summary. """
+    tracemalloc.start()
+    with record_requests() as samples, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(name, samples, elapsed, units, peak, payload_bytes)
+
+
+def bench_ingest(base_url, work_dir, files=20, file_size=1 << 20, workers=ingest_file.INGEST_WORKERS):
+    """ Upload generated files through send_all_files. """
+    available = {}
+    for number in range(files):
+        path = os.path.join(work_dir, f'book{number}.txt')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(file_size // 2).hex().encode('ascii'))
+        available[f'book{number}'] = path
+    run = lambda: ingest_file.send_all_files(available, set(), f'{base_url}/v1/ingest/file', max_workers=workers)
+    return measure('ingest', run, files, payload_bytes=files * file_size)
+
+
+def bench_chat(base_url, work_dir, questions=100, workers=send_messages.MAX_IN_FLIGHT):
+    """ Answer a generated questions CSV through process_questions_from_csv. """
+    csv_path = os.path.join(work_dir, 'questions.csv')
+    pd.DataFrame({'Question': [f'Question {n}?' for n in range(questions)]}).to_csv(csv_path, index=False)
+
+    def run():
+        # Results are written to ./results, so keep them inside the scratch directory
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            send_messages.process_questions_from_csv(csv_path, f'{base_url}/v1/chat/completions', max_in_flight=workers)
+        finally:
+            os.chdir(cwd)
+    return measure('chat', run, questions)
+
+
+def bench_convert(base_url, work_dir, book_ids=BENCHMARK_BOOKS):
+    """ Download the bundled books from the mock server and convert them to text. """
+    def run():
+        for book_id in book_ids:
+            epub_path = download_epub(book_id, exit_on_error=False, documents_path=work_dir, base_url=f'{base_url}/ebooks')
+            epub_to_text(epub_path, os.path.join(work_dir, f'{book_id}.txt'))
+    return measure('convert', run, len(book_ids))
+
+
+def print_report(summaries):
+    print(f"{'scenario':<10}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'per s':>9}{'peak MB':>9}")
+    for s in summaries:
+        percentiles = ''.join(f"{s[key]:>10.1f}" if s[key] is not None else f"{'-':>10}" for key in ('p50_ms', 'p95_ms', 'p99_ms'))
+        print(f"{s['scenario']:<10}{s['requests']:>9}{s['errors']:>8}{percentiles}{s['throughput_per_s']:>9.2f}{s['peak_memory_mb']:>9.1f}")
+    print(f"Process peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main(argv=None):
+    """ python benchmark.py --scenarios ingest chat --chat-latency 0.5 --error-rate 0.05 --json results/bench.json """
+    parser = argparse.ArgumentParser(description="Measure client latency, throughput and memory against a mock PrivateGPT server.")
+    parser.add_argument('--scenarios', nargs='+', choices=['ingest', 'chat', 'convert'], default=['ingest', 'chat', 'convert'])
+    parser.add_argument('--files', type=int, default=20, help="Files uploaded in the ingest scenario")
+    parser.add_argument('--file-size', type=int, default=1 << 20, help="Size of each uploaded file in bytes")
+    parser.add_argument('--questions', type=int, default=100, help="Questions asked in the chat scenario")
+    parser.add_argument('--workers', type=int, default=4, help="Parallel uploads / requests in flight")
+    parser.add_argument('--ingest-latency', type=float, default=DEFAULT_PROFILE['ingest']['latency'])
+    parser.add_argument('--chat-latency', type=float, default=DEFAULT_PROFILE['chat']['latency'])
+    parser.add_argument('--jitter', type=float, default=None, help="Standard deviation of the mocked latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with 503 (retried by the client)")
+    parser.add_argument('--json', help="Also write the summaries to this JSON file")
+    args = parser.parse_args(argv)
+
+    profile = {'ingest': {'latency': args.ingest_latency, 'error_rate': args.error_rate},
+               'chat': {'latency': args.chat_latency, 'error_rate': args.error_rate}}
+    if args.jitter is not None:
+        for endpoint in profile:
+            profile[endpoint]['jitter'] = args.jitter
+
+    summaries = []
+    work_dir = tempfile.mkdtemp(prefix='client-bench-')
+    try:
+        with mock_server(profile) as base_url:
+            if 'ingest' in args.scenarios:
+                summaries.append(bench_ingest(base_url, work_dir, args.files, args.file_size, args.workers))
+            if 'chat' in args.scenarios:
+                summaries.append(bench_chat(base_url, work_dir, args.questions, args.workers))
+            if 'convert' in args.scenarios:
+                summaries.append(bench_convert(base_url, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(summaries)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summaries, f, indent=2)
+    return summaries
+
+
+if __name__ == "__main__":
+    main()
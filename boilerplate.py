@@ -0,0 +1,81 @@
+import re
+from functools import lru_cache
+
+# Each kind of boilerplate is one line-anchored pattern and what to do when it matches:
+# 'start' drops everything before the match, 'stop' drops the match and the rest of the book,
+# 'remove' drops only the matched text
+BOILERPLATE_PATTERNS = {
+    'header': (r'^\*\*\* ?START OF (?:THE|THIS) PROJECT GUTENBERG EBOOK\b[^\n]*', 'start'),
+    'footer': (r'^\*\*\* ?END OF (?:THE|THIS) PROJECT GUTENBERG EBOOK\b', 'stop'),
+    'license': (r'^[ \t]*(?:START: FULL LICENSE|THE FULL PROJECT GUTENBERG LICENSE|'
+                r'Section 1\. General Terms of Use and Redistributing Project Gutenberg)', 'stop'),
+    # "This ebook is for the use of anyone anywhere..." up to the sentence that closes it, at most a few lines later
+    'preamble': (r'^[ \t]*The Project Gutenberg eBook of [^\n]*\n(?:[^\n]*\n){0,12}?[^\n]*before using this eBook\.', 'remove'),
+    # The <title> every chapter of a Gutenberg EPUB repeats, e.g. "Madame Bovary | Project Gutenberg"
+    'title': (r'^[ \t]*(?:The Project Gutenberg eBook of [^\n]*|[^\n|]*\| Project Gutenberg)[ \t]*$', 'remove'),
+    # A transcriber's note runs up to the next blank line
+    'transcriber': (r'^[ \t]*\[?Transcriber[’\']?s?[ \t]+Notes?\b[^\n]*(?:\n[ \t]*\S[^\n]*)*', 'remove'),
+}
+DEFAULT_BOILERPLATE = tuple(BOILERPLATE_PATTERNS)
+# Text kept back while looking for the start marker; books without one are released after this many characters
+HEADER_SEARCH_LIMIT = 100_000
+
+
+@lru_cache(maxsize=None)
+def compile_scanner(kinds):
+    """ Combine the patterns of the given kinds into a single regex so each chapter is scanned only once. """
+    unknown = set(kinds) - set(BOILERPLATE_PATTERNS)
+    if unknown:
+        raise ValueError(f"Unknown boilerplate kind(s) {', '.join(sorted(unknown))}, choose from: {', '.join(BOILERPLATE_PATTERNS)}")
+    # The dictionary order decides which pattern wins when two match at the same position
+    alternatives = [f'(?P<{kind}>{pattern})' for kind, (pattern, _) in BOILERPLATE_PATTERNS.items() if kind in kinds]
+    if not alternatives:
+        return None
+    return re.compile('|'.join(alternatives), re.MULTILINE)
+
+
+def strip_boilerplate(chapters, kinds=DEFAULT_BOILERPLATE):
+    """ Remove Gutenberg headers, license footers, page titles and transcriber notes from a stream of chapters. """
+    scanner = compile_scanner(tuple(sorted(kinds)))
+    if scanner is None:
+        yield from chapters
+        return
+
+    # Chapters before the start marker are header material, so they are held back until it is found
+    searching = 'header' in kinds
+    held, held_size = [], 0
+    for chapter in chapters:
+        pieces, position, finished = [], 0, False
+        for match in scanner.finditer(chapter):
+            action = BOILERPLATE_PATTERNS[match.lastgroup][1]
+            if action == 'start':
+                if searching:
+                    held, held_size, pieces = [], 0, []
+                    position = match.end()
+                    searching = False
+            elif action == 'remove':
+                pieces.append(chapter[position:match.start()])
+                position = match.end()
+            else:
+                # The book is over; the remaining chapters are never even extracted
+                pieces.append(chapter[position:match.start()])
+                position = len(chapter)
+                finished = True
+                break
+        pieces.append(chapter[position:])
+        text = ''.join(pieces)
+
+        if searching and not finished:
+            held.append(text)
+            held_size += len(text)
+            if held_size > HEADER_SEARCH_LIMIT:
+                searching = False
+                yield from held
+                held = []
+            continue
+        yield from held
+        held = []
+        yield text
+        if finished:
+            return
+    yield from held
@@ -0,0 +1,191 @@
+import argparse
+import math
+import os
+import re
+from manifest import cached_sha256, file_sha256, load_manifest, save_manifest
+
+# Token budget of one uploaded chunk, and how much of the previous chunk is repeated at its start
+CHUNK_TOKENS = 512
+CHUNK_OVERLAP = 64
+CHUNKS_PATH = '../client/output/chunks'
+# Rough English averages that hold for the common BPE tokenizers; the larger of the two estimates wins
+CHARS_PER_TOKEN = 4
+TOKENS_PER_WORD = 1.3
+# A short one-line paragraph such as "CHAPTER IV." or "Part II" starts a new chunk
+HEADING = re.compile(r'^[ \t]*(?:CHAPTER|BOOK|PART|VOLUME|EPILOGUE|PROLOGUE)\b', re.IGNORECASE)
+HEADING_MAX_CHARS = 80
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+
+def estimate_tokens(text):
+    """ Tokenizer-agnostic token estimate from the character and word counts. """
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), math.ceil(len(text.split()) * TOKENS_PER_WORD))
+
+
+def is_heading(paragraph):
+    return '\n' not in paragraph and len(paragraph) <= HEADING_MAX_CHARS and HEADING.match(paragraph) is not None
+
+
+def iter_paragraphs(path):
+    """ Stream (paragraph, first line number, last line number) from a text file; paragraphs are separated by blank lines. """
+    lines, first = [], None
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, start=1):
+            if line.strip():
+                if first is None:
+                    first = number
+                lines.append(line.rstrip())
+            elif lines:
+                yield '\n'.join(lines), first, number - 1
+                lines, first = [], None
+        if lines:
+            yield '\n'.join(lines), first, number
+
+
+def split_oversized(paragraph, max_tokens):
+    """ Split a paragraph over the budget at sentence ends, and a sentence over the budget at word boundaries. """
+    pieces = []
+    for sentence in SENTENCE_END.split(paragraph):
+        if estimate_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        words = sentence.split()
+        step = max(1, int(max_tokens / TOKENS_PER_WORD))
+        while True:
+            # Long words can still push a window over the budget, so shrink it until it fits
+            piece = ' '.join(words[:step])
+            while step > 1 and estimate_tokens(piece) > max_tokens:
+                step = max(1, step // 2)
+                piece = ' '.join(words[:step])
+            pieces.append(piece)
+            words = words[step:]
+            if not words:
+                break
+
+    # Pack the sentences back together up to the budget
+    packed, current = [], []
+    for piece in pieces:
+        if current and estimate_tokens(' '.join(current + [piece])) > max_tokens:
+            packed.append(' '.join(current))
+            current = []
+        current.append(piece)
+    if current:
+        packed.append(' '.join(current))
+    return packed
+
+
+def chunk_paragraphs(paragraphs, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """ Pack (paragraph, first line, last line) tuples into chunks of at most max_tokens, yielding one dict per chunk. """
+    if overlap >= max_tokens:
+        raise ValueError("The overlap must be smaller than the chunk token budget")
+    current, current_tokens = [], 0
+
+    def emit():
+        return {
+            'text': '\n\n'.join(unit[0] for unit in current),
+            'tokens': current_tokens,
+            'start_line': current[0][2],
+            'end_line': current[-1][3],
+        }
+
+    for paragraph, first, last in paragraphs:
+        tokens = estimate_tokens(paragraph)
+        units = [(paragraph, tokens, first, last)]
+        if tokens > max_tokens:
+            units = [(piece, estimate_tokens(piece), first, last) for piece in split_oversized(paragraph, max_tokens)]
+
+        # A new chapter starts a fresh chunk without overlap, unless the current one is still mostly empty
+        if current and is_heading(paragraph) and current_tokens >= max_tokens // 4:
+            yield emit()
+            current, current_tokens = [], 0
+
+        for unit in units:
+            if current and current_tokens + unit[1] > max_tokens:
+                yield emit()
+                # Carry the trailing paragraphs that fit in the overlap into the next chunk
+                tail, tail_tokens = [], 0
+                for previous in reversed(current):
+                    if tail_tokens + previous[1] > overlap:
+                        break
+                    tail.insert(0, previous)
+                    tail_tokens += previous[1]
+                current, current_tokens = tail, tail_tokens
+                while current and current_tokens + unit[1] > max_tokens:
+                    current_tokens -= current.pop(0)[1]
+            current.append(unit)
+            current_tokens += unit[1]
+
+    if current:
+        yield emit()
+
+
+def chunk_index_path(txt_path, chunks_dir=CHUNKS_PATH):
+    book = os.path.splitext(os.path.basename(txt_path))[0]
+    return os.path.join(chunks_dir, book, 'index.json')
+
+
+def index_is_current(index, source_sha256, max_tokens, overlap):
+    """ True if the index was built from this exact text with the same budgets and all its chunk files still exist. """
+    return (bool(index) and index.get('source_sha256') == source_sha256 and index.get('max_tokens') == max_tokens
+            and index.get('overlap') == overlap and all(os.path.exists(chunk['path']) for chunk in index['chunks']))
+
+
+def chunk_book(txt_path, chunks_dir=CHUNKS_PATH, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, stats=None):
+    """ Split a converted book into chunk files next to a per-book index.json, reusing them if the book is unchanged. """
+    index_path = chunk_index_path(txt_path, chunks_dir)
+    book_dir = os.path.dirname(index_path)
+    book = os.path.basename(book_dir)
+    # With a stats dict only books whose size or mtime changed are hashed again
+    source_sha256 = cached_sha256(txt_path, stats) if stats is not None else file_sha256(txt_path)
+    previous = load_manifest(index_path)
+    if index_is_current(previous, source_sha256, max_tokens, overlap):
+        return previous
+
+    os.makedirs(book_dir, exist_ok=True)
+    chunks = []
+    for number, chunk in enumerate(chunk_paragraphs(iter_paragraphs(txt_path), max_tokens, overlap), start=1):
+        path = os.path.join(book_dir, f'{book}.{number:04d}.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(chunk.pop('text'))
+        chunks.append(dict(chunk, path=path))
+
+    # Chunk files of an earlier, longer version of the book would otherwise linger
+    current_paths = {chunk['path'] for chunk in chunks}
+    removed = [chunk['path'] for chunk in previous.get('chunks', []) if chunk['path'] not in current_paths]
+    for path in removed:
+        if os.path.exists(path):
+            os.remove(path)
+
+    index = {
+        'source': os.path.normpath(txt_path),
+        'source_sha256': source_sha256,
+        'max_tokens': max_tokens,
+        'overlap': overlap,
+        'total_tokens': sum(chunk['tokens'] for chunk in chunks),
+        'chunks': chunks,
+        # Chunk files of the previous version that are gone, so ingest can remove their documents, even after a crash
+        'removed_chunks': removed,
+    }
+    save_manifest(index, index_path)
+    return index
+
+
+def main(argv=None):
+    """ Chunk the given books and print how many tokens ingesting them will embed. """
+    parser = argparse.ArgumentParser(description="Split converted books into token-budgeted chunks.")
+    parser.add_argument('paths', nargs='+', help="Converted .txt files")
+    parser.add_argument('--max-tokens', type=int, default=CHUNK_TOKENS, help="Token budget per chunk")
+    parser.add_argument('--overlap', type=int, default=CHUNK_OVERLAP, help="Tokens repeated from the previous chunk")
+    parser.add_argument('--chunks-dir', default=CHUNKS_PATH, help="Directory the chunk files are written to")
+    args = parser.parse_args(argv)
+
+    total = 0
+    for path in args.paths:
+        index = chunk_book(path, args.chunks_dir, args.max_tokens, args.overlap)
+        total += index['total_tokens']
+        print(f"{path}: {len(index['chunks'])} chunks, ~{index['total_tokens']} tokens")
+    print(f"Total: ~{total} tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import sys
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11, TOML configs need the tomli backport
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:  # PyYAML is optional, it is only needed for YAML configs
+    yaml = None
+
+# Read when it exists and no --config is given
+CONFIG_PATH = 'client.toml'
+# Every setting a config file may override; relative paths are taken from the working directory like the scripts do
+DEFAULT_CONFIG = {
+    'endpoints': {
+        'chat': 'http://host.docker.internal:8001/v1/chat/completions',
+        'ingest': 'http://private-gpt:8080/v1/ingest/file',
+        'gutenberg': 'https://www.gutenberg.org/ebooks',
+    },
+    'paths': {
+        'documents': '../client/documents',
+        'output': '../client/output',
+        'results': './results',
+    },
+    'concurrency': {
+        'convert_workers': None,  # CPU count
+        'ingest_workers': 3,
+        'chat_in_flight': 4,
+        'adaptive': True,
+    },
+    'timeouts': {
+        'chat': 600,
+        'ingest': 1200,
+        'download': 10,
+    },
+}
+
+
+def deep_merge(base, override, section='config'):
+    """ Return base updated with override, refusing keys base does not know so typos are not silently ignored. """
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if key not in base:
+            raise ValueError(f"Unknown setting '{key}' in {section}, expected one of: {', '.join(base)}")
+        if isinstance(base[key], dict):
+            if not isinstance(value, dict):
+                raise ValueError(f"Setting '{key}' in {section} must be a table")
+            merged[key] = deep_merge(base[key], value, f"{section}.{key}")
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(path=None):
+    """ Load a TOML, YAML or JSON config over DEFAULT_CONFIG; without a path, CONFIG_PATH is used if it exists. """
+    if path is None:
+        if not os.path.exists(CONFIG_PATH):
+            return copy.deepcopy(DEFAULT_CONFIG)
+        path = CONFIG_PATH
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.toml':
+        if tomllib is None:
+            raise ValueError("Reading TOML configs requires Python 3.11 or the tomli package")
+        with open(path, 'rb') as f:
+            data = tomllib.load(f)
+    elif extension in ('.yaml', '.yml'):
+        if yaml is None:
+            raise ValueError("Reading YAML configs requires PyYAML")
+        with open(path, encoding='utf-8') as f:
+            try:
+                data = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid YAML in {path}: {e}")
+    elif extension == '.json':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    else:
+        raise ValueError(f"Unsupported config format '{extension}', use .toml, .yaml or .json")
+    return deep_merge(DEFAULT_CONFIG, data)
+
+
+def configure_http(config):
+    """ Apply the timeouts and the concurrency settings to the shared HTTP client. """
+    import http_client
+    http_client.TIMEOUTS.update(config['timeouts'])
+    concurrency = config['concurrency']
+    http_client.ADAPTIVE_CONCURRENCY = concurrency['adaptive']
+    # The configured counts are ceilings: the adaptive limiter may lower the concurrency below them but never exceed them
+    ceilings = {'chat': concurrency['chat_in_flight'], 'ingest': concurrency['ingest_workers']}
+    http_client.configure_limiters({
+        endpoint: dict(settings, initial=min(settings['initial'], ceilings[endpoint]), maximum=ceilings[endpoint])
+        for endpoint, settings in http_client.ADAPTIVE_LIMITS.items()
+    })
+    # Every request that may be in flight at once needs a pooled connection, or the extra ones reconnect each time
+    http_client.configure(max(http_client.POOL_SIZE, *ceilings.values()))
+    return http_client
+
+
+def export_metrics(config):
+    import metrics
+    results = config['paths']['results']
+    metrics.export(os.path.join(results, 'metrics.json'), os.path.join(results, 'metrics.prom'))
+
+
+def book_files(paths, output_dir):
+    """ Map book names to converted .txt files; without paths, every book in the output directory. """
+    paths = paths or sorted(glob.glob(os.path.join(output_dir, '*.txt')))
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in paths}
+
+
+def run_convert(args, config):
+    """ Download and convert books, skipping the ones converted by an earlier run. """
+    # ebooklib and BeautifulSoup are only imported by the subcommands that convert books
+    import convert
+    from boilerplate import DEFAULT_BOILERPLATE
+    from manifest import load_manifest, save_manifest
+    configure_http(config)
+
+    try:
+        books = convert.books_from_ids(args.ids, args.ids_file)
+    except OSError as e:
+        print(f"Could not read book IDs from {args.ids_file}: {e}")
+        sys.exit(1)
+    if not books:
+        print("No book IDs given.")
+        sys.exit(1)
+
+    paths = config['paths']
+    manifest_path = os.path.join(paths['output'], '.convert_manifest.json')
+    manifest = load_manifest(manifest_path)
+    extractor = args.extractor or convert.DEFAULT_EXTRACTOR
+    report = convert.convert_books(books, max_workers=config['concurrency']['convert_workers'], extractor=extractor,
+                                   manifest=manifest, documents_path=paths['documents'],
+                                   base_url=config['endpoints']['gutenberg'],
+                                   boilerplate=[kind for kind in DEFAULT_BOILERPLATE if kind not in args.keep_boilerplate],
+                                   output_path=paths['output'])
+    save_manifest(manifest, manifest_path)
+    if report['failed']:
+        sys.exit(1)
+
+
+def run_ingest(args, config):
+    """ Upload converted books in chunks, skipping the ones the server already has. """
+    import http_client
+    import ingest_file
+    from manifest import load_manifest, save_manifest
+    configure_http(config)
+
+    output = config['paths']['output']
+    books = book_files(args.paths, output)
+    if not books:
+        print(f"No converted books found in {output}.")
+        sys.exit(1)
+
+    chunks_dir = os.path.join(output, 'chunks')
+    manifest_path = os.path.join(output, '.ingest_manifest.json')
+    manifest = load_manifest(manifest_path)
+    sent_books = ingest_file.ingested_books(books, manifest, chunks_dir, args.max_tokens, args.overlap)
+    for name in sorted(sent_books):
+        print(f"{name} is already ingested, skipping.")
+    unsent_books = {name: path for name, path in books.items() if name not in sent_books}
+    known_books = {}
+    if args.dedup:
+        # Every book already on the server counts for dedup, not only the ones named on the command line
+        every_book = book_files(None, output)
+        known_books = {name: every_book[name]
+                       for name in ingest_file.ingested_books(every_book, manifest, chunks_dir, args.max_tokens, args.overlap)}
+    try:
+        report = ingest_file.send_books_in_chunks(
+            unsent_books, sent_books, config['endpoints']['ingest'],
+            max_workers=http_client.concurrency_ceiling('ingest', config['concurrency']['ingest_workers']),
+            manifest=manifest, chunks_dir=chunks_dir, max_tokens=args.max_tokens, overlap=args.overlap, dedup=args.dedup,
+            manifest_path=manifest_path, known_books=known_books)
+    finally:
+        save_manifest(manifest, manifest_path)
+        export_metrics(config)
+    if report['failed']:
+        sys.exit(1)
+
+
+def run_ask(args, config):
+    """ Answer every question of a CSV or Parquet file and write the results file. """
+    # pandas is only imported here
+    import http_client
+    import retrieval
+    import send_messages
+    from response_cache import ResponseCache, corpus_fingerprint
+    configure_http(config)
+
+    paths = config['paths']
+    send_messages.RESULTS_PATH = paths['results']
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(os.path.join(paths['results'], 'response_cache.sqlite'), corpus_fingerprint(paths['output']),
+                              ttl=send_messages.CACHE_TTL)
+    index = None
+    if not args.no_index:
+        index = retrieval.open_index(retrieval.book_paths(paths['output']), os.path.join(paths['output'], 'bm25'))
+    try:
+        send_messages.process_questions_from_csv(
+            args.questions, config['endpoints']['chat'],
+            http_client.concurrency_ceiling('chat', config['concurrency']['chat_in_flight']),
+            deadline=config['timeouts']['chat'], resume=args.resume, cache=cache, output=args.output, index=index)
+    finally:
+        if cache is not None:
+            cache.close()
+        export_metrics(config)
+
+
+def run_pipeline(args, config):
+    """ Stream books through download, conversion and ingestion, each stage starting on a book as soon as it is ready. """
+    import http_client
+    import pipeline
+    from boilerplate import DEFAULT_BOILERPLATE
+    from convert import DEFAULT_EXTRACTOR, books_from_ids
+    from manifest import load_manifest, save_manifest
+    configure_http(config)
+
+    try:
+        books = books_from_ids(args.ids, args.ids_file)
+    except OSError as e:
+        print(f"Could not read book IDs from {args.ids_file}: {e}")
+        sys.exit(1)
+    if not books:
+        print("No book IDs given.")
+        sys.exit(1)
+
+    paths, concurrency = config['paths'], config['concurrency']
+    convert_manifest_path = os.path.join(paths['output'], '.convert_manifest.json')
+    ingest_manifest_path = os.path.join(paths['output'], '.ingest_manifest.json')
+    convert_manifest, ingest_manifest = load_manifest(convert_manifest_path), load_manifest(ingest_manifest_path)
+    try:
+        report = pipeline.run_pipeline(
+            books, config['endpoints']['ingest'], convert_manifest, ingest_manifest, documents_path=paths['documents'],
+            base_url=config['endpoints']['gutenberg'], output_path=paths['output'], extractor=args.extractor or DEFAULT_EXTRACTOR,
+            boilerplate=[kind for kind in DEFAULT_BOILERPLATE if kind not in args.keep_boilerplate],
+            convert_workers=concurrency['convert_workers'],
+            ingest_workers=http_client.concurrency_ceiling('ingest', concurrency['ingest_workers']),
+            chunks_dir=os.path.join(paths['output'], 'chunks'), max_tokens=args.max_tokens, overlap=args.overlap,
+            dedup=args.dedup, ingest_manifest_path=ingest_manifest_path)
+    finally:
+        save_manifest(convert_manifest, convert_manifest_path)
+        save_manifest(ingest_manifest, ingest_manifest_path)
+        export_metrics(config)
+    if report['failed']:
+        sys.exit(1)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Convert Gutenberg books, ingest them into PrivateGPT and ask questions.")
+    parser.add_argument('--config', help=f"TOML, YAML or JSON config file (default: {CONFIG_PATH} if it exists)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Choices and defaults are spelled out here so --help works without importing the heavy modules
+    convert_options = argparse.ArgumentParser(add_help=False)
+    convert_options.add_argument('--ids', nargs='*', default=[], help="Gutenberg book IDs to convert")
+    convert_options.add_argument('--ids-file', help="File with one `id` or `id,name` entry per line")
+    convert_options.add_argument('--extractor', choices=['html.parser', 'sax', 'lxml'], default=None,
+                                 help="HTML-to-text backend (all produce identical text; default: lxml if installed)")
+    convert_options.add_argument('--keep-boilerplate', nargs='+', default=[], metavar='KIND',
+                                 choices=['header', 'footer', 'license', 'preamble', 'title', 'transcriber'],
+                                 help="Boilerplate to leave in the text")
+
+    ingest_options = argparse.ArgumentParser(add_help=False)
+    ingest_options.add_argument('--max-tokens', type=int, default=512, help="Token budget per chunk")
+    ingest_options.add_argument('--overlap', type=int, default=64, help="Tokens repeated from the previous chunk")
+    ingest_options.add_argument('--dedup', action='store_true', help="Skip chunks another book already covers")
+
+    subparsers.add_parser('convert', parents=[convert_options], help="Download and convert books to text")
+    ingest = subparsers.add_parser('ingest', parents=[ingest_options], help="Upload converted books to the server")
+    ingest.add_argument('paths', nargs='*', help="Converted .txt files (default: every book in the output directory)")
+    ask = subparsers.add_parser('ask', help="Answer the questions of a CSV or Parquet file")
+    ask.add_argument('questions', help="CSV or Parquet file with a Question column")
+    ask.add_argument('--output', default='responses_from_csv.csv', help="Results file name, .csv or .parquet")
+    ask.add_argument('--resume', action='store_true', help="Skip the questions already answered in the results file")
+    ask.add_argument('--no-cache', action='store_true', help="Always ask the server, ignoring cached replies")
+    ask.add_argument('--no-index', action='store_true', help="Do not shortlist books with the local BM25 index")
+    subparsers.add_parser('pipeline', parents=[convert_options, ingest_options],
+                          help="Download, convert and ingest books with the stages overlapping")
+    return parser
+
+
+COMMANDS = {'convert': run_convert, 'ingest': run_ingest, 'ask': run_ask, 'pipeline': run_pipeline}
+
+
+def main(argv=None):
+    """ python cli.py --config client.toml pipeline --ids 2413 2600 """
+    args = build_parser().parse_args(argv)
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        print(f"Could not load config: {e}")
+        sys.exit(1)
+    COMMANDS[args.command](args, config)
+
+
+if __name__ == "__main__":
+    main()
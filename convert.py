@@ -1,54 +1,128 @@
 import requests
+import http_client
 import ebooklib
 from ebooklib import epub
-from bs4 import BeautifulSoup
+from extractors import DEFAULT_EXTRACTOR, EXTRACTORS, get_extractor
+from boilerplate import BOILERPLATE_PATTERNS, DEFAULT_BOILERPLATE, strip_boilerplate
+from manifest import file_sha256, cached_sha256, load_manifest, save_manifest
 import sys
 import warnings
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Bump whenever a change makes epub_to_text produce different text, so existing outputs are re-converted
+EXTRACTOR_VERSION = 2
+# Records which EPUB and extractor version produced each output, and the checksum of that output
+CONVERT_MANIFEST_PATH = '../client/output/.convert_manifest.json'
+
+GUTENBERG_URL = 'https://www.gutenberg.org/ebooks'
+# Local mirror of the downloaded EPUBs; only files that changed on the server are transferred again
+DOCUMENTS_PATH = '../client/documents'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Converted books are written here as '<book name>.txt'
+OUTPUT_PATH = '../client/output'
 
 # Suppress specific warnings from ebooklib
 warnings.filterwarnings("ignore", category=UserWarning, message="In the future version we will turn default option ignore_ncx to True.")
 
-def download_epub(book_id):
-    """ Download an EPUB file from Project Gutenberg without images. """
+def download_epub(book_id, exit_on_error=True, documents_path=DOCUMENTS_PATH, base_url=GUTENBERG_URL):
+    """ Download an EPUB file from Project Gutenberg without images, transferring only what changed since the last run. """
     # Ensure the directory exists
-    documents_path = '../client/documents'
     if not os.path.exists(documents_path):
         os.makedirs(documents_path, exist_ok=True)
 
     # Construct the file download URL and local save path
-    url = f'https://www.gutenberg.org/ebooks/{book_id}.epub.noimages'
+    url = f'{base_url}/{book_id}.epub.noimages'
     local_path = os.path.join(documents_path, f'{book_id}.epub')
+    part_path = local_path + '.part'
+    # Validators (ETag/Last-Modified) of the local copy and of any interrupted download
+    meta_path = local_path + '.meta.json'
+    meta = load_manifest(meta_path)
 
     try:
         # Attempt to download the file
-        response = requests.get(url, timeout=10)  # Added timeout for the request
+        response = request_epub(url, local_path, part_path, meta)
+        if response.status_code == 304:
+            response.close()
+            print(f"Book is unchanged on the server, keeping {local_path}")
+            return local_path
         response.raise_for_status()  # Will raise an HTTPError for bad responses
+
+        # Save the validators first so an interrupted transfer can be resumed by the next run
+        meta['partial'] = response_validators(response)
+        save_manifest(meta, meta_path)
+        # Stream the body to the partial file, appending when the server resumed it
+        with open(part_path, 'ab' if response.status_code == 206 else 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
     except requests.RequestException as e:
         # Handle specific requests exceptions or general request-related errors
         print(f"Failed to download the book: {e}")
+        if not exit_on_error:
+            raise  # Let bulk conversion record the failure and carry on with the other books
         sys.exit(1)
-
-    try:
-        # Write the downloaded content to a file
-        with open(local_path, 'wb') as f:
-            f.write(response.content)
     except IOError as e:
         # Handle potential file write errors
         print(f"Failed to save the book: {e}")
+        if not exit_on_error:
+            raise
         sys.exit(1)
 
     # Optional: Check if the file was written correctly (e.g., non-zero file size)
-    if os.path.getsize(local_path) > 0:
+    if os.path.getsize(part_path) > 0:
+        # Only a complete download replaces the local copy
+        os.replace(part_path, local_path)
+        # The validators of the finished download now describe the local copy
+        save_manifest(meta.pop('partial'), meta_path)
         print(f"Book downloaded and saved successfully: {local_path}")
     else:
         print("Failed to write the file, the file is empty.")
+        if not exit_on_error:
+            raise IOError(f"Downloaded file is empty: {local_path}")
         sys.exit(1)
 
     return local_path
 
-def epub_to_text(epub_path, output_txt_path):
+
+def response_validators(response):
+    """ The headers that identify the version of a downloaded file. """
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+
+def request_epub(url, local_path, part_path, meta):
+    """ Resume a partial download with a Range request, or revalidate a complete local copy with a conditional GET. """
+    headers = {}
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    partial = meta.get('partial') or {}
+    validator = partial.get('etag') or partial.get('last_modified')
+    if offset and validator:
+        # If-Range makes the server send the whole file instead if it changed since the partial download
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+    elif os.path.exists(local_path):
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    response = http_client.request('GET', url, endpoint='download', headers=headers, stream=True)
+    resumed_at = response.headers.get('Content-Range', '').partition(' ')[2].split('-')[0]
+    if 'Range' in headers and (response.status_code == 416 or
+                               (response.status_code == 206 and resumed_at != str(offset))):
+        # The partial file does not line up with the server's copy, start over from scratch
+        response.close()
+        os.remove(part_path)
+        return request_epub(url, local_path, part_path, {key: value for key, value in meta.items() if key != 'partial'})
+    return response
+
+
+def epub_to_text(epub_path, output_txt_path, extractor=DEFAULT_EXTRACTOR, boilerplate=DEFAULT_BOILERPLATE):
     """ Extract text from an EPUB file and save it as a plain text file, removing unwanted content. """
+    extract = get_extractor(extractor)
     if not os.path.exists(epub_path):
         print(f"Error: EPUB file does not exist at {epub_path}")
         return
@@ -59,38 +133,40 @@ def epub_to_text(epub_path, output_txt_path):
         print(f"Failed to read the EPUB file: {e}")
         return
 
-    full_text = []
+    # Chapters are written as soon as they are extracted, into a temporary file that only replaces
+    # the output once the whole book is done, so memory is bounded by the largest chapter
+    temp_path = output_txt_path + '.part'
     found_content = False  # Flag to check if we have processed any valid document content
-
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            soup = BeautifulSoup(item.content, 'html.parser')
-            text = soup.get_text()
-            start_phrase = "The Project Gutenberg eBook of"
-            end_phrase = "before using this eBook."
-            start_idx = text.find(start_phrase)
-            end_idx = text.find(end_phrase)
-
-            if start_idx != -1 and end_idx != -1:
-                text = text[:start_idx] + text[end_idx + len(end_phrase):]
-
-            lines = text.strip().split('\n')
-            initial_non_blank = next((i for i, line in enumerate(lines) if line.strip()), None)
-
-            if initial_non_blank is not None:
-                full_text.extend(lines[initial_non_blank:])
-                found_content = True
-
-    if not found_content:
-        print("No valid content found in the EPUB file.")
-        return
-
     try:
-        with open(output_txt_path, 'w', encoding='utf-8') as txt_file:
-            txt_file.write('\n'.join(full_text))
+        with open(temp_path, 'w', encoding='utf-8') as txt_file:
+            for chapter in iter_chapters(book, extract, boilerplate):
+                if found_content:
+                    txt_file.write('\n')
+                txt_file.write(chapter)
+                found_content = True
+        if not found_content:
+            os.remove(temp_path)
+            print("No valid content found in the EPUB file.")
+            return
+        os.replace(temp_path, output_txt_path)
         print(f"Text successfully extracted and saved to {output_txt_path}")
+        return output_txt_path
     except IOError as e:
         print(f"Failed to write to file {output_txt_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def iter_chapters(book, extract, boilerplate=DEFAULT_BOILERPLATE):
+    """ Yield the cleaned text of each document in the book, one chapter at a time. """
+    # Every extractor returns the same text as BeautifulSoup's get_text(), only faster
+    texts = (extract(item.content) for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT)
+    for text in strip_boilerplate(texts, boilerplate):
+        # Stripping leaves a chapter that starts at its first non-blank line, or nothing at all
+        text = text.strip()
+        if text:
+            yield text
+
 
 def check_available_texts():
     """ Check which processed texts are available in the output directory. """
@@ -107,18 +183,27 @@ def check_available_texts():
         print(f"Output directory is not accessible or readable: {output_dir}")
         return available_books
 
+    manifest = load_manifest(CONVERT_MANIFEST_PATH)
+    stats = dict(manifest.get('stats', {}))
+
     # Iterate over the book IDs and check for corresponding text files
     for book, id in book_ids.items():
         output_txt_path = os.path.join(output_dir, f'{book}.txt')
         
         # Check if file exists and is non-empty
         if os.path.exists(output_txt_path) and os.path.getsize(output_txt_path) > 0:
+            if not output_matches_manifest(book, output_txt_path, manifest):
+                print(f"Output for {book} does not match its recorded checksum, treating it as corrupt.")
+                continue
             available_books[book] = id
         elif os.path.exists(output_txt_path):
             print(f"Found empty or corrupt file for {book}, ignoring.")
         else:
             print(f"No txt file found for {book}.")
 
+    # Saving the sizes and mtimes of the outputs just hashed lets the next check skip hashing them again
+    if manifest.get('stats', {}) != stats:
+        save_manifest(manifest, CONVERT_MANIFEST_PATH)
     return available_books
 
 
@@ -129,6 +214,157 @@ book_ids = {
 }
 
 
+def load_book_ids(path):
+    """ Read Gutenberg IDs from a file with one `id` or `id,name` entry per line; blank lines and # comments are skipped. """
+    books = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            book_id, _, name = line.partition(',')
+            book_id = book_id.strip()
+            books[name.strip() or book_id] = book_id
+    return books
+
+
+def books_from_ids(ids, ids_file=None):
+    """ Map output names to Gutenberg IDs for IDs given directly and in an IDs file; known books keep their readable names. """
+    books = {book_id: book_id for book_id in ids}
+    if ids_file:
+        books.update(load_book_ids(ids_file))
+    names = {book_id: name for name, book_id in book_ids.items()}
+    return {names.get(book_id, name) if name == book_id else name: book_id for name, book_id in books.items()}
+
+
+def output_matches_manifest(book_name, output_txt_path, manifest):
+    """ Check an output against its recorded checksum; outputs without a manifest entry are trusted. """
+    entry = manifest.get('books', {}).get(book_name)
+    if entry is None:
+        return True
+    try:
+        return cached_sha256(output_txt_path, manifest.setdefault('stats', {})) == entry['output_sha256']
+    except OSError:
+        return False
+
+
+def conversion_entry(book_id, epub_sha256, output_txt_path, boilerplate=DEFAULT_BOILERPLATE):
+    """ Manifest entry describing a freshly converted output. """
+    return {
+        'book_id': book_id,
+        'epub_sha256': epub_sha256,
+        'extractor_version': EXTRACTOR_VERSION,
+        'boilerplate': sorted(boilerplate),
+        'output_sha256': file_sha256(output_txt_path),
+    }
+
+
+def conversion_is_current(entry, epub_sha256, output_txt_path, boilerplate=DEFAULT_BOILERPLATE):
+    """ True if the output came from this exact EPUB, extractor version and boilerplate setting and has not been modified since. """
+    if not entry or entry.get('epub_sha256') != epub_sha256 or entry.get('extractor_version') != EXTRACTOR_VERSION:
+        return False
+    if entry.get('boilerplate') != sorted(boilerplate):
+        return False
+    try:
+        # Hashing the output is far cheaper than parsing the EPUB again
+        return file_sha256(output_txt_path) == entry.get('output_sha256')
+    except OSError:
+        return False
+
+
+def convert_book(book_name, book_id, extractor=DEFAULT_EXTRACTOR, previous=None,
+                 documents_path=DOCUMENTS_PATH, base_url=GUTENBERG_URL, boilerplate=DEFAULT_BOILERPLATE, output_path=OUTPUT_PATH):
+    """ Download and convert one book, returning (book name, output path, error, manifest entry, skipped). """
+    try:
+        epub_path = download_epub(book_id, exit_on_error=False, documents_path=documents_path, base_url=base_url)
+    except Exception as e:
+        return book_name, None, str(e), None, False
+    return convert_downloaded(book_name, book_id, epub_path, extractor, previous, boilerplate, output_path)
+
+
+def convert_downloaded(book_name, book_id, epub_path, extractor=DEFAULT_EXTRACTOR, previous=None,
+                       boilerplate=DEFAULT_BOILERPLATE, output_path=OUTPUT_PATH):
+    """ Convert an already downloaded EPUB unless its output is current; returns the same tuple as convert_book. """
+    try:
+        output_txt_path = f'{output_path}/{book_name}.txt'
+        epub_sha256 = file_sha256(epub_path)
+        if conversion_is_current(previous, epub_sha256, output_txt_path, boilerplate):
+            print(f"{book_name} is up to date, skipping conversion.")
+            return book_name, output_txt_path, None, previous, True
+        if epub_to_text(epub_path, output_txt_path, extractor, boilerplate) is None:
+            return book_name, None, "Conversion produced no output", None, False
+        return book_name, output_txt_path, None, conversion_entry(book_id, epub_sha256, output_txt_path, boilerplate), False
+    except Exception as e:
+        return book_name, None, str(e), None, False
+
+
+def convert_books(books, max_workers=None, extractor=DEFAULT_EXTRACTOR, manifest=None,
+                  documents_path=DOCUMENTS_PATH, base_url=GUTENBERG_URL, boilerplate=DEFAULT_BOILERPLATE, output_path=OUTPUT_PATH):
+    """ Convert many books across a process pool and return a {'converted', 'skipped', 'failed'} report. """
+    report = {'converted': {}, 'skipped': {}, 'failed': {}}
+    recorded = manifest.setdefault('books', {}) if manifest is not None else {}
+    os.makedirs(output_path, exist_ok=True)
+
+    def record(book_name, output_path, error, entry, skipped):
+        if error is not None:
+            print(f"Failed to convert {book_name}: {error}")
+            report['failed'][book_name] = error
+            return
+        report['skipped' if skipped else 'converted'][book_name] = output_path
+        if manifest is not None:
+            recorded[book_name] = entry
+
+    if max_workers == 1:
+        # Run in this process, which keeps debugging simple
+        for book_name, book_id in books.items():
+            record(*convert_book(book_name, book_id, extractor, recorded.get(book_name), documents_path, base_url,
+                                 boilerplate, output_path))
+    else:
+        # Parsing is CPU bound, so each book gets its own process instead of a thread
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(convert_book, book_name, book_id, extractor, recorded.get(book_name),
+                                       documents_path, base_url, boilerplate, output_path)
+                       for book_name, book_id in books.items()]
+            for done, future in enumerate(as_completed(futures), start=1):
+                record(*future.result())
+                print(f"Finished {done}/{len(futures)} books.")
+
+    print(f"Converted {len(report['converted'])} and skipped {len(report['skipped'])} unchanged of {len(books)} books.")
+    return report
+
+
+def bulk_main(argv):
+    """ Non-interactive entry point: python convert.py --ids 2413 2600 --ids-file catalog.txt --workers 8 """
+    parser = argparse.ArgumentParser(description="Download and convert Gutenberg books in bulk.")
+    parser.add_argument('--ids', nargs='*', default=[], help="Gutenberg book IDs to convert")
+    parser.add_argument('--ids-file', help="File with one `id` or `id,name` entry per line")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--extractor', choices=sorted(EXTRACTORS), default=DEFAULT_EXTRACTOR,
+                        help="HTML-to-text backend (all produce identical text)")
+    parser.add_argument('--documents-dir', default=DOCUMENTS_PATH, help="Local mirror directory for downloaded EPUBs")
+    parser.add_argument('--base-url', default=GUTENBERG_URL, help="Server to download EPUBs from, e.g. a local mirror")
+    parser.add_argument('--keep-boilerplate', nargs='+', default=[], choices=list(BOILERPLATE_PATTERNS), metavar='KIND',
+                        help=f"Boilerplate to leave in the text ({', '.join(BOILERPLATE_PATTERNS)})")
+    args = parser.parse_args(argv)
+
+    try:
+        books = books_from_ids(args.ids, args.ids_file)
+    except OSError as e:
+        print(f"Could not read book IDs from {args.ids_file}: {e}")
+        sys.exit(1)
+    if not books:
+        print("No book IDs given.")
+        sys.exit(1)
+
+    manifest = load_manifest(CONVERT_MANIFEST_PATH)
+    report = convert_books(books, max_workers=args.workers, extractor=args.extractor, manifest=manifest,
+                           documents_path=args.documents_dir, base_url=args.base_url,
+                           boilerplate=[kind for kind in DEFAULT_BOILERPLATE if kind not in args.keep_boilerplate])
+    save_manifest(manifest, CONVERT_MANIFEST_PATH)
+    if report['failed']:
+        sys.exit(1)
+
+
 def main():
     available_books = check_available_texts()
     if available_books:
@@ -154,7 +390,11 @@ def main():
                 book_id = book_ids[book_name]
                 epub_path = download_epub(book_id)
                 output_txt_path = f'../client/output/{book_name}.txt'
-                epub_to_text(epub_path, output_txt_path)
+                if epub_to_text(epub_path, output_txt_path) is not None:
+                    # Remember what produced this output so later runs can spot stale or corrupted texts
+                    manifest = load_manifest(CONVERT_MANIFEST_PATH)
+                    manifest.setdefault('books', {})[book_name] = conversion_entry(book_id, file_sha256(epub_path), output_txt_path)
+                    save_manifest(manifest, CONVERT_MANIFEST_PATH)
                 print(f'Processed text file saved as {output_txt_path}')
             except Exception as e:
                 print(f"An error occurred while processing {book_name}: {e}")
@@ -171,4 +411,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # Any command line arguments switch to the non-interactive bulk mode
+    if len(sys.argv) > 1:
+        bulk_main(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,155 @@
+import argparse
+import re
+import zlib
+from collections import Counter, defaultdict
+import numpy as np
+from chunker import iter_paragraphs
+
+# Estimated Jaccard similarity of word shingles above which two paragraphs count as the same text
+THRESHOLD = 0.8
+# 16 bands of 8 rows make pairs above ~0.7 similarity very likely to share a bucket
+NUM_PERM = 128
+BANDS = 16
+SHINGLE_SIZE = 5
+# Shorter paragraphs ("CHAPTER I.", "THE END") are identical across unrelated books
+MIN_WORDS = 20
+# A chunk is dropped when at least this share of its words duplicate another book
+DUPLICATE_FRACTION = 0.9
+MERSENNE_PRIME = (1 << 61) - 1
+WORD = re.compile(r'\w+')
+
+
+class MinHashLSH:
+    """ MinHash signatures of word shingles, bucketed by band so near-duplicates are found without comparing every pair. """
+
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, bands=BANDS, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.bands = bands
+        # a * hash + b stays below 2**64 because a, b and the crc32 hashes are all 32-bit
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+        self._b = generator.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+        self._signatures = {}
+        self._owners = {}
+        self._order = {}
+
+    def signature(self, text):
+        """ Return the MinHash signature of a text, or None if it is too short to compare meaningfully. """
+        words = WORD.findall(text.lower())
+        if len(words) < MIN_WORDS:
+            return None
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        permuted = (hashes[:, None] * self._a + self._b) % MERSENNE_PRIME
+        return (permuted.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def insert(self, key, signature, owner=None):
+        self._signatures[key] = signature
+        self._owners[key] = owner
+        self._order[key] = len(self._order)
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket[band_key].append(key)
+
+    def query(self, signature, exclude_owner=None):
+        """ Return (key, estimated similarity) of the closest stored text above the threshold, or None; ties go to the earliest. """
+        candidates = set()
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(band_key, ()))
+        best = None
+        for key in sorted(candidates, key=self._order.get):
+            if exclude_owner is not None and self._owners[key] == exclude_owner:
+                continue
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+
+def find_duplicate_paragraphs(paths, threshold=THRESHOLD):
+    """ Return (path, line, duplicate of path, line, similarity) for every paragraph that repeats one from an earlier book. """
+    lsh = MinHashLSH(threshold)
+    duplicates = []
+    for path in paths:
+        for paragraph, first, _ in iter_paragraphs(path):
+            signature = lsh.signature(paragraph)
+            if signature is None:
+                continue
+            # Only overlap between books matters; repeated lines inside one book are left alone
+            match = lsh.query(signature, exclude_owner=path)
+            if match is not None:
+                (other_path, other_line), similarity = match
+                duplicates.append((path, first, other_path, other_line, similarity))
+            else:
+                lsh.insert((path, first), signature, owner=path)
+    return duplicates
+
+
+def add_books(lsh, books):
+    """ Insert every paragraph of {book name: path}, e.g. books ingested by earlier runs, so new chunks are compared with them. """
+    for book, path in books.items():
+        for paragraph, first, _ in iter_paragraphs(path):
+            signature = lsh.signature(paragraph)
+            if signature is not None:
+                lsh.insert((book, first), signature, owner=book)
+    return lsh
+
+
+def drop_duplicate_chunks(chunk_files, chunk_books, threshold=THRESHOLD, fraction=DUPLICATE_FRACTION, lsh=None):
+    """ Split {chunk name: path} into the chunks to upload and {chunk name: duplicated share} of those covered by another book. """
+    # Callers that upload one book at a time pass the same lsh every time, so later books are compared with earlier ones
+    lsh = MinHashLSH(threshold) if lsh is None else lsh
+    kept, dropped = {}, {}
+    for chunk_name, path in chunk_files.items():
+        book = chunk_books[chunk_name]
+        with open(path, encoding='utf-8') as f:
+            paragraphs = f.read().split('\n\n')
+
+        total_words = duplicate_words = 0
+        signatures = []
+        for paragraph in paragraphs:
+            words = len(paragraph.split())
+            total_words += words
+            signature = lsh.signature(paragraph)
+            if signature is None:
+                continue
+            if lsh.query(signature, exclude_owner=book) is not None:
+                duplicate_words += words
+            else:
+                signatures.append(signature)
+
+        share = duplicate_words / total_words if total_words else 0.0
+        if share >= fraction:
+            dropped[chunk_name] = share
+            continue
+        kept[chunk_name] = path
+        for number, signature in enumerate(signatures):
+            lsh.insert((chunk_name, number), signature, owner=book)
+    return kept, dropped
+
+
+def main(argv=None):
+    """ Report how much of each converted book repeats an earlier one. """
+    parser = argparse.ArgumentParser(description="Find near-duplicate paragraphs across converted books.")
+    parser.add_argument('paths', nargs='+', help="Converted .txt files")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="Estimated Jaccard similarity of duplicates")
+    args = parser.parse_args(argv)
+
+    duplicates = find_duplicate_paragraphs(args.paths, args.threshold)
+    if not duplicates:
+        print("No near-duplicate paragraphs found.")
+        return
+    for (path, other_path), count in Counter((dup[0], dup[2]) for dup in duplicates).most_common():
+        print(f"{path}: {count} paragraphs duplicate {other_path}")
+    for path, line, other_path, other_line, similarity in duplicates:
+        print(f"  {path}:{line} ~ {other_path}:{other_line} ({similarity:.2f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import re
+import sys
+import time
+import warnings
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional, the other extractors work without it
+    etree = None
+
+# Text inside these tags is not part of get_text() output
+SKIPPED_TAGS = {'script', 'style', 'template'}
+# Whitespace inside these tags is kept as-is
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+# Whitespace between markup before the root element and after it is closed
+PROLOG_WHITESPACE = re.compile(rb'>([\x20\x0a\x09\x0c\x0d]+)<')
+ROOT_START = re.compile(rb'<[A-Za-z]')
+XML_ENCODING = re.compile(rb'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+if etree is not None:
+    TEXT_NODES = etree.XPath('//text()[not(parent::*[{}])]'.format(
+        ' or '.join(f"local-name()='{tag}'" for tag in sorted(SKIPPED_TAGS))))
+
+
+def collapse_whitespace(text, preserve=False):
+    """ Mirror BeautifulSoup: a string made only of ASCII whitespace becomes a single newline or space. """
+    if not preserve and not text.strip(ASCII_SPACES):
+        return '\n' if '\n' in text else ' '
+    return text
+
+
+def extract_with_html_parser(content):
+    """ Reference extractor: BeautifulSoup with the stdlib html.parser. """
+    return BeautifulSoup(content, 'html.parser').get_text()
+
+
+class TextStripper(HTMLParser):
+    """ Streaming tag stripper producing the same text as BeautifulSoup's get_text() without building a tree. """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._pending = []
+        self._skipped = 0
+        self._preserved = 0
+
+    def _flush(self):
+        # BeautifulSoup joins all data between two markup events into one string
+        if not self._pending:
+            return
+        text = ''.join(self._pending)
+        self._pending = []
+        if not self._skipped:
+            self.parts.append(collapse_whitespace(text, self._preserved > 0))
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag in SKIPPED_TAGS:
+            self._skipped += 1
+        if tag in PRESERVE_WHITESPACE_TAGS:
+            self._preserved += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self._flush()
+
+    def handle_endtag(self, tag):
+        self._flush()
+        if tag in SKIPPED_TAGS and self._skipped:
+            self._skipped -= 1
+        if tag in PRESERVE_WHITESPACE_TAGS and self._preserved:
+            self._preserved -= 1
+
+    def handle_data(self, data):
+        self._pending.append(data)
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def unknown_decl(self, data):
+        # CDATA sections are text for BeautifulSoup
+        self._flush()
+        if data.startswith('CDATA[') and not self._skipped:
+            self.parts.append(data[len('CDATA['):])
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def extract_with_sax(content):
+    """ Stdlib streaming extractor, no tree is built. """
+    if isinstance(content, bytes):
+        # Honour the XML declaration; undecodable bytes go through html.parser, whose encoding detection is the reference
+        declared = XML_ENCODING.match(content)
+        try:
+            content = content.decode(declared.group(1).decode('ascii') if declared else 'utf-8')
+        except (LookupError, UnicodeDecodeError):
+            return extract_with_html_parser(content)
+    stripper = TextStripper()
+    stripper.feed(content)
+    stripper.close()
+    return ''.join(stripper.parts)
+
+
+def extract_with_lxml(content):
+    """ Fast extractor for well-formed XHTML; anything lxml cannot parse strictly goes through html.parser. """
+    if etree is None or not isinstance(content, bytes) or b'<![CDATA[' in content:
+        return extract_with_html_parser(content)
+    try:
+        root = etree.fromstring(content, etree.XMLParser(resolve_entities=False, huge_tree=True))
+    except (etree.XMLSyntaxError, ValueError):
+        # E.g. HTML entities such as &nbsp; that are undefined in plain XML
+        return extract_with_html_parser(content)
+
+    parts = []
+    # Text outside the root element is not in the tree, but BeautifulSoup keeps the whitespace between markup
+    root_start = ROOT_START.search(content)
+    root_end = content.rfind(b'>')
+    if root_start:
+        parts.extend(collapse_whitespace(m.group(1).decode('utf-8')) for m in PROLOG_WHITESPACE.finditer(content, 0, root_start.start() + 1))
+
+    # Text inside skipped tags is filtered by libxml2 itself; tails of those tags are siblings and stay
+    texts = TEXT_NODES(root)
+    # Elements without children are falsy, so test whether the iterator yields anything at all
+    if next(root.iter(*[f'{{*}}{tag}' for tag in PRESERVE_WHITESPACE_TAGS]), None) is None:
+        parts.extend(text if text.strip(ASCII_SPACES) else ('\n' if '\n' in text else ' ') for text in texts)
+    else:
+        for text in texts:
+            owner = text.getparent()
+            if text.is_tail:
+                owner = owner.getparent()
+            preserve = owner is not None and any(
+                element.tag.rpartition('}')[2] in PRESERVE_WHITESPACE_TAGS
+                for element in [owner] + list(owner.iterancestors())
+            )
+            parts.append(collapse_whitespace(text, preserve))
+
+    epilog = content[root_end + 1:]
+    if epilog:
+        parts.append(collapse_whitespace(epilog.decode('utf-8')))
+    return ''.join(parts)
+
+
+EXTRACTORS = {
+    'html.parser': extract_with_html_parser,
+    'sax': extract_with_sax,
+    'lxml': extract_with_lxml,
+}
+DEFAULT_EXTRACTOR = 'lxml' if etree is not None else 'html.parser'
+
+
+def get_extractor(name):
+    """ Look up an extraction backend by name. """
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown extractor '{name}', choose one of: {', '.join(EXTRACTORS)}")
+    return EXTRACTORS[name]
+
+
+def benchmark(epub_paths):
+    """ Time every extractor on the given books and check their text is identical to html.parser's. """
+    import ebooklib
+    from ebooklib import epub
+
+    warnings.filterwarnings("ignore", category=UserWarning)
+    for epub_path in epub_paths:
+        book = epub.read_epub(epub_path)
+        contents = [item.content for item in book.get_items() if item.get_type() == ebooklib.ITEM_DOCUMENT]
+        reference = None
+        for name, extract in EXTRACTORS.items():
+            started = time.perf_counter()
+            text = ''.join(extract(content) for content in contents)
+            elapsed = time.perf_counter() - started
+            reference = text if reference is None else reference
+            status = 'identical' if text == reference else 'DIFFERENT'
+            print(f"{epub_path} {name:<12} {elapsed:.3f}s {status}")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
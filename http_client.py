@@ -0,0 +1,249 @@
+import random
+import threading
+import time
+import requests
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+import metrics
+
+# Connections kept alive per host; should be at least the number of parallel workers
+POOL_SIZE = 16
+# Attempts after the first one for 429/5xx responses and connection errors
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# A read timeout means the server may still be working on the request, so only these methods are sent again after one
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+# Timeouts in seconds for each kind of endpoint the client talks to
+TIMEOUTS = {
+    'chat': 600,
+    'ingest': 1200,
+    'download': 10,
+    'default': 60,
+}
+
+# Additive-increase/multiplicative-decrease limits on concurrent requests per endpoint. The limit grows by one
+# while the p95 latency of a window of responses stays under the target and is cut on timeouts, 429 and 5xx
+ADAPTIVE_CONCURRENCY = True
+ADAPTIVE_LIMITS = {
+    'chat': {'initial': 4, 'maximum': 16, 'target': 60.0},
+    'ingest': {'initial': 3, 'maximum': 8, 'target': 300.0},
+}
+ADAPTIVE_WINDOW = 10
+ADAPTIVE_BACKOFF = 0.5
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class SlotTimeout(requests.exceptions.Timeout):
+    """ The deadline passed while a request was waiting for a slot; nothing was sent. """
+
+
+def configure(pool_size=POOL_SIZE):
+    """ Replace the shared session with one whose connection pool holds pool_size connections per host. """
+    global _session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with _session_lock:
+        old, _session = _session, session
+    if old is not None:
+        old.close()
+    return session
+
+
+def get_session():
+    """ Return the shared keep-alive session, creating it on first use. """
+    with _session_lock:
+        session = _session
+    return session if session is not None else configure()
+
+
+class AdaptiveLimiter:
+    """ Concurrency limit for one endpoint that adapts to the latency and errors the server shows. """
+
+    def __init__(self, endpoint, initial, maximum, target, minimum=1, window=ADAPTIVE_WINDOW, backoff=ADAPTIVE_BACKOFF):
+        self.endpoint = endpoint
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.window = window
+        self.backoff = backoff
+        self._in_flight = 0
+        self._latencies = []
+        # Bumped on every decrease, so one burst of failures only cuts the limit once
+        self._epoch = 0
+        self._condition = threading.Condition()
+        metrics.set_gauge('http_client_concurrency_limit', self.limit, endpoint=endpoint)
+
+    def acquire(self, timeout=None):
+        """ Wait up to timeout seconds for a free slot and return the epoch to hand back to release. """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < self.limit, timeout):
+                raise SlotTimeout(f"No {self.endpoint} request slot freed up within {timeout:.1f}s")
+            self._in_flight += 1
+            return self._epoch
+
+    def release(self, epoch, seconds, ok):
+        """ Free a slot and adjust the limit with the outcome of the request that held it. """
+        with self._condition:
+            self._in_flight -= 1
+            if not ok:
+                # Requests sent before the last decrease saw the old limit, so their failures are not counted again
+                if epoch == self._epoch:
+                    self._decrease("timeout or server error")
+            else:
+                self._latencies.append(seconds)
+                # Roughly one decision per round trip of the whole window of requests
+                if len(self._latencies) >= max(self.window, self.limit):
+                    p95 = sorted(self._latencies)[int(0.95 * (len(self._latencies) - 1))]
+                    if p95 <= self.target:
+                        self._set(min(self.maximum, self.limit + 1), f"p95 {p95:.2f}s <= {self.target:g}s")
+                    else:
+                        self._decrease(f"p95 {p95:.2f}s > {self.target:g}s")
+            self._condition.notify_all()
+
+    def _decrease(self, reason):
+        self._epoch += 1
+        self._set(max(self.minimum, int(self.limit * self.backoff)), reason)
+
+    def _set(self, limit, reason):
+        self._latencies = []
+        if limit == self.limit:
+            return
+        print(f"Concurrency limit for {self.endpoint}: {self.limit} -> {limit} ({reason})")
+        metrics.increment('http_client_limit_changes_total', endpoint=self.endpoint, direction='up' if limit > self.limit else 'down')
+        metrics.set_gauge('http_client_concurrency_limit', limit, endpoint=self.endpoint)
+        self.limit = limit
+
+
+_limiters = {}
+
+
+def configure_limiters(limits=None):
+    """ Start every endpoint in limits (default ADAPTIVE_LIMITS) again from its initial limit. """
+    limits = ADAPTIVE_LIMITS if limits is None else limits
+    with _session_lock:
+        _limiters.clear()
+        _limiters.update({endpoint: AdaptiveLimiter(endpoint, **settings) for endpoint, settings in limits.items()})
+
+
+def get_limiter(endpoint):
+    """ Return the limiter shared by every request to this endpoint, or None if it is not adaptive. """
+    if not ADAPTIVE_CONCURRENCY:
+        return None
+    if not _limiters:
+        configure_limiters()
+    return _limiters.get(endpoint)
+
+
+def concurrency_ceiling(endpoint, default):
+    """ Number of workers a caller should run so the limiter, not the pool, decides how many requests are open. """
+    limiter = get_limiter(endpoint)
+    return max(default, limiter.maximum) if limiter is not None else default
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """ Exponential backoff with full jitter for the given zero-based retry attempt. """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _retry_after(response, attempt):
+    """ Honour a numeric Retry-After header, falling back to the usual backoff. """
+    value = response.headers.get('Retry-After', '')
+    if value.isdigit():
+        return min(float(value), BACKOFF_MAX)
+    return backoff_delay(attempt)
+
+
+def _file_bodies(kwargs):
+    """ Collect file objects in a request body so they can be rewound before a retry. """
+    bodies = []
+    files = kwargs.get('files') or {}
+    for value in files.values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            bodies.append(fileobj)
+    data = kwargs.get('data')
+    if hasattr(data, 'seek'):
+        bodies.append(data)
+    return [(body, body.tell()) for body in bodies]
+
+
+def _header_bytes(headers):
+    """ Content-Length of a request or response, or None if it is not known up front. """
+    value = headers.get('Content-Length') if headers is not None else None
+    return int(value) if isinstance(value, str) and value.isdigit() else None
+
+
+def record_response(response, endpoint, started):
+    """ Record the status, timing phases and payload sizes of a finished request. """
+    metrics.increment('http_client_responses_total', endpoint=endpoint, status=response.status_code)
+    metrics.observe('http_client_request_seconds', time.monotonic() - started, endpoint=endpoint)
+    # From sending the request until the response headers were parsed: connect, upload and server time
+    elapsed = getattr(response, 'elapsed', None)
+    if isinstance(elapsed, timedelta):
+        metrics.observe('http_client_time_to_headers_seconds', elapsed.total_seconds(), endpoint=endpoint)
+    sent = _header_bytes(getattr(getattr(response, 'request', None), 'headers', None))
+    if sent is not None:
+        metrics.observe('http_client_request_bytes', sent, buckets=metrics.SIZE_BUCKETS, endpoint=endpoint)
+    received = _header_bytes(getattr(response, 'headers', None))
+    if received is not None:
+        metrics.observe('http_client_response_bytes', received, buckets=metrics.SIZE_BUCKETS, endpoint=endpoint)
+
+
+def request(method, url, endpoint='default', retries=MAX_RETRIES, timeout=None, deadline=None, on_attempt=None, **kwargs):
+    """ Send a request over the shared session, retrying 429/5xx responses and connection errors with backoff. """
+    # Past the time.monotonic() deadline no attempt is started, so a question given up on never reaches the server
+    timeout = TIMEOUTS.get(endpoint, TIMEOUTS['default']) if timeout is None else timeout
+    bodies = _file_bodies(kwargs)
+    started = time.monotonic()
+
+    for attempt in range(retries + 1):
+        for body, position in bodies:
+            body.seek(position)
+        limiter = get_limiter(endpoint)
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        try:
+            if remaining is not None and remaining <= 0:
+                raise SlotTimeout(f"Deadline passed before attempt {attempt + 1} of {url}")
+            epoch = limiter.acquire(remaining) if limiter is not None else None
+        except SlotTimeout:
+            metrics.increment('http_client_errors_total', endpoint=endpoint, error='SlotTimeout')
+            raise
+        attempt_started = time.monotonic()
+        # Called once the attempt has its slot, right before it is sent, e.g. to time the phases of that attempt alone
+        if on_attempt is not None:
+            on_attempt()
+        ok = False
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+            ok = response.status_code not in RETRY_STATUSES
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            metrics.increment('http_client_errors_total', endpoint=endpoint, error=type(e).__name__)
+            # ConnectTimeout is a ConnectionError: nothing reached the server. A read timeout on a POST is not retried,
+            # re-sending a book the server is still embedding would store it twice
+            read_timeout = not isinstance(e, requests.exceptions.ConnectionError)
+            if attempt == retries or (read_timeout and method.upper() not in IDEMPOTENT_METHODS):
+                raise
+            delay = backoff_delay(attempt)
+            print(f"{type(e).__name__} for {url}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                record_response(response, endpoint, started)
+                return response
+            metrics.increment('http_client_responses_total', endpoint=endpoint, status=response.status_code)
+            delay = _retry_after(response, attempt)
+            print(f"Server returned {response.status_code} for {url}, retrying in {delay:.1f}s ({attempt + 1}/{retries})")
+            response.close()
+        finally:
+            # The slot is given back before any backoff, so waiting to retry does not hold up other requests
+            if limiter is not None:
+                limiter.release(epoch, time.monotonic() - attempt_started, ok)
+        metrics.increment('http_client_retries_total', endpoint=endpoint)
+        time.sleep(delay)
@@ -1,49 +1,363 @@
 import requests
+import http_client
+import metrics
+import time
 import sys
+import os
+import uuid
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from manifest import cached_sha256, load_manifest, save_manifest
+from chunker import CHUNK_OVERLAP, CHUNK_TOKENS, CHUNKS_PATH, chunk_book, chunk_index_path, index_is_current
+from dedup import MinHashLSH, add_books, drop_duplicate_chunks
 
+# Number of files uploaded at the same time in bulk mode
+INGEST_WORKERS = 3
+# Remembers which file contents the server has already embedded, across runs
+MANIFEST_PATH = '../client/output/.ingest_manifest.json'
+# Skip chunks whose text is already covered by another book, e.g. a second edition of the same work
+DROP_DUPLICATES = False
 
-def send_file_to_server(file_path, url):
+
+class MultipartFileStream:
+    """ File-like multipart/form-data body that reads the upload from disk block by block instead of buffering it. """
+
+    def __init__(self, field_name, file_path, content_type='application/octet-stream', filename=None):
+        self.boundary = uuid.uuid4().hex
+        filename = file_path if filename is None else filename
+        self._head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{quote_header_param(field_name)}"; '
+            f'filename="{quote_header_param(filename)}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        self._tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self._file = open(file_path, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self.length = len(self._head) + self._file_size + len(self._tail)
+        self._position = 0
+        self.attempt_started = None
+        self.first_read_at = None
+        self.last_read_at = None
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        """ Only absolute positions are needed, e.g. to rewind before a retry. """
+        if whence != 0:
+            raise OSError("MultipartFileStream only supports absolute seeks")
+        self._position = max(0, min(offset, self.length))
+        self._file.seek(min(max(self._position - len(self._head), 0), self._file_size))
+        if self._position == 0:
+            # A rewound body is sent again, so the timings of the previous attempt no longer apply
+            self.first_read_at = self.last_read_at = None
+        return self._position
+
+    def start_attempt(self):
+        """ Mark the moment a (re)try of the upload starts, after waiting for a slot and any backoff. """
+        self.attempt_started = time.monotonic()
+        self.first_read_at = self.last_read_at = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self._position
+        if self.first_read_at is None:
+            self.first_read_at = time.monotonic()
+
+        parts = []
+        while size > 0 and self._position < self.length:
+            file_end = len(self._head) + self._file_size
+            if self._position < len(self._head):
+                part = self._head[self._position:self._position + size]
+            elif self._position < file_end:
+                part = self._file.read(min(size, file_end - self._position))
+            else:
+                offset = self._position - file_end
+                part = self._tail[offset:offset + size]
+            if not part:
+                raise OSError("File changed size while it was being uploaded")
+            parts.append(part)
+            self._position += len(part)
+            size -= len(part)
+
+        self.last_read_at = time.monotonic()
+        return b''.join(parts)
+
+    def upload_seconds(self):
+        """ Time between handing the first and the last bytes to the connection. """
+        if self.first_read_at is None:
+            return 0.0
+        return self.last_read_at - self.first_read_at
+
+    def close(self):
+        self._file.close()
+
+
+def quote_header_param(value):
+    """ Escape a multipart header parameter the way browsers (and urllib3) do. """
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+def send_file_to_server(file_path, url, exit_on_error=True):
     """ Send a file to the specified server endpoint with a custom timeout. """
-    with open(file_path, 'rb') as f:
-        files = {'file': (file_path, f, 'application/octet-stream')}
+    # The multipart body is streamed from disk so memory stays flat regardless of the file size
+    with MultipartFileStream('file', file_path) as body:
         try:
-            # Setting a longer timeout, e.g., 900 seconds (15 minutes)
-            response = requests.post(url, files=files, timeout=1200)
+            # Uploads use the long ingest timeout and are retried on transient server errors
+            started = time.monotonic()
+            response = http_client.request('POST', url, endpoint='ingest', data=body,
+                                           headers={'Content-Type': body.content_type}, on_attempt=body.start_attempt)
+            elapsed = time.monotonic() - started
+            report_throughput(file_path, body, elapsed)
+            record_upload_phases(body, started + elapsed)
             return response
         except requests.exceptions.Timeout:
-            print("The request timed out. Please try again or verify the server's response time.")
+            print("The request timed out after all retries. Please try again or verify the server's response time.")
+            if not exit_on_error:
+                raise  # Let bulk uploads record the failure and carry on with the other files
             sys.exit(1)  # Exit if the server does not respond within the timeout period
         except requests.exceptions.RequestException as e:
             print("An error occurred while uploading the file:", e)
+            if not exit_on_error:
+                raise
             sys.exit(1)
 
 
-def send_all_files(available_files, sent_books, api_url):
-    """ Sends all available files to the server and updates the list of sent books. """
-    for book_name, file_path in available_files.items():
-        if book_name not in sent_books:
+def report_throughput(file_path, body, elapsed):
+    """ Print how fast the body went over the wire and how long the whole request took. """
+    megabytes = body.length / (1024 * 1024)
+    upload_seconds = body.upload_seconds()
+    rate = f"{megabytes / upload_seconds:.2f} MB/s" if upload_seconds > 0 else "instant"
+    print(f"Sent {os.path.basename(file_path)}: {megabytes:.2f} MB uploaded at {rate}, request took {elapsed:.1f}s")
+
+
+def record_upload_phases(body, finished):
+    """ Split the attempt that succeeded into connecting (before the first body byte), sending the body and waiting for the server. """
+    metrics.observe('ingest_upload_bytes', body.length, buckets=metrics.SIZE_BUCKETS)
+    # Waiting for a limiter slot, failed attempts and backoff are left out, they are not part of any phase
+    if body.first_read_at is None or body.attempt_started is None:
+        return
+    metrics.observe('ingest_connect_seconds', body.first_read_at - body.attempt_started)
+    metrics.observe('ingest_upload_seconds', body.upload_seconds())
+    metrics.observe('ingest_server_seconds', finished - body.last_read_at)
+
+
+def document_ids(response):
+    """ Return the ids of the documents the server created for an upload. """
+    try:
+        return [document['doc_id'] for document in response.json().get('data', [])]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def is_already_ingested(file_path, manifest):
+    """ Check whether the current content of a file has already been ingested, hashing only files whose stat changed. """
+    try:
+        sha256 = cached_sha256(file_path, manifest.setdefault('stats', {}))
+    except OSError:
+        return False
+    return sha256 in manifest.get('documents', {})
+
+
+def record_ingestion(file_path, doc_ids, manifest, duplicate_share=None):
+    """ Store the ingestion result for the file's current content and return the doc ids of its previous content. """
+    path = os.path.normpath(file_path)
+    sha256 = cached_sha256(file_path, manifest.setdefault('stats', {}))
+    documents = manifest.setdefault('documents', {})
+
+    # A modified file has just been re-ingested, so the entries for its old content are stale
+    stale_ids = []
+    for old_sha256 in [key for key, entry in documents.items() if entry['path'] == path and key != sha256]:
+        stale_ids.extend(documents.pop(old_sha256)['doc_ids'])
+
+    documents[sha256] = {
+        'path': path,
+        'doc_ids': doc_ids,
+        'ingested_at': datetime.now(timezone.utc).isoformat(),
+    }
+    # A chunk left out because another book already covers it counts as ingested without any documents of its own
+    if duplicate_share is not None:
+        documents[sha256]['duplicate_share'] = round(duplicate_share, 3)
+    return stale_ids
+
+
+def forget_files(paths, manifest):
+    """ Drop the manifest entries of files that no longer exist, e.g. the chunks a shortened book lost, and return their doc ids. """
+    paths = {os.path.normpath(path) for path in paths}
+    documents = manifest.get('documents', {})
+    doc_ids = []
+    for sha256 in [key for key, entry in documents.items() if entry['path'] in paths]:
+        doc_ids.extend(documents.pop(sha256)['doc_ids'])
+    for path in paths:
+        manifest.get('stats', {}).pop(path, None)
+    return doc_ids
+
+
+def delete_documents(doc_ids, api_url):
+    """ Remove documents from the server on a best-effort basis, e.g. the old version of a modified book. """
+    base_url = api_url.rsplit('/', 1)[0]  # .../v1/ingest/file -> .../v1/ingest
+    for doc_id in doc_ids:
+        try:
+            response = http_client.request('DELETE', f"{base_url}/{doc_id}", endpoint='ingest')
+            if response.status_code != 200:
+                print(f"Could not delete stale document {doc_id}: status code {response.status_code}")
+        except requests.exceptions.RequestException as e:
+            print(f"Could not delete stale document {doc_id}: {e}")
+
+
+def upload_book(book_name, file_path, api_url):
+    """ Upload one book and return (succeeded, detail, seconds taken, doc ids) without raising. """
+    started = time.monotonic()
+    try:
+        response = send_file_to_server(file_path, api_url, exit_on_error=False)
+        if response is not None and response.status_code == 200:
+            return True, 'OK', time.monotonic() - started, document_ids(response)
+        # Handle unsuccessful uploads
+        error_status = response.status_code if response is not None else 'No response'
+        error_text = response.text if response is not None else 'No detailed error message'
+        return False, f"Status code: {error_status}, Response: {error_text}", time.monotonic() - started, []
+    except requests.exceptions.RequestException as e:
+        # Handle requests-specific errors
+        return False, f"Network error: {e}", time.monotonic() - started, []
+    except Exception as e:
+        # Handle other unexpected errors, such as a file that cannot be opened
+        return False, f"Unexpected error: {e}", time.monotonic() - started, []
+
+
+def send_all_files(available_files, sent_books, api_url, max_workers=1, manifest=None, manifest_path=None):
+    """ Sends all available files to the server in parallel and updates the list of sent books. """
+    to_send = {name: path for name, path in available_files.items() if name not in sent_books}
+    report = {'succeeded': {}, 'failed': {}, 'skipped': []}
+
+    # Files whose content is already in the manifest were ingested by an earlier run
+    if manifest is not None:
+        for book_name, file_path in list(to_send.items()):
+            if is_already_ingested(file_path, manifest):
+                print(f"Skipping {book_name}, it is unchanged since it was last ingested.")
+                sent_books.add(book_name)
+                report['skipped'].append(book_name)
+                del to_send[book_name]
+
+    if not to_send:
+        return report
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for book_name, file_path in to_send.items():
             print(f"Sending {book_name}...")
-            try:
-                response = send_file_to_server(file_path, api_url)
-                if response and response.status_code == 200:
-                    print(f"File '{book_name}' uploaded successfully!")
-                    sent_books.add(book_name)
-                else:
-                    # Handle unsuccessful uploads
-                    error_status = response.status_code if response else 'No response'
-                    error_text = response.text if response else 'No detailed error message'
-                    print(f"Failed to upload file: {book_name}")
-                    print(f"Status code: {error_status}")
-                    print(f"Response: {error_text}")
-            except requests.exceptions.RequestException as e:
-                # Handle requests-specific errors
-                print(f"Network error occurred while sending {book_name}: {e}")
-            except Exception as e:
-                # Handle other unexpected errors
-                print(f"An unexpected error occurred while sending {book_name}: {e}")
+            futures[executor.submit(upload_book, book_name, file_path, api_url)] = book_name
+
+        # A failed upload is only reported, the remaining files keep going
+        for done, future in enumerate(as_completed(futures), start=1):
+            book_name = futures[future]
+            succeeded, detail, elapsed, doc_ids = future.result()
+            if succeeded:
+                print(f"File '{book_name}' uploaded successfully in {elapsed:.1f}s ({done}/{len(futures)})")
+                sent_books.add(book_name)
+                report['succeeded'][book_name] = elapsed
+                if manifest is not None:
+                    delete_documents(record_ingestion(to_send[book_name], doc_ids, manifest), api_url)
+                    # Saved after every upload, so a crash halfway through a bulk run does not cause re-embedding
+                    if manifest_path is not None:
+                        save_manifest(manifest, manifest_path)
+            else:
+                print(f"Failed to upload file: {book_name} after {elapsed:.1f}s ({done}/{len(futures)})")
+                print(detail)
+                report['failed'][book_name] = detail
+
+    print(f"Uploaded {len(report['succeeded'])} of {len(to_send)} files in {time.monotonic() - started:.1f}s.")
+    for book_name, detail in report['failed'].items():
+        print(f"- {book_name}: {detail}")
+    return report
+
+
+def is_book_ingested(file_path, manifest, chunks_dir=CHUNKS_PATH, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """ Check whether every chunk of the book's current content has already been ingested. """
+    index = load_manifest(chunk_index_path(file_path, chunks_dir))
+    try:
+        sha256 = cached_sha256(file_path, manifest.setdefault('stats', {}))
+    except OSError:
+        return False
+    if not index_is_current(index, sha256, max_tokens, overlap):
+        return False
+    return all(is_already_ingested(chunk['path'], manifest) for chunk in index['chunks'])
+
+
+def ingested_books(books, manifest, chunks_dir=CHUNKS_PATH, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """ Names of the books ingested by an earlier run, whole or in chunks; they are only re-sent if their content changed since. """
+    return {name for name, path in books.items()
+            if is_already_ingested(path, manifest) or is_book_ingested(path, manifest, chunks_dir, max_tokens, overlap)}
+
+
+def send_books_in_chunks(books, sent_books, api_url, max_workers=1, manifest=None, chunks_dir=CHUNKS_PATH,
+                         max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, dedup=False, lsh=None, manifest_path=None,
+                         known_books=None):
+    """ Split books into token-budgeted chunks and upload all chunks in parallel; a book is sent once all of its chunks are. """
+    chunk_files, book_chunks, chunk_books = {}, {}, {}
+    stats = manifest.setdefault('stats', {}) if manifest is not None else None
+    for book_name, file_path in books.items():
+        try:
+            index = chunk_book(file_path, chunks_dir, max_tokens, overlap, stats)
+        except OSError as e:
+            print(f"Could not chunk {book_name}: {e}")
+            continue
+        print(f"{book_name}: {len(index['chunks'])} chunks, about {index['total_tokens']} tokens to embed")
+        # A book that got shorter leaves chunks behind whose documents would keep answering questions
+        if manifest is not None and index.get('removed_chunks'):
+            delete_documents(forget_files(index['removed_chunks'], manifest), api_url)
+            if manifest_path is not None:
+                save_manifest(manifest, manifest_path)
+        book_chunks[book_name] = []
+        for number, chunk in enumerate(index['chunks'], start=1):
+            chunk_name = f"{book_name} [{number}/{len(index['chunks'])}]"
+            chunk_files[chunk_name] = chunk['path']
+            chunk_books[chunk_name] = book_name
+            book_chunks[book_name].append(chunk_name)
+
+    sent_chunks = set()
+    if dedup:
+        # Chunks are also compared with the books already on the server, such as the original of a new edition
+        if lsh is None:
+            lsh = add_books(MinHashLSH(), known_books or {})
+        chunk_paths = chunk_files
+        chunk_files, dropped = drop_duplicate_chunks(chunk_files, chunk_books, lsh=lsh)
+        if dropped:
+            print(f"Skipping {len(dropped)} chunks that duplicate text from another book.")
+        # Nothing is left to upload for a dropped chunk; the manifest remembers it, so runs without dedup skip it too
+        sent_chunks.update(dropped)
+        if manifest is not None and dropped:
+            for chunk_name, share in dropped.items():
+                delete_documents(record_ingestion(chunk_paths[chunk_name], [], manifest, duplicate_share=share), api_url)
+            if manifest_path is not None:
+                save_manifest(manifest, manifest_path)
+
+    report = send_all_files(chunk_files, sent_chunks, api_url, max_workers=max_workers, manifest=manifest,
+                            manifest_path=manifest_path)
+    for book_name, chunk_names in book_chunks.items():
+        if all(chunk_name in sent_chunks for chunk_name in chunk_names):
+            sent_books.add(book_name)
+    return report
 
 
 def main():
+    manifest = load_manifest(MANIFEST_PATH)
+    sent_books.update(ingested_books(available_files, manifest, CHUNKS_PATH))
+
     while True:
         # Display unsent books
         unsent_books = {name: path for name, path in available_files.items() if name not in sent_books}
@@ -74,6 +388,8 @@ def main():
                         if response and response.status_code == 200:
                             print(f"File '{book_name}' uploaded successfully!")
                             sent_books.add(book_name)
+                            delete_documents(record_ingestion(file_to_send, document_ids(response), manifest), api_url)
+                            save_manifest(manifest, MANIFEST_PATH)
                         else:
                             print("Failed to upload file.")
                             print("Status code:", response.status_code if response else 'No response')
@@ -87,12 +403,21 @@ def main():
 
         elif user_choice == '2':
             if unsent_books:
-                send_all_files(unsent_books, sent_books, 'http://private-gpt:8080/v1/ingest/file')
+                # Chunks rather than whole books are uploaded, so the load is even and predictable
+                # Enough workers for the adaptive limiter in http_client to open as many uploads as the server takes
+                send_books_in_chunks(unsent_books, sent_books, 'http://private-gpt:8080/v1/ingest/file',
+                                     max_workers=http_client.concurrency_ceiling('ingest', INGEST_WORKERS), manifest=manifest,
+                                     chunks_dir=CHUNKS_PATH,
+                                     dedup=DROP_DUPLICATES, manifest_path=MANIFEST_PATH,
+                                     known_books={name: path for name, path in available_files.items() if name in sent_books})
+                save_manifest(manifest, MANIFEST_PATH)
             else:
                 print("No unsent files to send.")
         else:
             print("Invalid option selected. Please try again.")
 
+    metrics.export()
+
 
 available_files = {
     'Madame Bovary': '../client/output/Madame Bovary.txt',
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    """ Hash a file in fixed-size chunks so large books never sit in memory at once. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_sha256(path, stats):
+    """ Return the content hash of path, only re-reading the file when its size or modification time changed. """
+    stat = os.stat(path)
+    key = os.path.normpath(path)
+    entry = stats.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    sha256 = file_sha256(path)
+    stats[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+    return sha256
+
+
+def load_manifest(path):
+    """ Load a JSON manifest, starting from an empty one if it is missing or unreadable. """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Ignoring unreadable manifest {path}: {e}")
+        return {}
+
+
+def save_manifest(manifest, path):
+    """ Write a manifest atomically so an interrupted run never leaves a half-written file behind. """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Failed to save manifest {path}: {e}")
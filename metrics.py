@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1 KB .. 1 GB
+# Written at the end of a run; the .prom file can be picked up by node_exporter's textfile collector
+METRICS_JSON_PATH = './results/metrics.json'
+METRICS_PROM_PATH = './results/metrics.prom'
+
+
+class Histogram:
+    """ Cumulative-bucket histogram in the Prometheus style. """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ Return [(upper bound, observations <= bound)] including +Inf. """
+        total, result = 0, []
+        for bound, count in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MetricsRegistry:
+    """ Thread-safe counters, gauges and histograms keyed by metric name and labels. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """ Observe how long the with-block took, in seconds. """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """ JSON-friendly copy of every metric. """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            gauges = [{'name': name, 'labels': dict(labels), 'value': value}
+                      for (name, labels), value in sorted(self._gauges.items())]
+            histograms = [{
+                'name': name,
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'mean': histogram.sum / histogram.count if histogram.count else None,
+                'buckets': [{'le': 'inf' if bound == float('inf') else bound, 'count': count}
+                            for bound, count in histogram.cumulative()],
+            } for (name, labels), histogram in sorted(self._histograms.items())]
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """ Render every metric in the Prometheus text exposition format. """
+        snapshot = self.snapshot()
+        lines, typed = [], set()
+        for kind, metric_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            for metric in snapshot[kind]:
+                if metric['name'] not in typed:
+                    typed.add(metric['name'])
+                    lines.append(f"# TYPE {metric['name']} {metric_type}")
+                lines.append(f"{metric['name']}{format_labels(metric['labels'])} {metric['value']}")
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bucket in histogram['buckets']:
+                le = '+Inf' if bucket['le'] == 'inf' else repr(float(bucket['le']))
+                lines.append(f"{name}_bucket{format_labels(dict(histogram['labels'], le=le))} {bucket['count']}")
+            lines.append(f"{name}_sum{format_labels(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{format_labels(histogram['labels'])} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+# Process-wide registry shared by the HTTP client and the scripts
+REGISTRY = MetricsRegistry()
+increment = REGISTRY.increment
+set_gauge = REGISTRY.set_gauge
+observe = REGISTRY.observe
+timer = REGISTRY.time
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    # Scrapers must never see a half-written file
+    os.replace(temp_path, path)
+
+
+def export(json_path=None, prom_path=None, registry=REGISTRY):
+    """ Write the collected metrics as JSON and as a Prometheus text file at the end of a run. """
+    json_path = METRICS_JSON_PATH if json_path is None else json_path
+    prom_path = METRICS_PROM_PATH if prom_path is None else prom_path
+    try:
+        _write_atomically(json_path, json.dumps(registry.snapshot(), indent=2))
+        _write_atomically(prom_path, registry.to_prometheus())
+        print(f"Metrics saved to {json_path} and {prom_path}")
+    except OSError as e:
+        print(f"Failed to save metrics: {e}")
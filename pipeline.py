@@ -0,0 +1,183 @@
+import glob
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from boilerplate import DEFAULT_BOILERPLATE
+from chunker import CHUNK_OVERLAP, CHUNK_TOKENS, CHUNKS_PATH
+from convert import DOCUMENTS_PATH, GUTENBERG_URL, OUTPUT_PATH, convert_downloaded, download_epub
+from dedup import MinHashLSH, add_books
+from extractors import DEFAULT_EXTRACTOR
+from ingest_file import INGEST_WORKERS, ingested_books, send_books_in_chunks
+
+# Books waiting between two stages; a full queue makes the stage before it wait instead of running ahead
+QUEUE_SIZE = 2
+DOWNLOAD_WORKERS = 4
+# Placed on a queue once its producers are done
+DONE = object()
+
+
+class StageStats:
+    """ Counts and timings of one pipeline stage, summed over its workers. """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.failed = 0
+        self.busy = 0.0     # Seconds spent working on books
+        self.idle = 0.0     # Seconds waiting for the previous stage
+        self.blocked = 0.0  # Seconds waiting for room in the next stage's queue (backpressure)
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, **seconds):
+        with self._lock:
+            for key, value in seconds.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def summary(self):
+        elapsed = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'failed': self.failed,
+            'busy_seconds': round(self.busy, 3),
+            'idle_seconds': round(self.idle, 3),
+            'blocked_seconds': round(self.blocked, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'items_per_second': round(self.items / elapsed, 3) if elapsed > 0 else None,
+        }
+
+
+def run_stage(stats, work, inbox, outbox, workers, failures):
+    """ Start worker threads that take books from inbox, run work on them and put the results on outbox. """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            waited = time.monotonic()
+            item = inbox.get()
+            stats.add(idle=time.monotonic() - waited)
+            if item is DONE:
+                # Leave the marker for the other workers; the last one to stop passes it on
+                inbox.put(DONE)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    stats.finished = time.monotonic()
+                    if outbox is not None:
+                        outbox.put(DONE)
+                return
+
+            book_name = item[0]
+            started = time.monotonic()
+            try:
+                result, error = work(*item)
+            except Exception as e:
+                result, error = None, str(e)
+            busy = time.monotonic() - started
+            metrics.observe('pipeline_stage_seconds', busy, stage=stats.name)
+            if error is not None:
+                print(f"{stats.name} failed for {book_name}: {error}")
+                failures[book_name] = f"{stats.name}: {error}"
+                stats.add(busy=busy, failed=1)
+                continue
+            stats.add(busy=busy, items=1)
+            if outbox is not None and result is not None:
+                waited = time.monotonic()
+                outbox.put(result)
+                stats.add(blocked=time.monotonic() - waited)
+
+    stats.started = time.monotonic()
+    threads = [threading.Thread(target=worker, name=f'{stats.name}-{number}', daemon=True) for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def run_pipeline(books, api_url, convert_manifest=None, ingest_manifest=None, documents_path=DOCUMENTS_PATH,
+                 base_url=GUTENBERG_URL, output_path=OUTPUT_PATH, extractor=DEFAULT_EXTRACTOR, boilerplate=DEFAULT_BOILERPLATE,
+                 download_workers=DOWNLOAD_WORKERS, convert_workers=None, ingest_workers=INGEST_WORKERS, chunks_dir=CHUNKS_PATH,
+                 max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP, dedup=False, queue_size=QUEUE_SIZE, ingest_manifest_path=None):
+    """ Download, convert and ingest {book name: Gutenberg ID} with the three stages overlapping; returns a report. """
+    report = {'ingested': {}, 'skipped': {}, 'failed': {}, 'stages': []}
+    recorded = convert_manifest.setdefault('books', {}) if convert_manifest is not None else {}
+    ingest_manifest = {} if ingest_manifest is None else ingest_manifest
+    os.makedirs(output_path, exist_ok=True)
+    convert_workers = convert_workers or os.cpu_count() or 1
+    # Books reach the ingest stage one at a time, so they are all checked against the signatures of the earlier ones,
+    # starting with every converted book an earlier run already ingested
+    lsh = None
+    if dedup:
+        converted = {os.path.splitext(os.path.basename(path))[0]: path for path in glob.glob(os.path.join(output_path, '*.txt'))}
+        lsh = add_books(MinHashLSH(), {name: converted[name] for name in ingested_books(converted, ingest_manifest, chunks_dir,
+                                                                                          max_tokens, overlap)})
+
+    def download(book_name, book_id):
+        return (book_name, book_id, download_epub(book_id, exit_on_error=False, documents_path=documents_path,
+                                                  base_url=base_url)), None
+
+    def convert(book_name, book_id, epub_path):
+        arguments = (book_name, book_id, epub_path, extractor, recorded.get(book_name), boilerplate, output_path)
+        # Parsing is CPU bound, so the stage's threads hand the work to a process pool unless there is only one
+        if converter is None:
+            name, output_txt_path, error, entry, _ = convert_downloaded(*arguments)
+        else:
+            name, output_txt_path, error, entry, _ = converter.submit(convert_downloaded, *arguments).result()
+        if error is not None:
+            return None, error
+        if convert_manifest is not None:
+            recorded[name] = entry
+        return (name, output_txt_path), None
+
+    def ingest(book_name, output_txt_path):
+        if ingested_books({book_name: output_txt_path}, ingest_manifest, chunks_dir, max_tokens, overlap):
+            print(f"{book_name} is already ingested, skipping.")
+            report['skipped'][book_name] = output_txt_path
+            return None, None
+        started = time.monotonic()
+        sent = set()
+        uploads = send_books_in_chunks({book_name: output_txt_path}, sent, api_url, max_workers=ingest_workers,
+                                       manifest=ingest_manifest, chunks_dir=chunks_dir, max_tokens=max_tokens,
+                                       overlap=overlap, dedup=dedup, lsh=lsh, manifest_path=ingest_manifest_path)
+        if book_name not in sent:
+            return None, f"{len(uploads['failed'])} chunks failed to upload" if uploads['failed'] else "Could not chunk the book"
+        report['ingested'][book_name] = time.monotonic() - started
+        return None, None
+
+    stages = [StageStats('download'), StageStats('convert'), StageStats('ingest')]
+    # Every book is queued for download up front; only the hand-offs between stages are bounded
+    queues = [queue.Queue(), queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)]
+    converter = ProcessPoolExecutor(max_workers=convert_workers) if convert_workers > 1 else None
+    try:
+        # Only one ingest worker touches the manifest; it uploads the chunks of a book in parallel itself
+        threads = (run_stage(stages[0], download, queues[0], queues[1], download_workers, report['failed'])
+                   + run_stage(stages[1], convert, queues[1], queues[2], convert_workers, report['failed'])
+                   + run_stage(stages[2], ingest, queues[2], None, 1, report['failed']))
+        for item in books.items():
+            queues[0].put(item)
+        queues[0].put(DONE)
+        for thread in threads:
+            thread.join()
+    finally:
+        if converter is not None:
+            converter.shutdown()
+
+    report['stages'] = [stage.summary() for stage in stages]
+    print_stage_report(report['stages'])
+    print(f"Ingested {len(report['ingested'])}, skipped {len(report['skipped'])} already ingested "
+          f"and failed {len(report['failed'])} of {len(books)} books.")
+    return report
+
+
+def print_stage_report(summaries):
+    print(f"{'stage':<10}{'books':>7}{'failed':>8}{'busy s':>9}{'idle s':>9}{'blocked s':>11}{'books/s':>9}")
+    for s in summaries:
+        rate = f"{s['items_per_second']:>9.2f}" if s['items_per_second'] is not None else f"{'-':>9}"
+        print(f"{s['stage']:<10}{s['items']:>7}{s['failed']:>8}{s['busy_seconds']:>9.1f}{s['idle_seconds']:>9.1f}"
+              f"{s['blocked_seconds']:>11.1f}{rate}")
@@ -0,0 +1,92 @@
+import sqlite3
+import hashlib
+import threading
+import json
+import time
+import os
+
+
+def corpus_fingerprint(directory='../client/output'):
+    """ Fingerprint the converted books from their names, sizes and modification times. """
+    digest = hashlib.sha256()
+    if not os.path.isdir(directory):
+        return digest.hexdigest()
+
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith('.txt') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """ On-disk cache of server replies keyed on the rendered prompt, request flags and corpus fingerprint. """
+
+    def __init__(self, path, fingerprint='', ttl=7 * 24 * 3600, max_entries=50000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Questions are answered from worker threads, so one connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, reply TEXT, reference TEXT, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        # Counting the table is a full scan, so it is done once here and the count is kept up to date afterwards
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def make_key(self, prompt, use_context=True, include_sources=True):
+        """ Hash everything that can change the server's answer into a cache key. """
+        material = json.dumps([prompt, use_context, include_sources, self.fingerprint])
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """ Return the cached (reply, reference) pair for key, or None if it is missing or expired. """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT reply, reference, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > self.ttl:
+                self._count -= self._conn.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return row[0], row[1]
+
+    def put(self, key, reply, reference):
+        """ Store a reply and evict the least recently used entries beyond max_entries. """
+        now = time.time()
+        with self._lock:
+            # Replacing an entry leaves the count unchanged, only a new key adds to it
+            updated = self._conn.execute(
+                "UPDATE responses SET reply = ?, reference = ?, created = ?, accessed = ? WHERE key = ?",
+                (reply, reference, now, now, key)
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO responses (key, reply, reference, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, reply, reference, now, now)
+                )
+                self._count += 1
+            if self._count > self.max_entries:
+                self._count -= self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                    (self._count - self.max_entries,)
+                ).rowcount
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
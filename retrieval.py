@@ -0,0 +1,192 @@
+import argparse
+import glob
+import math
+import os
+import re
+from collections import Counter
+import numpy as np
+from chunker import iter_paragraphs
+from manifest import cached_sha256, load_manifest, save_manifest
+
+BOOKS_PATH = '../client/output'
+RETRIEVAL_INDEX_PATH = '../client/output/bm25'
+# Bumped whenever the tokenizer or the on-disk layout changes, so old indexes are rebuilt
+INDEX_VERSION = 1
+# Usual Okapi BM25 parameters: term frequency saturation and document length normalisation
+K1 = 1.5
+B = 0.75
+# Passages looked at when ranking books, and books named in the prompt
+SEARCH_DEPTH = 50
+SHORTLIST_BOOKS = 3
+WORD = re.compile(r'\w+')
+# Words too common to tell books apart; a question made only of these has no lexical match
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves book books text texts novel novels story stories
+""".split())
+# Arrays saved as .npy files next to index.json and memory-mapped when the index is opened
+ARRAYS = ('offsets', 'postings', 'frequencies', 'lengths', 'doc_books', 'doc_lines')
+
+
+def tokenize(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS and len(word) > 1]
+
+
+class Bm25Index:
+    """ Inverted index over book paragraphs, stored as compressed-row arrays: the postings of term t are offsets[t]:offsets[t + 1]. """
+
+    def __init__(self, terms, books, arrays):
+        self.terms = {term: number for number, term in enumerate(terms)}
+        self.books = books
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.average_length = float(np.mean(self.lengths)) if len(self.lengths) else 0.0
+
+    def search(self, question, limit=SEARCH_DEPTH):
+        """ Return (book, first line, score) of the best matching paragraphs, best first; empty if no word of the question occurs. """
+        term_ids = sorted({self.terms[word] for word in tokenize(question) if word in self.terms})
+        if not term_ids:
+            return []
+        documents, contributions = [], []
+        total = len(self.lengths)
+        for term in term_ids:
+            start, end = int(self.offsets[term]), int(self.offsets[term + 1])
+            docs = np.asarray(self.postings[start:end])
+            frequencies = np.asarray(self.frequencies[start:end], dtype=np.float64)
+            idf = math.log(1 + (total - (end - start) + 0.5) / (end - start + 0.5))
+            norm = K1 * (1 - B + B * self.lengths[docs] / self.average_length)
+            documents.append(docs)
+            contributions.append(idf * frequencies * (K1 + 1) / (frequencies + norm))
+
+        # Only paragraphs containing at least one term are scored, never the whole corpus
+        docs, inverse = np.unique(np.concatenate(documents), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions))
+        best = np.argsort(-scores, kind='stable')[:limit]
+        return [(self.books[self.doc_books[docs[n]]], int(self.doc_lines[docs[n]]), float(scores[n])) for n in best]
+
+    def shortlist(self, question, limit=SHORTLIST_BOOKS):
+        """ Return the names of the books whose paragraphs match the question best, best first. """
+        books = []
+        for book, _, _ in self.search(question):
+            if book not in books:
+                books.append(book)
+        return books[:limit]
+
+
+def build_index(paths, index_dir=RETRIEVAL_INDEX_PATH, stats=None):
+    """ Index every paragraph of the given books and save the arrays and the vocabulary under index_dir. """
+    stats = {} if stats is None else stats
+    sources = {os.path.normpath(path): cached_sha256(path, stats) for path in paths}
+    terms, books = {}, []
+    term_ids, doc_ids, frequencies, lengths, doc_books, doc_lines = [], [], [], [], [], []
+    for book_number, path in enumerate(paths):
+        books.append(os.path.splitext(os.path.basename(path))[0])
+        for paragraph, first, _ in iter_paragraphs(path):
+            counts = Counter(tokenize(paragraph))
+            if not counts:
+                continue
+            for word, count in counts.items():
+                term_ids.append(terms.setdefault(word, len(terms)))
+                doc_ids.append(len(lengths))
+                frequencies.append(count)
+            lengths.append(sum(counts.values()))
+            doc_books.append(book_number)
+            doc_lines.append(first)
+
+    # Group the postings by term; the stable sort keeps each term's documents in ascending order
+    term_ids = np.array(term_ids, dtype=np.int64)
+    order = np.argsort(term_ids, kind='stable')
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+    arrays = {
+        'offsets': offsets,
+        'postings': np.array(doc_ids, dtype=np.int32)[order],
+        'frequencies': np.array(frequencies, dtype=np.int32)[order],
+        'lengths': np.array(lengths, dtype=np.int32),
+        'doc_books': np.array(doc_books, dtype=np.int32),
+        'doc_lines': np.array(doc_lines, dtype=np.int32),
+    }
+
+    os.makedirs(index_dir, exist_ok=True)
+    # index.json is written last and only then describes the new arrays
+    meta_path = os.path.join(index_dir, 'index.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(index_dir, f'{name}.npy'), array)
+    meta = {'version': INDEX_VERSION, 'sources': sources, 'stats': {key: stats[key] for key in sources}, 'books': books,
+            'terms': list(terms)}
+    save_manifest(meta, meta_path)
+    return Bm25Index(meta['terms'], books, arrays)
+
+
+def load_index(index_dir=RETRIEVAL_INDEX_PATH, sources=None, meta=None):
+    """ Open a saved index with its arrays memory-mapped, or return None if it is missing or was built from other books. """
+    meta = load_manifest(os.path.join(index_dir, 'index.json')) if meta is None else meta
+    if not meta or meta.get('version') != INDEX_VERSION or (sources is not None and meta.get('sources') != sources):
+        return None
+    try:
+        arrays = {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable index {index_dir}: {e}")
+        return None
+    return Bm25Index(meta['terms'], meta['books'], arrays)
+
+
+def book_paths(directory=BOOKS_PATH):
+    return sorted(glob.glob(os.path.join(directory, '*.txt')))
+
+
+def open_index(paths=None, index_dir=RETRIEVAL_INDEX_PATH):
+    """ Load the index of the given books (default: every converted book), building it first if any book changed; None when there are no books. """
+    paths = book_paths() if paths is None else paths
+    if not paths:
+        return None
+    meta_path = os.path.join(index_dir, 'index.json')
+    meta = load_manifest(meta_path)
+    # Startup is a stat per book: only books whose size or modification time changed since the last run are hashed
+    stats = dict(meta.get('stats', {}))
+    sources = {os.path.normpath(path): cached_sha256(path, stats) for path in paths}
+    index = load_index(index_dir, sources, meta)
+    if index is None:
+        print(f"Indexing {len(paths)} books for local retrieval...")
+        return build_index(paths, index_dir, stats)
+    stats = {key: stats[key] for key in sources}
+    if stats != meta.get('stats'):
+        # Books that were touched but not changed, or an index from before the stat cache existed
+        meta['stats'] = stats
+        save_manifest(meta, meta_path)
+    return index
+
+
+def main(argv=None):
+    """ python retrieval.py "Which novel is set in Rouen?" """
+    parser = argparse.ArgumentParser(description="Rank converted books and passages for a question with BM25.")
+    parser.add_argument('questions', nargs='*', help="Questions to look up (put them before --books)")
+    parser.add_argument('--books', nargs='+', default=None, help="Converted .txt files (default: all books in output/)")
+    parser.add_argument('--index-dir', default=RETRIEVAL_INDEX_PATH, help="Directory the index is stored in")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index even if the books did not change")
+    args = parser.parse_args(argv)
+
+    paths = args.books or book_paths()
+    index = build_index(paths, args.index_dir) if args.rebuild else open_index(paths, args.index_dir)
+    if index is None:
+        print("No converted books to index.")
+        return
+    print(f"{len(index.books)} books, {len(index.lengths)} paragraphs, {len(index.terms)} terms indexed.")
+    for question in args.questions:
+        results = index.search(question, limit=5)
+        if not results:
+            print(f"{question}: no lexical match")
+            continue
+        print(f"{question}:")
+        for book, line, score in results:
+            print(f"  {book}:{line} ({score:.2f})")
+
+
+if __name__ == "__main__":
+    main()
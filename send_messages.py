@@ -1,11 +1,63 @@
 import pandas as pd
 import requests
+import http_client
+import metrics
 import json
+import csv
 import sys
 import os
-
-
-def send_prompt_to_chat_api(url, message, use_context=True, include_sources=True, stream=False):
+import time
+import itertools
+import retrieval
+from response_cache import ResponseCache, corpus_fingerprint
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, it is only needed for Parquet questions and results
+    pa = pq = None
+
+# Upper bound on chat requests open against the server at the same time in CSV mode
+MAX_IN_FLIGHT = 4
+# Seconds a single question may take before it is reported as timed out
+REQUEST_DEADLINE = 600
+# Number of rows written to the results file between fsync'd checkpoints
+CHECKPOINT_EVERY = 25
+RESULT_COLUMNS = ['Reply', 'Reference', 'Question', 'Latency']
+# Results files written before the Latency column existed can still be resumed
+LEGACY_RESULT_COLUMNS = ['Reply', 'Reference', 'Question']
+RESULTS_FILENAME = 'responses_from_csv.csv'
+# Every results file is written to this folder
+RESULTS_PATH = './results'
+# Rows read from the questions file at a time, and rows per row group of Parquet results
+QUESTION_CHUNK_ROWS = 10_000
+PARQUET_BATCH_ROWS = 10_000
+# Every interactive turn is appended to the session log and the results file is rebuilt from it every few turns
+SESSION_COLUMNS = ['Reply', 'Reference', 'TTFT', 'Latency']
+SESSION_LOG_FILENAME = 'session_log.jsonl'
+SESSION_RESULTS_FILENAME = 'responses_from_user_input.csv'
+COMPACT_EVERY = 20
+# Returned without asking the server when no word of the question occurs in any converted book
+NO_MATCH_REPLY = "None of the ingested books contain the words of this question."
+# Rank the converted books locally and name the best ones in each prompt
+ROUTE_WITH_INDEX = True
+# Replies are reused across runs for 30 days unless the converted books change
+CACHE_PATH = './results/response_cache.sqlite'
+CACHE_TTL = 30 * 24 * 3600
+# Questions that only differ in case or spacing share one request; replies are remembered for this many distinct questions
+COALESCE_QUESTIONS = True
+COALESCE_MEMORY = 10_000
+# Outcomes of handle_question that are real answers; only those are handed to later copies of the question
+ANSWERED_OUTCOMES = ('ok', 'cached', 'no_match')
+# Rows with one of these references, or with the empty reply, were not answered and are asked again on resume
+FAILED_REFERENCES = ('No response from server', 'Network error occurred', 'No reference data found')
+EMPTY_REPLY = 'No response data found.'
+
+
+def send_prompt_to_chat_api(url, message, use_context=True, include_sources=True, stream=False, timeout=REQUEST_DEADLINE,
+                            deadline=None):
     """Send a chat message to the API and return the server's response."""
     headers = {'Content-Type': 'application/json'}
     body = {
@@ -16,7 +68,9 @@ def send_prompt_to_chat_api(url, message, use_context=True, include_sources=True
     }
 
     try:
-        response = requests.post(url, headers=headers, json=body, timeout=600)  # Set a timeout for the request
+        # With stream=True only the headers are read here and the body is consumed by read_streamed_reply
+        response = http_client.request('POST', url, endpoint='chat', headers=headers, json=body, timeout=timeout, stream=stream,
+                                     deadline=deadline)
         response.raise_for_status()  # Raise an exception for HTTP error responses
         return response
     except requests.exceptions.HTTPError as e:
@@ -39,10 +93,12 @@ def send_prompt_to_chat_api(url, message, use_context=True, include_sources=True
     return None
 
 
-def process_questions_from_csv(file_path, api_url):
-    # Try to read the CSV file and handle potential exceptions
+def process_questions_from_csv(file_path, api_url, max_in_flight=MAX_IN_FLIGHT, deadline=REQUEST_DEADLINE, resume=False, cache=None,
+                               output=RESULTS_FILENAME, index=None):
+    # Questions are read in chunks, so memory stays flat however many rows the CSV or Parquet file has
     try:
-        questions_df = pd.read_csv(file_path)
+        chunks = read_question_chunks(file_path)
+        first_chunk = next(chunks, None)
     except FileNotFoundError:
         print(f"Error: The file '{file_path}' does not exist.")
         return
@@ -52,31 +108,71 @@ def process_questions_from_csv(file_path, api_url):
     except pd.errors.ParserError:
         print("Error: The file could not be parsed.")
         return
+    except KeyError:
+        # The 'Question' column is missing
+        print("Error: No 'Question' column found in the CSV file.")
+        return
     except Exception as e:
         print(f"An unexpected error occurred while reading the file: {e}")
         return
-
-    # Check if 'Question' column exists in the DataFrame
-    if 'Question' not in questions_df.columns:
-        print("Error: No 'Question' column found in the CSV file.")
+    chunks = itertools.chain([first_chunk], chunks) if first_chunk is not None else iter(())
+
+    answered = 0
+    if resume and output.endswith('.parquet'):
+        print("Resuming is only supported for CSV results, starting over.")
+    elif resume:
+        answered = resume_responses(itertools.chain.from_iterable(read_question_chunks(file_path)), output)
+        if answered:
+            print(f"Resuming after {answered} already answered questions.")
+            chunks = skip_rows(chunks, answered)
+
+    # One copy of the chunks feeds the requests, one renders their prompts and one labels the result rows;
+    # tee only buffers the few chunks between the slowest and the fastest of them
+    # With an index every prompt carries its own shortlist and is rendered by handle_question instead
+    request_chunks, *prompt_chunks, row_chunks = itertools.tee(chunks, 3 if index is None else 2)
+    questions = itertools.chain.from_iterable(request_chunks)
+    prompts = itertools.chain.from_iterable(render_prompts(chunk) for chunk in prompt_chunks[0]) if prompt_chunks else None
+
+    # Answers come back in row order even though questions are sent in parallel,
+    # so each one can be appended to the results file as soon as its turn comes
+    replies = handle_questions_concurrently(api_url, questions, max_in_flight, deadline, cache, with_latency=True, prompts=prompts,
+                                            index=index)
+    rows = ({'Reply': response, 'Reference': reference, 'Question': question, 'Latency': round(latency, 3)}
+            for question, (response, reference, latency) in zip(itertools.chain.from_iterable(row_chunks), replies))
+    stream_responses(rows, output, append=answered > 0)
+
+
+def read_question_chunks(file_path, chunksize=QUESTION_CHUNK_ROWS):
+    """ Yield the Question column of a CSV or Parquet file as Series of at most chunksize rows. """
+    if file_path.endswith('.parquet'):
+        if pq is None:
+            raise ImportError("Reading Parquet files requires pyarrow")
+        parquet_file = pq.ParquetFile(file_path)
+        if 'Question' not in parquet_file.schema_arrow.names:
+            raise KeyError('Question')
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=['Question']):
+            yield batch.column(0).to_pandas()
         return
 
-    responses = []
-    # Process each question in the DataFrame
-    for _, row in questions_df.iterrows():
-        question = row['Question']
-        response, question = handle_question(api_url, question)
-        responses.append({'Reply': response, 'Reference': question})
+    # Only the Question column is parsed; a file without it yields chunks without columns
+    with pd.read_csv(file_path, chunksize=chunksize, usecols=lambda column: column == 'Question') as reader:
+        for chunk in reader:
+            if 'Question' not in chunk.columns:
+                raise KeyError('Question')
+            yield chunk['Question']
 
-    # Convert list of dictionaries to DataFrame
-    responses_df = pd.DataFrame(responses)
 
-    # Save responses to a CSV file
-    save_responses(responses_df, 'responses_from_csv.csv')
+def skip_rows(chunks, count):
+    """ Drop the first count rows from a stream of chunks. """
+    for chunk in chunks:
+        if count >= len(chunk):
+            count -= len(chunk)
+            continue
+        yield chunk.iloc[count:]
+        count = 0
 
 
-def generate_prompt(question):
-    prompt_template = f"""
+PROMPT_TEMPLATE = """
     The system has ingested and processed key texts from classic literature. These documents encompass a range of settings, themes, and narratives.
 
     Given this knowledge base, identify which texts align with the specified thematic inquiry and explain how they relate to the following question:
@@ -87,75 +183,386 @@ def generate_prompt(question):
     Instruction:
     Your response should clearly cite specific examples from the texts that directly address the question, highlighting relevant plot points, characters, or themes. If multiple texts provide answers, mention all that apply, detailing their contributions to the thematic inquiry posed. If not, state that given texts does not cover the wanted conditions.
     """
-    return prompt_template
+PROMPT_PREFIX, PROMPT_SUFFIX = PROMPT_TEMPLATE.split('{question}')
+SHORTLIST_NOTE = """
 
+    A keyword search of the texts ranks these as the most relevant, best first: {books}"""
 
-def handle_question(api_url, question):
-    print(f"Sending question to server: {question}")
-    prompt = generate_prompt(question)
-    response = send_prompt_to_chat_api(api_url, prompt)
-    
-    # Check if the response was successful before proceeding
-    if response is not None and response.status_code == 200:
-        try:
-            response_data = response.json()
-            
-            server_response = response_data['choices'][0]['message']['content'] if response_data.get('choices') else 'No response data found.'
-            try:
-                reference = (response_data['choices'][0]['sources'][0]['document']
-                            ['doc_metadata']['window'])
-            except (IndexError, KeyError, TypeError):
-                reference = 'No reference data found.'
-            print("Received response from server.")
-            return server_response, reference
-        except KeyError as e:
-            # Handle missing keys in JSON response
-            error_message = f"Missing data in response: {e}"
-            print(error_message)
-            return error_message, "No reference data found"
-        except json.JSONDecodeError as e:
-            # Handle JSON decode error if response is not in JSON format
-            error_message = f"JSON decoding failed: {e}"
-            print(error_message)
-            return error_message, "No reference data found"
-    elif response is not None:
-        # Handle HTTP errors that were not caught by send_prompt_to_chat_api
-        error_message = f"HTTP Error {response.status_code}: {response.text}"
-        print("Failed to get response from server.")
-        return error_message, "No response from server"
-    else:
-        # Handle cases where the response is None (network errors or timeouts handled in send_prompt_to_chat_api)
-        error_message = "Server did not respond or network error occurred."
-        print(error_message)
-        return error_message, "Network error occurred"
-
-
-def user_input_mode(api_url):
-    responses_df = pd.DataFrame(columns=['Reply', 'Reference'])
-
-    while True:
-        user_input = input("Enter your message (type 'exit' to quit): ").strip()
-
-        if user_input.lower() == 'exit':
-            print("Exiting chat session.")
-            if not responses_df.empty:
-                save_responses(responses_df, 'responses_from_user_input.csv')
+
+def generate_prompt(question, shortlist=None):
+    note = SHORTLIST_NOTE.format(books=', '.join(shortlist)) if shortlist else ''
+    return f"{PROMPT_PREFIX}{question}{note}{PROMPT_SUFFIX}"
+
+
+def render_prompts(questions):
+    """ Render the prompts of a whole chunk of questions with one vectorized string concatenation. """
+    return (PROMPT_PREFIX + questions.astype(str) + PROMPT_SUFFIX).tolist()
+
+
+def extract_reference(sources):
+    """ Return the text window of the first source document, or a placeholder if there is none. """
+    try:
+        return sources[0]['document']['doc_metadata']['window']
+    except (IndexError, KeyError, TypeError):
+        return 'No reference data found.'
+
+
+def read_streamed_reply(response, on_token=None, started=None):
+    """ Consume a server-sent events response and return the reply, its sources and the time to the first token. """
+    started = time.monotonic() if started is None else started
+    first_token_at = None
+    parts = []
+    sources = None
+
+    for line in response.iter_lines():
+        line = line.decode('utf-8') if isinstance(line, bytes) else line
+        if not line.startswith('data:'):
+            continue  # Blank event separators, comments and keep-alives carry no tokens
+        payload = line[len('data:'):].strip()
+        if payload == '[DONE]':
             break
 
-        response, question = handle_question(api_url, user_input)
+        choices = json.loads(payload).get('choices') or []
+        if not choices:
+            continue
+        token = (choices[0].get('delta') or {}).get('content')
+        if token:
+            if first_token_at is None:
+                first_token_at = time.monotonic() - started
+            parts.append(token)
+            if on_token is not None:
+                on_token(token)
+        # Every chunk repeats the sources found so far, so the last non-empty list is the complete one
+        if choices[0].get('sources'):
+            sources = choices[0]['sources']
 
-        if response:
-            # Note the use of the loc indexer to add a new row to the DataFrame
-            # This way, we're updating the DataFrame in place and avoiding the issue entirely.
-            responses_df.loc[len(responses_df)] = {'Reply': response, 'Reference': question}
+    return ''.join(parts), sources, first_token_at
+
+
+def print_token(token):
+    print(token, end='', flush=True)
+
+
+def handle_question(api_url, question, timeout=REQUEST_DEADLINE, cache=None, stream=False, stats=None, prompt=None, index=None):
+    started = time.monotonic()
+    outcome = 'error'
+    try:
+        if index is not None and prompt is None:
+            shortlist = index.shortlist(question)
+            if not shortlist:
+                # The server could only search the same books and come back empty-handed
+                print(f"No book matches question: {question}")
+                outcome = 'no_match'
+                return NO_MATCH_REPLY, "No reference data found."
+            prompt = generate_prompt(question, shortlist)
+        # Bulk callers pass the prompt they already rendered
+        prompt = generate_prompt(question) if prompt is None else prompt
+        cache_key = cache.make_key(prompt) if cache is not None else None
+        if cache_key is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print(f"Using cached response for question: {question}")
+                outcome = 'cached'
+                return cached
+
+        print(f"Sending question to server: {question}")
+        # The batch reports the question as timed out after timeout seconds, so it must not be sent any later
+        response = send_prompt_to_chat_api(api_url, prompt, stream=stream, timeout=timeout, deadline=started + timeout)
+
+        # Check if the response was successful before proceeding
+        if response is not None and response.status_code == 200:
+            try:
+                if stream:
+                    # Tokens are printed as they arrive and reassembled for the results file
+                    with metrics.timer('chat_stream_seconds'):
+                        server_response, sources, first_token_at = read_streamed_reply(response, print_token, started)
+                    print()
+                    if stats is not None and first_token_at is not None:
+                        stats['ttft'] = first_token_at
+                    has_choices = bool(server_response)
+                    if not has_choices:
+                        server_response = EMPTY_REPLY
+                    reference = extract_reference(sources)
+                else:
+                    with metrics.timer('chat_decode_seconds'):
+                        response_data = response.json()
+
+                    has_choices = bool(response_data.get('choices'))
+                    server_response = response_data['choices'][0]['message']['content'] if has_choices else EMPTY_REPLY
+                    reference = extract_reference(response_data['choices'][0].get('sources') if has_choices else None)
+                print("Received response from server.")
+                outcome = 'ok' if has_choices else 'empty'
+                # Only real answers are cached so failures are retried on the next run
+                if cache_key is not None and has_choices:
+                    cache.put(cache_key, server_response, reference)
+                return server_response, reference
+            except KeyError as e:
+                # Handle missing keys in JSON response
+                error_message = f"Missing data in response: {e}"
+                print(error_message)
+                return error_message, "No reference data found"
+            except json.JSONDecodeError as e:
+                # Handle JSON decode error if response is not in JSON format
+                error_message = f"JSON decoding failed: {e}"
+                print(error_message)
+                return error_message, "No reference data found"
+            except requests.exceptions.RequestException as e:
+                # Handle the connection dropping while a streamed reply is still being read
+                error_message = f"Stream interrupted: {e}"
+                print(error_message)
+                return error_message, "Network error occurred"
+        elif response is not None:
+            # Handle HTTP errors that were not caught by send_prompt_to_chat_api
+            error_message = f"HTTP Error {response.status_code}: {response.text}"
+            print("Failed to get response from server.")
+            return error_message, "No response from server"
         else:
-            print("Failed to get a valid response from the server, please try again.")
+            # Handle cases where the response is None (network errors or timeouts handled in send_prompt_to_chat_api)
+            error_message = "Server did not respond or network error occurred."
+            print(error_message)
+            return error_message, "Network error occurred"
+    finally:
+        latency = time.monotonic() - started
+        metrics.increment('chat_replies_total', outcome=outcome)
+        metrics.observe('chat_latency_seconds', latency, outcome=outcome)
+        # A buffered reply arrives all at once, so its first token comes with the full body
+        if stats is not None:
+            stats['ok'] = outcome in ANSWERED_OUTCOMES
+            stats['latency'] = latency
+            stats.setdefault('ttft', stats['latency'])
+            if stream:
+                metrics.observe('chat_ttft_seconds', stats['ttft'])
+
+
+def normalize_question(question):
+    """ Key under which questions that only differ in case or spacing share one request. """
+    return ' '.join(str(question).split()).casefold()
+
+
+def handle_questions_concurrently(api_url, questions, max_in_flight=MAX_IN_FLIGHT, deadline=REQUEST_DEADLINE, cache=None,
+                                  with_latency=False, prompts=None, index=None, coalesce=COALESCE_QUESTIONS):
+    """ Answer questions with at most max_in_flight requests open and yield (reply, reference[, seconds]) in input order. """
+    # Prompts rendered ahead of time travel alongside their questions
+    questions = zip(questions, prompts) if prompts is not None else ((question, None) for question in questions)
+    pending = {}   # future -> [[(row index, time joined)], start time, expired flag, question key, stats]
+    inflight = {}  # question key -> future of the live request answering it
+    answered = OrderedDict()  # question key -> (reply, reference) of the last COALESCE_MEMORY requests
+    finished = {}  # row index -> (reply, reference) waiting for earlier rows
+    submitted = 0
+    emitted = 0
+    coalesced = 0
+    exhausted = False
+    # The deadline runs from submission, so no more questions are submitted than the adaptive limiter lets through;
+    # otherwise the extra ones would spend their deadline waiting for a slot
+    limiter = http_client.get_limiter('chat')
+
+    def window():
+        return min(max_in_flight, limiter.limit) if limiter is not None else max_in_flight
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            # Keep the window full; a question only leaves it once its request has really ended
+            # Rows answered ahead of an unfinished one wait in finished, so reading ahead is capped as well
+            while not exhausted and len(pending) < window() and len(finished) < COALESCE_MEMORY:
+                try:
+                    question, prompt = next(questions)
+                except StopIteration:
+                    exhausted = True
+                    break
+                row = submitted
+                submitted += 1
+                key = normalize_question(question) if coalesce else None
+                # Repeated questions join the request already made for them instead of taking a slot
+                if key in answered:
+                    answered.move_to_end(key)
+                    finished[row] = (*answered[key], 0.0) if with_latency else answered[key]
+                    coalesced += 1
+                    if row == emitted:
+                        break  # Hand it out before reading further ahead
+                    continue
+                if key in inflight:
+                    pending[inflight[key]][0].append((row, time.monotonic()))
+                    coalesced += 1
+                    continue
+                options = {}
+                if prompt is not None:
+                    options['prompt'] = prompt
+                if index is not None:
+                    options['index'] = index
+                # Stamped before the thread starts, so the question is reported as timed out before handle_question gives up
+                started = time.monotonic()
+                stats = {}
+                future = executor.submit(handle_question, api_url, question, deadline, cache, stats=stats, **options)
+                pending[future] = [[(row, started)], started, False, key, stats]
+                if key is not None:
+                    inflight[key] = future
+
+            if not pending and emitted not in finished:
+                break
+
+            # Wake up either when a request finishes or when the oldest live request hits its deadline
+            live = [started for _, started, expired, _, _ in pending.values() if not expired]
+            wait_for = max(min(live) + deadline - time.monotonic(), 0) if live else None
+            if emitted in finished:
+                wait_for = 0
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED) if pending else (set(), set())
+
+            for future in done:
+                rows, started, expired, key, stats = pending.pop(future)
+                if expired:
+                    continue  # Already reported as timed out, drop the late answer
+                inflight.pop(key, None)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"An error occurred while handling question {rows[0][0] + 1}: {e}")
+                    result = (f"Unexpected error: {e}", "No response from server")
+                else:
+                    # Only real answers are shared, failures and empty replies are asked again by later copies
+                    if key is not None and stats.get('ok'):
+                        answered[key] = result
+                        if len(answered) > COALESCE_MEMORY:
+                            answered.popitem(last=False)
+                for row, joined in rows:
+                    # Timed from submission, or from joining for a repeated question, so it also includes any wait for a
+                    # limiter slot; the window keeps that short, but a lowered limit or another caller can still hold the slot
+                    finished[row] = (*result, time.monotonic() - joined) if with_latency else result
+
+            now = time.monotonic()
+            for future, entry in pending.items():
+                rows, started, expired, key, _ = entry
+                if not expired and now - started >= deadline:
+                    for row, joined in rows:
+                        print(f"Question {row + 1} exceeded the {deadline} second deadline.")
+                        finished[row] = (f"Request exceeded the {deadline} second deadline.", "Network error occurred")
+                        if with_latency:
+                            finished[row] = (*finished[row], now - joined)
+                    entry[2] = True
+                    # Later copies of the question get a fresh request
+                    if inflight.get(key) is future:
+                        del inflight[key]
+
+            while emitted in finished:
+                yield finished.pop(emitted)
+                emitted += 1
+
+    if coalesced:
+        metrics.increment('chat_coalesced_total', coalesced)
+        print(f"Answered {coalesced} repeated questions without asking the server again.")
+
+
+def user_input_mode(api_url, log_filename=SESSION_LOG_FILENAME, output=SESSION_RESULTS_FILENAME, compact_every=COMPACT_EVERY,
+                    index=None):
+    log_path = get_results_path(log_filename)
+    if log_path is None:
+        return
+    # Turns left behind by a session that crashed are carried over into this one
+    turns = recover_session_log(log_path)
+    if turns:
+        print(f"Recovered {turns} turns from an interrupted session.")
+    # Bytes of the log already copied to the results file; each compaction only adds the turns after it
+    compacted = 0
+
+    with open(log_path, 'a', encoding='utf-8') as log:
+        while True:
+            user_input = input("Enter your message (type 'exit' to quit): ").strip()
+
+            if user_input.lower() == 'exit':
+                print("Exiting chat session.")
+                break
+
+            # Stream the reply so the answer shows up token by token instead of after the full generation
+            stats = {}
+            response, question = handle_question(api_url, user_input, stream=True, stats=stats, index=index)
+
+            if response:
+                print(f"Time to first token: {stats['ttft']:.2f}s, total latency: {stats['latency']:.2f}s")
+                append_session_log(log, {'Reply': response, 'Reference': question,
+                                         'TTFT': round(stats['ttft'], 3), 'Latency': round(stats['latency'], 3)})
+                turns += 1
+                # Parquet files cannot be appended to, so they are only written when the session ends
+                if turns % compact_every == 0 and not output.endswith('.parquet'):
+                    compacted = compact_session_log(log_path, output, compacted) or compacted
+            else:
+                print("Failed to get a valid response from the server, please try again.")
 
+    # The log is only removed once its turns are safely in the results file
+    if not turns or compact_session_log(log_path, output, compacted) is not None:
+        os.remove(log_path)
+
+
+def append_session_log(log, record):
+    """ Append one turn to the session log and make sure it reaches the disk before the next question. """
+    log.write(json.dumps(record, ensure_ascii=False) + '\n')
+    log.flush()
+    os.fsync(log.fileno())
+
+
+def read_session_log(path):
+    """ Return the turns recorded in a session log, ignoring a last line cut short by a crash. """
+    return [record for record, _ in iter_session_log(path)]
+
+
+def iter_session_log(path, offset=0):
+    """ Yield (turn, byte offset just past it) for every complete line of a session log, starting at byte offset. """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                return
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return
+            offset += len(line)
+            yield record, offset
+
+
+def recover_session_log(path):
+    """ Cut a torn last line off the session log so new turns are appended after the last complete one; returns the turn count. """
+    turns, end = 0, 0
+    for turns, (_, end) in enumerate(iter_session_log(path), start=1):
+        pass
+    if os.path.exists(path) and os.path.getsize(path) != end:
+        os.truncate(path, end)
+    return turns
+
+
+def compact_session_log(log_path, filename, offset=0):
+    """ Copy the turns logged after byte offset to the session results file; returns the new offset, or None if it was not saved. """
+    if filename.endswith('.parquet'):
+        records = list(iter_session_log(log_path))
+        responses_df = pd.DataFrame.from_records([record for record, _ in records], columns=SESSION_COLUMNS)
+        return (records[-1][1] if records else 0) if save_responses(responses_df, filename) else None
+
+    path = get_results_path(filename)
+    if path is None:
+        return None
+    # Only the new turns are written, so a long session costs linear rather than quadratic time. Starting from
+    # offset 0 the file is rebuilt, which also repairs a row torn by a crash; the log stays the source of truth
+    end = offset
+    try:
+        with open(path, 'a' if offset else 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=SESSION_COLUMNS, extrasaction='ignore')
+            if not offset:
+                writer.writeheader()
+            for record, end in iter_session_log(log_path, offset):
+                writer.writerow(record)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        print(f"Failed to save responses to {path}: {e}")
+        return None
+    print(f"Responses saved as '{filename}' in the results folder.")
+    return end
+
+
+def get_results_path(filename):
+    """ Return the path of a file in the results folder, creating the folder if needed. """
+    results_dir = RESULTS_PATH
 
-def save_responses(responses_df, filename):
-    # Define the full path for the results directory
-    results_dir = './results'
-    
     # Ensure the results directory exists
     if not os.path.exists(results_dir):
         try:
@@ -163,25 +570,147 @@ def save_responses(responses_df, filename):
             print(f"Created directory: {results_dir}")
         except OSError as e:
             print(f"Failed to create directory {results_dir}: {e}")
-            return
+            return None
 
     # Full path to save the file
-    path = os.path.join(results_dir, filename)
+    return os.path.join(results_dir, filename)
 
+
+def save_responses(responses_df, filename):
+    """ Save a DataFrame in the results folder as CSV, or as Parquet if the filename ends in .parquet. """
+    path = get_results_path(filename)
+    if path is None:
+        return False
+    if filename.endswith('.parquet') and pa is None:
+        print("Writing Parquet results requires pyarrow.")
+        return False
+
+    # Written next to the old file and swapped in, so a crash never leaves a half-written results file
+    temp_path = path + '.tmp'
     try:
-        # Attempt to save the DataFrame to a CSV file
-        responses_df.to_csv(path, index=False)
+        if filename.endswith('.parquet'):
+            responses_df.to_parquet(temp_path, index=False)
+        else:
+            responses_df.to_csv(temp_path, index=False)
+        os.replace(temp_path, path)
         print(f"Responses saved as '{filename}' in the results folder.")
+        return True
     except Exception as e:
         # Handle general exceptions that could occur during file writing
         print(f"Failed to save responses to {path}: {e}")
+        return False
+
+
+def stream_responses(rows, filename, append=False, checkpoint_every=CHECKPOINT_EVERY):
+    """ Write response rows to a CSV file in the results folder as they arrive, fsyncing every few rows. """
+    path = get_results_path(filename)
+    if path is None:
+        return 0
+    if filename.endswith('.parquet'):
+        return write_parquet_responses(rows, path)
+
+    written = 0
+    try:
+        with open(path, 'a' if append else 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+            if not append:
+                writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                written += 1
+                f.flush()
+                # A checkpoint guarantees the rows so far survive a crash of the whole machine
+                if written % checkpoint_every == 0:
+                    os.fsync(f.fileno())
+            f.flush()
+            os.fsync(f.fileno())
+        print(f"Responses saved as '{filename}' in the results folder.")
+    except OSError as e:
+        print(f"Failed to save responses to {path}: {e}")
+    return written
+
+
+def write_parquet_responses(rows, path, batch_rows=PARQUET_BATCH_ROWS):
+    """ Write response rows to a Parquet file one row group at a time, so memory is bounded by a single row group. """
+    if pa is None:
+        print("Writing Parquet results requires pyarrow.")
+        return 0
+    schema = pa.schema([(column, pa.float64() if column == 'Latency' else pa.string()) for column in RESULT_COLUMNS])
+
+    def convert(row):
+        return {column: None if pd.isna(row.get(column)) else row[column] if column == 'Latency' else str(row[column])
+                for column in RESULT_COLUMNS}
+
+    # A Parquet file is unreadable until its footer is written, so it only replaces the results once complete
+    temp_path = path + '.part'
+    rows = iter(rows)
+    written = 0
+    try:
+        with pq.ParquetWriter(temp_path, schema) as writer:
+            for batch in iter(lambda: list(itertools.islice(rows, batch_rows)), []):
+                writer.write_table(pa.Table.from_pylist([convert(row) for row in batch], schema=schema))
+                written += len(batch)
+        os.replace(temp_path, path)
+        print(f"Responses saved as '{os.path.basename(path)}' in the results folder.")
+    except OSError as e:
+        print(f"Failed to save responses to {path}: {e}")
+    return written
+
+
+def resume_responses(questions, filename):
+    """ Return how many leading questions are already answered in the results file, dropping any unmatched or failed tail. """
+    path = get_results_path(filename)
+    if path is None or not os.path.exists(path):
+        return 0
+
+    # The file is streamed twice at most, so resuming a run of millions of rows keeps memory flat
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames not in (RESULT_COLUMNS, LEGACY_RESULT_COLUMNS):
+                print(f"Cannot resume from {path}: unexpected columns {reader.fieldnames}.")
+                return 0
+            columns = reader.fieldnames
+
+            # Results are written in question order, so the answered rows must be a prefix of the questions.
+            # A row cut short by a crash will not match and is dropped along with anything after it.
+            # So is a row that reports a failure, so the question is asked again; with a cache the answered rows after it are cheap.
+            answered = total = 0
+            questions = iter(questions)
+            for row in reader:
+                total += 1
+                if answered < total - 1:
+                    continue  # Past the prefix, only counting the rows to drop
+                question = next(questions, None)
+                if question is None or row['Question'] != str(question) or row['Reply'] is None or row['Reference'] is None:
+                    continue
+                if row['Reference'] in FAILED_REFERENCES or row['Reply'] == EMPTY_REPLY:
+                    continue
+                answered += 1
+    except (OSError, csv.Error) as e:
+        print(f"Cannot resume from {path}: {e}")
+        return 0
+
+    # Older files are rewritten with the current columns so appended rows line up
+    if answered < total or columns != RESULT_COLUMNS:
+        if answered < total:
+            print(f"Discarding {total - answered} unmatched or failed rows from {path}.")
+        temp_path = path + '.tmp'
+        with open(path, newline='', encoding='utf-8') as source, open(temp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(itertools.islice(csv.DictReader(source), answered))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    return answered
 
 
 def list_csv_files(directory='./source'):  # Ensure the path is set to your source directory
     """ List CSV files in a specified directory. """
     try:
         # Fetch all files in the directory
-        files = [file for file in os.listdir(directory) if file.endswith('.csv')]
+        files = [file for file in os.listdir(directory) if file.endswith(('.csv', '.parquet'))]
         if not files:
             print("No CSV files found.")
             return []
@@ -218,11 +747,21 @@ def main():
                 questions_file_path = input("Enter the name of the CSV file from the list above: ").strip()
                 if questions_file_path in csv_files:
                     full_path = os.path.join('./source', questions_file_path)  # Construct full path to the file
+                    resume = False
+                    if os.path.exists(os.path.join('./results', RESULTS_FILENAME)):
+                        answer = input("Resume from the existing results file? (yes/no): ").strip().lower()
+                        resume = answer == 'yes'
+                    cache = ResponseCache(CACHE_PATH, corpus_fingerprint(), ttl=CACHE_TTL)
+                    index = retrieval.open_index() if ROUTE_WITH_INDEX else None
                     try:
-                        process_questions_from_csv(full_path, api_url)
+                        # The adaptive limiter in http_client decides how many of these requests are really open
+                        process_questions_from_csv(full_path, api_url, http_client.concurrency_ceiling('chat', MAX_IN_FLIGHT),
+                                                   resume=resume, cache=cache, index=index)
                         print("Questions processed successfully.")
                     except Exception as e:
                         print(f"An error occurred while processing the CSV file: {e}")
+                    finally:
+                        cache.close()
                 else:
                     print("File not listed. Please enter a valid file name from the list.")
             else:
@@ -231,7 +770,7 @@ def main():
             break   # Exit the loop after processing the CSV or handling errors
 
         elif mode == '2':
-            user_input_mode(api_url)
+            user_input_mode(api_url, index=retrieval.open_index() if ROUTE_WITH_INDEX else None)
             break  # Exit the loop after interactive mode
 
         else:
@@ -241,6 +780,9 @@ def main():
                 print("Too many incorrect attempts. Exiting.")
                 break
 
+    # Timings of every request in this run, for dashboards or later comparison
+    metrics.export()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,37 @@
+import os
+import tempfile
+import unittest
+
+import benchmark
+
+FAST = {endpoint: {'latency': 0.0, 'jitter': 0.0} for endpoint in benchmark.DEFAULT_PROFILE}
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.work_dir = temp_dir.name
+
+    def test_ingest_and_chat_scenarios_against_mock_server(self):
+        with benchmark.mock_server(FAST) as base_url:
+            ingest = benchmark.bench_ingest(base_url, self.work_dir, files=3, file_size=4096, workers=2)
+            chat = benchmark.bench_chat(base_url, self.work_dir, questions=5, workers=2)
+        self.assertEqual((ingest['requests'], ingest['errors']), (3, 0))
+        self.assertEqual((chat['requests'], chat['errors']), (5, 0))
+        self.assertLessEqual(chat['p50_ms'], chat['p99_ms'])
+        # Every question was answered with the mocked reply and written to the scratch results folder
+        with open(os.path.join(self.work_dir, 'results', 'responses_from_csv.csv')) as f:
+            self.assertEqual(f.read().count('token0'), 5)
+
+    def test_summary_percentiles_and_errors(self):
+        samples = [(n / 1000, 200) for n in range(1, 100)] + [(1.0, 503)]
+        summary = benchmark.summarize('chat', samples, elapsed=2.0, units=100, peak_memory=1024 * 1024)
+        self.assertEqual(summary['errors'], 1)
+        self.assertAlmostEqual(summary['p50_ms'], 50.5)
+        self.assertEqual(summary['throughput_per_s'], 50)
+        self.assertEqual(summary['peak_memory_mb'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
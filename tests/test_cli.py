@@ -0,0 +1,107 @@
+import copy
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import call, patch
+
+import cli
+import chunker
+import extractors
+from boilerplate import BOILERPLATE_PATTERNS
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    @unittest.skipIf(cli.tomllib is None, "TOML needs Python 3.11 or tomli")
+    def test_config_file_overrides_defaults(self):
+        path = self.write('client.toml', '[endpoints]\nchat = "http://localhost:8001/v1/chat/completions"\n\n'
+                                         '[concurrency]\nchat_in_flight = 8\n')
+        config = cli.load_config(path)
+        self.assertEqual(config['endpoints']['chat'], 'http://localhost:8001/v1/chat/completions')
+        self.assertEqual(config['concurrency']['chat_in_flight'], 8)
+        self.assertEqual(config['endpoints']['ingest'], cli.DEFAULT_CONFIG['endpoints']['ingest'])
+
+    @unittest.skipIf(cli.yaml is None, "PyYAML is not installed")
+    def test_yaml_config_and_unknown_settings(self):
+        self.assertEqual(cli.load_config(self.write('client.yaml', 'timeouts:\n  chat: 30\n'))['timeouts']['chat'], 30)
+        with self.assertRaises(ValueError):
+            cli.load_config(self.write('typo.yaml', 'timeouts:\n  chta: 30\n'))
+
+    def test_without_config_file_the_defaults_apply(self):
+        with patch('cli.CONFIG_PATH', os.path.join(self.dir, 'missing.toml')):
+            self.assertEqual(cli.load_config(), cli.DEFAULT_CONFIG)
+
+
+class TestCommands(unittest.TestCase):
+    def test_help_choices_match_the_modules(self):
+        # The parser repeats them so that --help does not import the modules
+        args = cli.build_parser().parse_args(['pipeline', '--ids', '2413'])
+        self.assertEqual((args.max_tokens, args.overlap), (chunker.CHUNK_TOKENS, chunker.CHUNK_OVERLAP))
+        actions = {action.dest: action for action in cli.build_parser()._subparsers._group_actions[0].choices['convert']._actions}
+        self.assertEqual(sorted(actions['extractor'].choices), sorted(extractors.EXTRACTORS))
+        self.assertEqual(actions['keep_boilerplate'].choices, list(BOILERPLATE_PATTERNS))
+
+    def test_startup_does_not_import_pandas_or_ebooklib(self):
+        code = "import sys, cli; cli.build_parser().parse_args(['ask', 'q.csv']); print('pandas' in sys.modules or 'ebooklib' in sys.modules)"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.strip(), 'False')
+
+    @patch('metrics.export')
+    @patch('retrieval.open_index', return_value=None)
+    @patch('send_messages.process_questions_from_csv')
+    def test_ask_uses_the_configured_endpoint_and_limits(self, mock_process, mock_index, mock_export):
+        config = copy.deepcopy(cli.DEFAULT_CONFIG)
+        config['endpoints']['chat'] = 'http://localhost:9/v1/chat/completions'
+        config['concurrency'].update(chat_in_flight=2, adaptive=False)
+        config['timeouts']['chat'] = 30
+        args = cli.build_parser().parse_args(['ask', 'q.parquet', '--no-cache', '--output', 'out.parquet'])
+        with patch.dict('http_client.TIMEOUTS'), patch('http_client.ADAPTIVE_CONCURRENCY'), patch('send_messages.RESULTS_PATH'):
+            cli.run_ask(args, config)
+        mock_process.assert_called_once_with('q.parquet', 'http://localhost:9/v1/chat/completions', 2, deadline=30,
+                                             resume=False, cache=None, output='out.parquet', index=None)
+        mock_export.assert_called_once()
+
+    @patch('builtins.print')
+    def test_configured_concurrency_caps_the_adaptive_limiter(self, mock_print):
+        import http_client
+        self.addCleanup(http_client.configure_limiters)
+        config = copy.deepcopy(cli.DEFAULT_CONFIG)
+        config['concurrency'].update(chat_in_flight=2, ingest_workers=6)
+        with patch.dict('http_client.TIMEOUTS'), patch('http_client.ADAPTIVE_CONCURRENCY'):
+            cli.configure_http(config)
+            chat, ingest = http_client.get_limiter('chat'), http_client.get_limiter('ingest')
+            self.assertEqual((chat.limit, chat.maximum), (2, 2))
+            self.assertEqual((ingest.limit, ingest.maximum), (http_client.ADAPTIVE_LIMITS['ingest']['initial'], 6))
+            self.assertEqual(http_client.concurrency_ceiling('chat', 2), 2)
+            for _ in range(20):
+                chat.release(chat.acquire(), 0.1, ok=True)
+            self.assertEqual(chat.limit, 2)
+
+    def test_connection_pool_fits_the_configured_concurrency(self):
+        import http_client
+        self.addCleanup(http_client.configure_limiters)
+        config = copy.deepcopy(cli.DEFAULT_CONFIG)
+        config['concurrency'].update(chat_in_flight=40, ingest_workers=6)
+        with patch.dict('http_client.TIMEOUTS'), patch('http_client.ADAPTIVE_CONCURRENCY'), \
+                patch('http_client.configure') as mock_configure:
+            cli.configure_http(config)
+            config['concurrency'].update(chat_in_flight=2)
+            cli.configure_http(config)
+        self.assertEqual(mock_configure.call_args_list, [call(40), call(http_client.POOL_SIZE)])
+
+
+if __name__ == '__main__':
+    unittest.main()
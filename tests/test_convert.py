@@ -1,25 +1,106 @@
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, MagicMock
 from requests.exceptions import HTTPError, ConnectionError, Timeout
 import sys
+import os
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Importing directly from convert as it's in the same directory level as the project root
-from convert import download_epub, epub_to_text, check_available_texts
+import ebooklib
+from ebooklib import epub
+from convert import download_epub, epub_to_text, check_available_texts, load_book_ids, convert_books
+from extractors import EXTRACTORS, extract_with_html_parser
+from boilerplate import strip_boilerplate
+from manifest import file_sha256, load_manifest, save_manifest
+import convert
 
 class TestDownloadEpub(unittest.TestCase):
-    @patch('convert.requests.get')
+    @patch('convert.http_client.request')
     def test_download_nonexistent_book(self, mock_get):
         mock_get.side_effect = HTTPError("404 Client Error: Not Found for url")
         with self.assertRaises(SystemExit):
             download_epub('9999999')  # Assuming 9999999 is a non-existent book ID
 
-    @patch('builtins.open', new_callable=mock_open())
-    @patch('convert.requests.get')
-    def test_successful_download(self, mock_get, mock_file):
+    @patch('builtins.print')
+    @patch('convert.http_client.request')
+    def test_successful_download(self, mock_get, mock_print):
         mock_get.return_value.status_code = 200
-        mock_get.return_value.content = b'Some content'
-        response = download_epub('2413')  # Valid ID
-        self.assertIn('2413.epub', response)
+        mock_get.return_value.headers = {'ETag': '"v1"'}
+        mock_get.return_value.iter_content.return_value = iter([b'Some ', b'content'])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            response = download_epub('2413', documents_path=temp_dir)  # Valid ID
+            self.assertIn('2413.epub', response)
+            with open(response, 'rb') as f:
+                self.assertEqual(f.read(), b'Some content')
+
+
+class EpubMirrorHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for gutenberg.org that supports ETag revalidation and byte ranges. """
+    body = b'PK' + bytes(range(256)) * 400
+    etag = '"v1"'
+    requests_seen = []
+
+    def do_GET(self):
+        type(self).requests_seen.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body, status = self.body, 200
+        requested = self.headers.get('Range')
+        if requested and self.headers.get('If-Range') == self.etag:
+            start = int(requested.split('=')[1].rstrip('-'))
+            body, status = self.body[start:], 206
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{len(self.body) - 1}/{len(self.body)}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConditionalDownload(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), EpubMirrorHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/ebooks'
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.documents_path = temp_dir.name
+        EpubMirrorHandler.requests_seen = []
+
+    @patch('builtins.print')
+    def test_unchanged_book_is_revalidated_not_downloaded(self, mock_print):
+        path = download_epub('2413', documents_path=self.documents_path, base_url=self.base_url)
+        download_epub('2413', documents_path=self.documents_path, base_url=self.base_url)
+        self.assertEqual(EpubMirrorHandler.requests_seen[1].get('If-None-Match'), '"v1"')
+        mock_print.assert_any_call(f"Book is unchanged on the server, keeping {path}")
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), EpubMirrorHandler.body)
+
+    @patch('builtins.print')
+    def test_interrupted_download_is_resumed(self, mock_print):
+        # Leave behind what an interrupted first attempt would have written
+        local_path = os.path.join(self.documents_path, '2413.epub')
+        with open(local_path + '.part', 'wb') as f:
+            f.write(EpubMirrorHandler.body[:1000])
+        with open(local_path + '.meta.json', 'w') as f:
+            json.dump({'partial': {'etag': '"v1"', 'last_modified': None}}, f)
+
+        path = download_epub('2413', documents_path=self.documents_path, base_url=self.base_url)
+        self.assertEqual(EpubMirrorHandler.requests_seen[0].get('Range'), 'bytes=1000-')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), EpubMirrorHandler.body)
+        self.assertFalse(os.path.exists(local_path + '.part'))
 
 class TestEpubToText(unittest.TestCase):
     @patch('convert.os.path.exists', return_value=False)
@@ -35,6 +116,28 @@ class TestEpubToText(unittest.TestCase):
         # Check that the appropriate error message was printed
         mock_print.assert_called_with(f"Error: EPUB file does not exist at {epub_path}")
 
+    @patch('builtins.print')
+    def test_streamed_output_matches_converted_text(self, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_txt_path = os.path.join(temp_dir, "L'assomoir.txt")
+            self.assertEqual(epub_to_text('../client/documents/8600.epub', output_txt_path), output_txt_path)
+            with open(output_txt_path, encoding='utf-8') as f, open("../client/output/L'assomoir.txt", encoding='utf-8') as expected:
+                self.assertEqual(f.read(), expected.read())
+            # The temporary file is renamed into place, nothing is left behind
+            self.assertEqual(os.listdir(temp_dir), ["L'assomoir.txt"])
+
+    @patch('builtins.print')
+    @patch('convert.iter_chapters', return_value=iter([]))
+    def test_empty_book_keeps_previous_output(self, mock_chapters, mock_print):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_txt_path = os.path.join(temp_dir, 'book.txt')
+            with open(output_txt_path, 'w') as f:
+                f.write('previous text')
+            self.assertIsNone(epub_to_text('../client/documents/8600.epub', output_txt_path))
+            with open(output_txt_path) as f:
+                self.assertEqual(f.read(), 'previous text')
+            self.assertEqual(os.listdir(temp_dir), ['book.txt'])
+
 
 class TestCheckAvailableTexts(unittest.TestCase):
     @patch('convert.os.path.exists', return_value=True)
@@ -50,5 +153,129 @@ class TestCheckAvailableTexts(unittest.TestCase):
         result = check_available_texts()
         self.assertEqual(result, {})
 
+    @patch('builtins.print')
+    def test_output_checksums_are_not_recomputed_by_the_next_check(self, mock_print):
+        output_txt_path = "../client/output/L'assomoir.txt"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_path = os.path.join(temp_dir, 'manifest.json')
+            save_manifest({'books': {"L'assomoir": {'output_sha256': file_sha256(output_txt_path)}}}, manifest_path)
+            with patch('convert.CONVERT_MANIFEST_PATH', manifest_path):
+                self.assertIn("L'assomoir", check_available_texts())
+                self.assertIn(os.path.normpath(output_txt_path), load_manifest(manifest_path)['stats'])
+                with patch('manifest.file_sha256') as mock_hash:
+                    self.assertIn("L'assomoir", check_available_texts())
+                mock_hash.assert_not_called()
+
+class TestBulkConversion(unittest.TestCase):
+    def test_load_book_ids(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'catalog.txt')
+            with open(path, 'w') as f:
+                f.write("# my catalog\n2413, Madame Bovary\n\n2600  # War and Peace\n")
+            self.assertEqual(load_book_ids(path), {'Madame Bovary': '2413', '2600': '2600'})
+
+    @patch('builtins.print')
+    @patch('convert.file_sha256', return_value='0' * 64)
+    @patch('convert.epub_to_text', side_effect=lambda epub_path, output_txt_path, extractor=None, boilerplate=None: output_txt_path)
+    @patch('convert.download_epub')
+    def test_failed_book_does_not_stop_the_others(self, mock_download, mock_convert, mock_sha256, mock_print):
+        def download(book_id, exit_on_error=True, **kwargs):
+            if book_id == '9999999':
+                raise HTTPError("404 Client Error: Not Found for url")
+            return f'../client/documents/{book_id}.epub'
+        mock_download.side_effect = download
+
+        report = convert_books({'Madame Bovary': '2413', 'Missing': '9999999', '2600': '2600'}, max_workers=1)
+        self.assertEqual(set(report['converted']), {'Madame Bovary', '2600'})
+        self.assertIn('Missing', report['failed'])
+        self.assertFalse(mock_download.call_args.kwargs['exit_on_error'])
+
+class TestConversionManifest(unittest.TestCase):
+    def setUp(self):
+        self.epub_path = '../client/documents/8600.epub'
+        self.output_txt_path = "../client/output/L'assomoir.txt"
+        self.entry = convert.conversion_entry('8600', file_sha256(self.epub_path), self.output_txt_path)
+        patcher = patch('convert.download_epub', return_value=self.epub_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('builtins.print')
+    @patch('convert.epub_to_text')
+    def test_unchanged_book_is_not_reconverted(self, mock_convert, mock_print):
+        result = convert.convert_book("L'assomoir", '8600', previous=self.entry)
+        self.assertTrue(result[4])
+        mock_convert.assert_not_called()
+
+    @patch('builtins.print')
+    @patch('convert.epub_to_text', side_effect=lambda epub_path, output_txt_path, extractor=None, boilerplate=None: output_txt_path)
+    def test_new_extractor_version_or_corrupt_output_is_reconverted(self, mock_convert, mock_print):
+        for stale in [dict(self.entry, extractor_version=0), dict(self.entry, output_sha256='0' * 64),
+                      dict(self.entry, boilerplate=[])]:
+            result = convert.convert_book("L'assomoir", '8600', previous=stale)
+            self.assertFalse(result[4])
+            self.assertEqual(result[3], self.entry)
+        self.assertEqual(mock_convert.call_count, 3)
+
+class TestExtractors(unittest.TestCase):
+    def test_extractors_match_html_parser_on_bundled_books(self):
+        for book_id in ['2413', '2600', '8600']:
+            book = epub.read_epub(f'../client/documents/{book_id}.epub')
+            for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT):
+                expected = extract_with_html_parser(item.content)
+                for name, extract in EXTRACTORS.items():
+                    self.assertEqual(extract(item.content), expected, f"{name} differs on {book_id}/{item.get_name()}")
+
+    def test_extractors_handle_markup_edge_cases(self):
+        documents = [
+            b"<?xml version='1.0' encoding='utf-8'?>\n<html xmlns='http://www.w3.org/1999/xhtml'>\n<head><style>p {}</style>"
+            b"<script>var x = 1;</script></head>\n<body><p>A &amp; B</p>  <pre>  keep\n  </pre>\t<p>caf&#233;</p></body>\n</html>\n",
+            # Not well-formed XML, so lxml hands it to html.parser
+            b"<html><body><p>Fish&nbsp;&amp; chips<br>next</p></body></html>",
+            # A <pre> without child elements still keeps its whitespace
+            b"<html><body><pre>  \n </pre></body></html>",
+            # Not UTF-8, the declared encoding has to be used
+            "<?xml version='1.0' encoding='iso-8859-1'?>\n<html><body><p>caf\u00e9 cr\u00e8me</p></body></html>".encode('iso-8859-1'),
+        ]
+        for content in documents:
+            expected = extract_with_html_parser(content)
+            for name, extract in EXTRACTORS.items():
+                self.assertEqual(extract(content), expected, name)
+
+class TestBoilerplate(unittest.TestCase):
+    chapters = [
+        "Book | Project Gutenberg\nThe Project Gutenberg eBook of Book\nThis ebook is free\nbefore using this eBook.\nTitle: Book\n",
+        "*** START OF THE PROJECT GUTENBERG EBOOK BOOK ***\nBOOK\n",
+        "Book | Project Gutenberg\nTranscriber's Note: typos fixed.\nSpelling kept.\n\nCHAPTER I.\nIt begins.\n",
+        "The end.\n*** END OF THE PROJECT GUTENBERG EBOOK BOOK ***\nUpdated editions will replace the previous one.\n",
+        "THE FULL PROJECT GUTENBERG LICENSE\n",
+    ]
+
+    def test_strips_header_titles_notes_and_footer_in_one_pass(self):
+        seen = []
+
+        def chapters():
+            for chapter in self.chapters:
+                seen.append(chapter)
+                yield chapter
+        cleaned = [text.strip() for text in strip_boilerplate(chapters())]
+        self.assertEqual(cleaned, ['BOOK', 'CHAPTER I.\nIt begins.', 'The end.'])
+        # Nothing after the end marker is even read
+        self.assertEqual(len(seen), 4)
+
+    def test_kinds_can_be_kept(self):
+        cleaned = ''.join(strip_boilerplate(self.chapters, kinds=['footer', 'license']))
+        self.assertIn('Title: Book', cleaned)
+        self.assertIn("Transcriber's Note", cleaned)
+        self.assertNotIn('Updated editions', cleaned)
+        self.assertEqual(''.join(strip_boilerplate(self.chapters, kinds=[])), ''.join(self.chapters))
+
+    def test_book_without_start_marker_keeps_its_text(self):
+        cleaned = list(strip_boilerplate(['Chapter one.\n', 'Chapter two.\n']))
+        self.assertEqual(cleaned, ['Chapter one.\n', 'Chapter two.\n'])
+
+    def test_unknown_kind_is_rejected(self):
+        with self.assertRaises(ValueError):
+            list(strip_boilerplate(self.chapters, kinds=['colophon']))
+
 if __name__ == '__main__':
     unittest.main()
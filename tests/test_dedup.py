@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from dedup import MinHashLSH, find_duplicate_paragraphs, drop_duplicate_chunks
+
+PARAGRAPH = ("Gervaise had waited up for Lantier until two in the morning. Then, shivering from having remained "
+             "in a thin loose jacket at the window, she fell asleep across the bed, feverish and with her cheeks")
+OTHER = ("Well, Prince, so Genoa and Lucca are now just family estates of the Buonapartes. But I warn you, if you "
+         "don't tell me that this means war, if you still try to defend the infamies and horrors")
+
+
+class TestMinHashLSH(unittest.TestCase):
+    def test_near_duplicates_match_and_different_texts_do_not(self):
+        lsh = MinHashLSH()
+        lsh.insert('original', lsh.signature(PARAGRAPH))
+        edited = lsh.query(lsh.signature(PARAGRAPH.replace('cheeks', 'face')))
+        self.assertEqual(edited[0], 'original')
+        self.assertGreaterEqual(edited[1], 0.8)
+        self.assertIsNone(lsh.query(lsh.signature(OTHER)))
+
+    def test_short_paragraphs_are_not_compared(self):
+        self.assertIsNone(MinHashLSH().signature("CHAPTER I."))
+
+
+class TestDuplicateDetection(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_paragraphs_repeated_across_books_are_reported(self):
+        first = self.write('first.txt', f"{PARAGRAPH}\n\n{PARAGRAPH}\n")
+        second = self.write('second.txt', f"{OTHER}\n\n{PARAGRAPH}\n")
+        # The repeat inside the first book is not a cross-book duplicate
+        self.assertEqual([(dup[0], dup[1], dup[2], dup[3]) for dup in find_duplicate_paragraphs([first, second])],
+                         [(second, 3, first, 1)])
+
+    def test_chunks_covered_by_another_book_are_dropped(self):
+        chunks = {
+            'first [1/1]': self.write('a.txt', PARAGRAPH),
+            'second [1/2]': self.write('b.txt', PARAGRAPH.replace('cheeks', 'face')),
+            'second [2/2]': self.write('c.txt', f"{OTHER}\n\n{PARAGRAPH}"),
+        }
+        books = {'first [1/1]': 'first', 'second [1/2]': 'second', 'second [2/2]': 'second'}
+        kept, dropped = drop_duplicate_chunks(chunks, books)
+        self.assertEqual(list(kept), ['first [1/1]', 'second [2/2]'])
+        self.assertEqual(list(dropped), ['second [1/2]'])
+
+    def test_a_shared_lsh_compares_books_across_calls(self):
+        lsh = MinHashLSH()
+        kept, _ = drop_duplicate_chunks({'first [1/1]': self.write('a.txt', PARAGRAPH)}, {'first [1/1]': 'first'}, lsh=lsh)
+        self.assertEqual(list(kept), ['first [1/1]'])
+        kept, dropped = drop_duplicate_chunks({'second [1/1]': self.write('b.txt', PARAGRAPH)}, {'second [1/1]': 'second'}, lsh=lsh)
+        self.assertEqual((kept, list(dropped)), ({}, ['second [1/1]']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import io
+import threading
+import unittest
+import requests
+from unittest.mock import patch, MagicMock
+
+import http_client
+import metrics
+
+
+class TestRequestWithRetry(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        patcher = patch('http_client.get_session', return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_retries_server_errors_then_succeeds(self, mock_sleep, mock_print):
+        self.session.request.side_effect = [MagicMock(status_code=503, headers={}), MagicMock(status_code=200)]
+        response = http_client.request('POST', 'http://fakeurl.com', endpoint='chat')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.session.request.call_count, 2)
+        self.assertEqual(self.session.request.call_args.kwargs['timeout'], http_client.TIMEOUTS['chat'])
+        mock_sleep.assert_called_once()
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_connection_errors_raise_after_last_retry(self, mock_sleep, mock_print):
+        for error in (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
+            self.session.request.reset_mock()
+            self.session.request.side_effect = error
+            with self.assertRaises(error):
+                http_client.request('POST', 'http://fakeurl.com', retries=2)
+            self.assertEqual(self.session.request.call_count, 3)
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_read_timeouts_are_only_retried_for_idempotent_methods(self, mock_sleep, mock_print):
+        self.session.request.side_effect = requests.exceptions.ReadTimeout
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            http_client.request('POST', 'http://fakeurl.com', endpoint='ingest', retries=2)
+        self.assertEqual(self.session.request.call_count, 1)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            http_client.request('GET', 'http://fakeurl.com', retries=2)
+        self.assertEqual(self.session.request.call_count, 4)
+
+    def test_client_errors_are_not_retried(self):
+        self.session.request.return_value = MagicMock(status_code=404)
+        response = http_client.request('GET', 'http://fakeurl.com')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.session.request.call_count, 1)
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_uploaded_file_is_rewound_before_retry(self, mock_sleep, mock_print):
+        upload = io.BytesIO(b'book contents')
+        seen = []
+
+        def send(method, url, timeout, files):
+            seen.append(files['file'][1].read())
+            return MagicMock(status_code=502 if len(seen) == 1 else 200, headers={})
+        self.session.request.side_effect = send
+
+        http_client.request('POST', 'http://fakeurl.com', files={'file': ('book.txt', upload)})
+        self.assertEqual(seen, [b'book contents', b'book contents'])
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_statuses_and_retries_are_recorded(self, mock_sleep, mock_print):
+        registry = metrics.MetricsRegistry()
+        self.session.request.side_effect = [MagicMock(status_code=503, headers={}), MagicMock(status_code=200, headers={})]
+        with patch('http_client.metrics.increment', registry.increment), patch('http_client.metrics.observe', registry.observe):
+            http_client.request('POST', 'http://fakeurl.com', endpoint='chat')
+        counters = {(c['name'], c['labels'].get('status')): c['value'] for c in registry.snapshot()['counters']}
+        self.assertEqual(counters[('http_client_responses_total', '503')], 1)
+        self.assertEqual(counters[('http_client_responses_total', '200')], 1)
+        self.assertEqual(counters[('http_client_retries_total', None)], 1)
+
+    def test_backoff_is_capped(self):
+        for attempt in range(10):
+            self.assertLessEqual(http_client.backoff_delay(attempt, base=1.0, cap=5.0), 5.0)
+
+
+
+@patch('builtins.print')
+class TestAdaptiveLimiter(unittest.TestCase):
+    def test_limit_grows_while_latency_is_under_target(self, mock_print):
+        limiter = http_client.AdaptiveLimiter('chat', initial=2, maximum=3, target=1.0, window=3)
+        for _ in range(9):
+            limiter.release(limiter.acquire(), 0.1, ok=True)
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(4):
+            limiter.release(limiter.acquire(), 5.0, ok=True)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_burst_of_failures_only_cuts_the_limit_once(self, mock_print):
+        limiter = http_client.AdaptiveLimiter('ingest', initial=8, maximum=8, target=1.0)
+        epochs = [limiter.acquire() for _ in range(4)]
+        for epoch in epochs:
+            limiter.release(epoch, 0.1, ok=False)
+        self.assertEqual(limiter.limit, 4)
+        limiter.release(limiter.acquire(), 0.1, ok=False)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_requests_wait_for_a_free_slot(self, mock_print):
+        limiter = http_client.AdaptiveLimiter('chat', initial=1, maximum=1, target=1.0)
+        epoch = limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(epoch, 0.1, ok=True)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    @patch('http_client.time.sleep')
+    def test_server_errors_lower_the_shared_limit(self, mock_sleep, mock_print):
+        http_client.configure_limiters({'chat': {'initial': 4, 'maximum': 8, 'target': 60.0}})
+        self.addCleanup(http_client.configure_limiters)
+        session = MagicMock()
+        session.request.side_effect = [MagicMock(status_code=503, headers={}), MagicMock(status_code=200)]
+        with patch('http_client.get_session', return_value=session):
+            http_client.request('POST', 'http://fakeurl.com', endpoint='chat')
+        self.assertEqual(http_client.get_limiter('chat').limit, 2)
+        self.assertEqual(http_client.concurrency_ceiling('chat', 4), 8)
+        self.assertIsNone(http_client.get_limiter('download'))
+
+    def test_no_request_is_sent_once_the_deadline_passed_in_the_queue(self, mock_print):
+        http_client.configure_limiters({'chat': {'initial': 1, 'maximum': 1, 'target': 60.0}})
+        self.addCleanup(http_client.configure_limiters)
+        epoch = http_client.get_limiter('chat').acquire()
+        session = MagicMock()
+        with patch('http_client.get_session', return_value=session):
+            with self.assertRaises(http_client.SlotTimeout):
+                http_client.request('POST', 'http://fakeurl.com', endpoint='chat', deadline=http_client.time.monotonic() + 0.05)
+        session.request.assert_not_called()
+        http_client.get_limiter('chat').release(epoch, 0.1, ok=True)
+
+if __name__ == '__main__':
+    unittest.main()
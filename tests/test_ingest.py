@@ -1,22 +1,80 @@
+import os
+import tempfile
+import time
 import unittest
 import requests
+import metrics
 from unittest.mock import patch, MagicMock
-from ingest_file import send_file_to_server, send_all_files, main
+from ingest_file import send_file_to_server, send_all_files, send_books_in_chunks, main, MultipartFileStream, is_book_ingested
+from chunker import chunk_book, estimate_tokens, split_oversized
+from manifest import load_manifest, save_manifest
 
 class TestSendFileToServer(unittest.TestCase):
-    @patch('requests.post')
+    @patch('ingest_file.http_client.request')
     def test_send_file_to_server_success(self, mock_post):
         mock_post.return_value.status_code = 200
         mock_post.return_value.text = "Success"
         response = send_file_to_server('../client/output/deneme.txt', 'http://fakeurl.com')
         self.assertEqual(response.status_code, 200)
 
-    @patch('requests.post')
+    @patch('ingest_file.http_client.request')
     def test_send_file_to_server_timeout(self, mock_post):
         mock_post.side_effect = requests.exceptions.Timeout
         with self.assertRaises(SystemExit):
             send_file_to_server('../client/output/deneme.txt', 'http://fakeurl.com')
 
+class TestMultipartFileStream(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, 'book "one".txt')
+        with open(self.path, 'wb') as f:
+            f.write(b'Chapter I\n' * 5000)
+
+    def test_body_matches_requests_multipart_encoding(self):
+        with open(self.path, 'rb') as f:
+            expected = requests.Request('POST', 'http://fakeurl.com', files={
+                'file': (self.path, f, 'application/octet-stream')
+            }).prepare()
+        boundary = expected.headers['Content-Type'].split('boundary=')[1]
+
+        with MultipartFileStream('file', self.path) as body:
+            # Read in small blocks the way the connection does, never more than asked for
+            blocks = list(iter(lambda: body.read(4096), b''))
+            self.assertTrue(all(len(block) <= 4096 for block in blocks))
+            data = b''.join(blocks)
+            self.assertEqual(len(data), len(body))
+            self.assertEqual(data.replace(body.boundary.encode(), b'BOUNDARY'),
+                             expected.body.replace(boundary.encode(), b'BOUNDARY'))
+
+    def test_rewind_replays_the_same_body(self):
+        with MultipartFileStream('file', self.path) as body:
+            first = body.read()
+            body.seek(0)
+            self.assertEqual(body.read(), first)
+
+    @patch('builtins.print')
+    @patch('http_client.time.sleep')
+    def test_phases_are_timed_from_the_attempt_that_succeeded(self, mock_sleep, mock_print):
+        registry = metrics.MetricsRegistry()
+        attempts = []
+
+        def send(method, url, timeout, data, headers):
+            attempts.append(data.read())
+            if len(attempts) == 1:
+                time.sleep(0.3)  # A slow first attempt that fails
+                return MagicMock(status_code=503, headers={})
+            return MagicMock(status_code=200, headers={})
+        session = MagicMock()
+        session.request.side_effect = send
+        with patch('http_client.get_session', return_value=session), patch('http_client.ADAPTIVE_CONCURRENCY', False), \
+                patch('ingest_file.metrics.observe', registry.observe):
+            send_file_to_server(self.path, 'http://fakeurl.com')
+        self.assertEqual(len(attempts), 2)
+        phases = {h['name']: h['sum'] for h in registry.snapshot()['histograms']}
+        for name in ('ingest_connect_seconds', 'ingest_upload_seconds', 'ingest_server_seconds'):
+            self.assertLess(phases[name], 0.1, name)
+
 class TestSendAllFiles(unittest.TestCase):
     @patch('ingest_file.send_file_to_server')
     def test_send_all_files(self, mock_send_file):
@@ -31,7 +89,183 @@ class TestSendAllFiles(unittest.TestCase):
         send_all_files(available_files, sent_books, 'http://fakeurl.com')
         self.assertEqual(len(sent_books), 4)
 
+    @patch('builtins.print')
+    @patch('ingest_file.send_file_to_server')
+    def test_failed_upload_does_not_stop_the_others(self, mock_send_file, mock_print):
+        def upload(file_path, url, exit_on_error=True):
+            if 'War and Peace' in file_path:
+                raise requests.exceptions.Timeout("timed out")
+            return MagicMock(status_code=200)
+        mock_send_file.side_effect = upload
+        available_files = {
+            'Madame Bovary': '../client/output/Madame Bovary.txt',
+            'War and Peace': '../client/output/War and Peace.txt',
+            "L'assomoir": '../client/output/L\'assomoir.txt',
+        }
+        sent_books = set()
+        report = send_all_files(available_files, sent_books, 'http://fakeurl.com', max_workers=3)
+        self.assertEqual(sent_books, {'Madame Bovary', "L'assomoir"})
+        self.assertIn('War and Peace', report['failed'])
+        self.assertEqual(len(report['succeeded']), 2)
+
+class TestIngestionManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.book_path = os.path.join(self.temp_dir.name, 'book.txt')
+        with open(self.book_path, 'w') as f:
+            f.write('first edition')
+
+    @patch('builtins.print')
+    @patch('ingest_file.delete_documents')
+    @patch('ingest_file.send_file_to_server')
+    def test_unchanged_files_are_skipped_and_modified_files_resent(self, mock_send_file, mock_delete, mock_print):
+        mock_send_file.return_value = MagicMock(status_code=200)
+        mock_send_file.return_value.json.return_value = {'data': [{'doc_id': 'doc-1'}]}
+        manifest = {}
+
+        send_all_files({'book': self.book_path}, set(), 'http://fakeurl.com/v1/ingest/file', manifest=manifest)
+        report = send_all_files({'book': self.book_path}, set(), 'http://fakeurl.com/v1/ingest/file', manifest=manifest)
+        self.assertEqual(report['skipped'], ['book'])
+        self.assertEqual(mock_send_file.call_count, 1)
+
+        with open(self.book_path, 'w') as f:
+            f.write('second, revised edition')
+        mock_send_file.return_value.json.return_value = {'data': [{'doc_id': 'doc-2'}]}
+        report = send_all_files({'book': self.book_path}, set(), 'http://fakeurl.com/v1/ingest/file', manifest=manifest)
+        self.assertIn('book', report['succeeded'])
+        self.assertEqual(mock_send_file.call_count, 2)
+        # The document created from the first edition is removed from the server
+        mock_delete.assert_called_with(['doc-1'], 'http://fakeurl.com/v1/ingest/file')
+        self.assertEqual([entry['doc_ids'] for entry in manifest['documents'].values()], [['doc-2']])
+
+    @patch('builtins.print')
+    @patch('ingest_file.send_file_to_server')
+    def test_manifest_is_saved_after_every_upload(self, mock_send_file, mock_print):
+        mock_send_file.return_value = MagicMock(status_code=200)
+        manifest_path = os.path.join(self.temp_dir.name, 'manifest.json')
+        second_path = os.path.join(self.temp_dir.name, 'second.txt')
+        with open(second_path, 'w') as f:
+            f.write('another book')
+        saved = []
+
+        def save(manifest, path):
+            saved.append(len(manifest['documents']))
+            save_manifest(manifest, path)
+        with patch('ingest_file.save_manifest', side_effect=save):
+            send_all_files({'book': self.book_path, 'second': second_path}, set(), 'http://fakeurl.com/v1/ingest/file',
+                           manifest={}, manifest_path=manifest_path)
+        # One save per upload, each with the books recorded so far
+        self.assertEqual(saved, [1, 2])
+        self.assertEqual(len(load_manifest(manifest_path)['documents']), 2)
+
+class TestChunkedIngestion(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.chunks_dir = os.path.join(self.temp_dir.name, 'chunks')
+        self.book_path = os.path.join(self.temp_dir.name, 'book.txt')
+        with open(self.book_path, 'w') as f:
+            f.write('CHAPTER I.\n\n' + '\n\n'.join(f'Paragraph {n} ' + 'word ' * 40 for n in range(30)))
+
+    def test_chunks_respect_the_token_budget_and_overlap(self):
+        index = chunk_book(self.book_path, self.chunks_dir, max_tokens=200, overlap=60)
+        self.assertGreater(len(index['chunks']), 1)
+        self.assertTrue(all(chunk['tokens'] <= 200 for chunk in index['chunks']))
+        self.assertEqual(index['total_tokens'], sum(chunk['tokens'] for chunk in index['chunks']))
+        with open(index['chunks'][0]['path']) as first, open(index['chunks'][1]['path']) as second:
+            # The last paragraph of a chunk is repeated at the start of the next one
+            self.assertEqual(first.read().split('\n\n')[-1], second.read().split('\n\n')[0])
+        # Unchanged books reuse their chunks
+        self.assertEqual(chunk_book(self.book_path, self.chunks_dir, max_tokens=200, overlap=60), index)
+
+    def test_oversized_paragraph_is_split_at_sentences(self):
+        paragraph = ' '.join(f'Sentence number {n} is here.' for n in range(200))
+        pieces = split_oversized(paragraph, 100)
+        self.assertTrue(all(estimate_tokens(piece) <= 100 for piece in pieces))
+        self.assertEqual(' '.join(pieces), paragraph)
+
+    @patch('builtins.print')
+    @patch('ingest_file.send_file_to_server')
+    def test_book_is_sent_once_all_its_chunks_are(self, mock_send_file, mock_print):
+        mock_send_file.return_value = MagicMock(status_code=200)
+        sent_books = set()
+        report = send_books_in_chunks({'book': self.book_path}, sent_books, 'http://fakeurl.com', max_workers=3,
+                                      chunks_dir=self.chunks_dir, max_tokens=200, overlap=0)
+        self.assertEqual(sent_books, {'book'})
+        self.assertEqual(mock_send_file.call_count, len(report['succeeded']))
+        self.assertGreater(mock_send_file.call_count, 1)
+
+    @patch('builtins.print')
+    @patch('ingest_file.send_file_to_server')
+    def test_new_edition_is_compared_with_books_ingested_before(self, mock_send_file, mock_print):
+        edition_path = os.path.join(self.temp_dir.name, 'edition.txt')
+        with open(self.book_path) as original, open(edition_path, 'w') as edition:
+            edition.write(original.read())
+        sent_books = set()
+        report = send_books_in_chunks({'edition': edition_path}, sent_books, 'http://fakeurl.com', chunks_dir=self.chunks_dir,
+                                      max_tokens=200, overlap=0, dedup=True, known_books={'book': self.book_path})
+        self.assertEqual(sent_books, {'edition'})
+        self.assertEqual(report['succeeded'], {})
+        mock_send_file.assert_not_called()
+
+    @patch('builtins.print')
+    @patch('ingest_file.send_file_to_server')
+    def test_dropped_chunks_are_recorded_for_runs_without_dedup(self, mock_send_file, mock_print):
+        edition_path = os.path.join(self.temp_dir.name, 'edition.txt')
+        with open(self.book_path) as original, open(edition_path, 'w') as edition:
+            edition.write(original.read())
+        manifest_path = os.path.join(self.temp_dir.name, 'manifest.json')
+        send_books_in_chunks({'edition': edition_path}, set(), 'http://fakeurl.com', manifest={}, chunks_dir=self.chunks_dir,
+                             max_tokens=200, overlap=0, dedup=True, known_books={'book': self.book_path},
+                             manifest_path=manifest_path)
+        manifest = load_manifest(manifest_path)
+        self.assertTrue(all(entry['doc_ids'] == [] and entry['duplicate_share'] >= 0.9
+                            for entry in manifest['documents'].values()))
+        self.assertTrue(is_book_ingested(edition_path, manifest, self.chunks_dir, max_tokens=200, overlap=0))
+        sent_books = set()
+        send_books_in_chunks({'edition': edition_path}, sent_books, 'http://fakeurl.com', manifest=manifest,
+                             chunks_dir=self.chunks_dir, max_tokens=200, overlap=0)
+        self.assertEqual(sent_books, {'edition'})
+        mock_send_file.assert_not_called()
+
+    @patch('builtins.print')
+    @patch('ingest_file.delete_documents')
+    @patch('ingest_file.send_file_to_server')
+    def test_chunks_a_shortened_book_lost_are_deleted(self, mock_send_file, mock_delete, mock_print):
+        def upload(file_path, url, exit_on_error=True):
+            response = MagicMock(status_code=200)
+            response.json.return_value = {'data': [{'doc_id': os.path.basename(file_path)}]}
+            return response
+        mock_send_file.side_effect = upload
+        manifest = {}
+        first = send_books_in_chunks({'book': self.book_path}, set(), 'http://fakeurl.com', manifest=manifest,
+                                     chunks_dir=self.chunks_dir, max_tokens=200, overlap=0)
+        with open(self.book_path, 'w') as f:
+            f.write('CHAPTER I.\n\n' + 'Paragraph 0 ' + 'word ' * 40)
+        send_books_in_chunks({'book': self.book_path}, set(), 'http://fakeurl.com', manifest=manifest,
+                             chunks_dir=self.chunks_dir, max_tokens=200, overlap=0)
+        self.assertGreater(len(first['succeeded']), 1)
+        deleted = {doc_id for call in mock_delete.call_args_list for doc_id in call.args[0]}
+        # The lost chunks are removed and the first chunk, whose text changed, replaces its old document
+        self.assertEqual(deleted, {f'book.{number:04d}.txt' for number in range(1, len(first['succeeded']) + 1)})
+        self.assertEqual([os.path.basename(entry['path']) for entry in manifest['documents'].values()], ['book.0001.txt'])
+
 class TestMainFunction(unittest.TestCase):
+    def setUp(self):
+        # Keep the tests from reading or writing the real ingestion manifest
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        for name, value in [('MANIFEST_PATH', os.path.join(temp_dir.name, 'manifest.json')),
+                            ('CHUNKS_PATH', os.path.join(temp_dir.name, 'chunks'))]:
+            patcher = patch(f'ingest_file.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Nor write a metrics report into the repository
+        patcher = patch('ingest_file.metrics.export')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('builtins.input', side_effect=['2', 'finish'])
     @patch('ingest_file.send_all_files')
     def test_main_bulk_send(self, mock_send_all_files, mock_input):
@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import metrics
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in [0.004, 0.03, 0.03, 700]:
+            self.registry.observe('chat_latency_seconds', value, endpoint='chat')
+        histogram = self.registry.snapshot()['histograms'][0]
+        self.assertEqual(histogram['count'], 4)
+        buckets = {bucket['le']: bucket['count'] for bucket in histogram['buckets']}
+        self.assertEqual((buckets[0.005], buckets[0.05], buckets[600], buckets['inf']), (1, 3, 3, 4))
+
+    def test_prometheus_text_format(self):
+        self.registry.increment('http_client_responses_total', endpoint='chat', status=200)
+        self.registry.observe('ingest_upload_bytes', 2048, buckets=(1024, 4096))
+        self.registry.set_gauge('http_client_concurrency_limit', 5, endpoint='chat')
+        text = self.registry.to_prometheus()
+        self.assertIn('# TYPE http_client_concurrency_limit gauge', text)
+        self.assertIn('http_client_concurrency_limit{endpoint="chat"} 5', text)
+        self.assertIn('# TYPE http_client_responses_total counter', text)
+        self.assertIn('http_client_responses_total{endpoint="chat",status="200"} 1', text)
+        self.assertIn('ingest_upload_bytes_bucket{le="1024.0"} 0', text)
+        self.assertIn('ingest_upload_bytes_bucket{le="+Inf"} 1', text)
+        self.assertIn('ingest_upload_bytes_count 1', text)
+
+    @patch('builtins.print')
+    def test_export_writes_json_and_prometheus_files(self, mock_print):
+        self.registry.increment('chat_replies_total', outcome='ok')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_path, prom_path = os.path.join(temp_dir, 'm.json'), os.path.join(temp_dir, 'm.prom')
+            metrics.export(json_path, prom_path, registry=self.registry)
+            with open(json_path) as f:
+                self.assertEqual(json.load(f)['counters'][0]['value'], 1)
+            with open(prom_path) as f:
+                self.assertIn('chat_replies_total{outcome="ok"} 1', f.read())
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['m.json', 'm.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
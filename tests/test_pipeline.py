@@ -0,0 +1,69 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from pipeline import run_pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.ingest_started = threading.Event()
+
+    def download(self, book_id, exit_on_error=True, documents_path=None, base_url=None):
+        if book_id == '404':
+            raise IOError("Downloaded file is empty")
+        return os.path.join(self.dir, f'{book_id}.epub')
+
+    def convert(self, book_name, book_id, epub_path, extractor, previous, boilerplate, output_path):
+        # The last book is only converted once the first one is being ingested, so the stages must overlap
+        if book_id == '3':
+            self.assertTrue(self.ingest_started.wait(5), "Ingestion did not start before conversion finished")
+        output_txt_path = os.path.join(output_path, f'{book_name}.txt')
+        with open(output_txt_path, 'w', encoding='utf-8') as f:
+            f.write(f"Text of {book_name}\n")
+        return book_name, output_txt_path, None, {'book_id': book_id}, False
+
+    def ingest(self, books, sent_books, api_url, **kwargs):
+        self.ingest_started.set()
+        sent_books.update(books)
+        return {'succeeded': dict.fromkeys(books, 0.1), 'failed': {}, 'skipped': []}
+
+    @patch('builtins.print')
+    def test_books_flow_through_overlapping_stages(self, mock_print):
+        manifest = {}
+        with patch('pipeline.download_epub', side_effect=self.download), \
+                patch('pipeline.convert_downloaded', side_effect=self.convert), \
+                patch('pipeline.send_books_in_chunks', side_effect=self.ingest) as mock_ingest:
+            report = run_pipeline({'one': '1', 'two': '2', 'three': '3', 'missing': '404'}, 'http://fakeurl.com',
+                                  convert_manifest=manifest, output_path=self.dir, download_workers=1, convert_workers=1, queue_size=1,
+                                  chunks_dir=os.path.join(self.dir, 'chunks'))
+
+        self.assertEqual(sorted(report['ingested']), ['one', 'three', 'two'])
+        self.assertEqual(report['failed'], {'missing': 'download: Downloaded file is empty'})
+        self.assertEqual(sorted(manifest['books']), ['one', 'three', 'two'])
+        self.assertEqual(mock_ingest.call_count, 3)
+        stages = {stage['stage']: stage for stage in report['stages']}
+        self.assertEqual((stages['download']['items'], stages['download']['failed']), (3, 1))
+        self.assertEqual(stages['ingest']['items'], 3)
+
+    @patch('builtins.print')
+    def test_dedup_shares_one_lsh_across_books(self, mock_print):
+        with patch('pipeline.download_epub', side_effect=self.download), \
+                patch('pipeline.convert_downloaded', side_effect=self.convert), \
+                patch('pipeline.send_books_in_chunks', side_effect=self.ingest) as mock_ingest:
+            run_pipeline({'one': '1', 'two': '2', 'three': '3'}, 'http://fakeurl.com', output_path=self.dir, download_workers=1,
+                         convert_workers=1, chunks_dir=os.path.join(self.dir, 'chunks'), dedup=True)
+
+        lshs = [call.kwargs['lsh'] for call in mock_ingest.call_args_list]
+        self.assertEqual(len(lshs), 3)
+        self.assertIsNotNone(lshs[0])
+        self.assertTrue(all(lsh is lshs[0] for lsh in lshs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+from retrieval import build_index, load_index, open_index, tokenize
+
+BOVARY = ("Emma went to Rouen every Thursday to see Leon at the hotel.\n\n"
+          "Charles Bovary was a country doctor in Tostes.\n")
+WAR = ("Prince Andrei lay wounded on the field of Austerlitz.\n\n"
+       "Napoleon rode past the wounded after the battle, and Andrei looked at the sky.\n")
+
+
+class TestBm25Index(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.index_dir = os.path.join(temp_dir.name, 'bm25')
+        self.paths = []
+        for name, text in (('Madame Bovary.txt', BOVARY), ('War and Peace.txt', WAR)):
+            path = os.path.join(temp_dir.name, name)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self.paths.append(path)
+
+    def test_questions_are_routed_to_the_matching_book(self):
+        index = build_index(self.paths, self.index_dir)
+        book, line, _ = index.search("Where was Andrei wounded?")[0]
+        self.assertEqual((book, line), ('War and Peace', 1))
+        self.assertEqual(index.shortlist("Did Emma visit Rouen or Austerlitz?"), ['Madame Bovary', 'War and Peace'])
+        # Nothing but stopwords, or words no book contains, is no match at all
+        self.assertEqual(tokenize("What is this about?"), [])
+        self.assertEqual(index.shortlist("What about the spaceship?"), [])
+
+    @patch('builtins.print')
+    def test_saved_index_is_memory_mapped_and_rebuilt_when_a_book_changes(self, mock_print):
+        build_index(self.paths, self.index_dir)
+        with patch('retrieval.build_index') as mock_build:
+            index = open_index(self.paths, self.index_dir)
+            mock_build.assert_not_called()
+        self.assertIsInstance(index.postings, np.memmap)
+        self.assertEqual(index.shortlist("Charles the doctor"), ['Madame Bovary'])
+
+        with open(self.paths[1], 'a', encoding='utf-8') as f:
+            f.write("\nA new chapter about Pierre.\n")
+        self.assertIsNone(load_index(self.index_dir, {os.path.normpath(path): 'stale' for path in self.paths}))
+        self.assertEqual(open_index(self.paths, self.index_dir).shortlist("Pierre"), ['War and Peace'])
+
+    @patch('builtins.print')
+    def test_unchanged_books_are_not_hashed_again_on_startup(self, mock_print):
+        build_index(self.paths, self.index_dir)
+        with patch('manifest.file_sha256') as mock_hash, patch('retrieval.build_index') as mock_build:
+            open_index(self.paths, self.index_dir)
+        mock_hash.assert_not_called()
+        mock_build.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
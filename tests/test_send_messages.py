@@ -0,0 +1,433 @@
+import unittest
+import threading
+import tempfile
+import time
+import os
+import csv
+import json
+from unittest.mock import patch, MagicMock
+
+import pandas as pd
+import send_messages
+from send_messages import handle_questions_concurrently, handle_question, stream_responses, resume_responses
+from send_messages import user_input_mode, read_session_log
+from send_messages import process_questions_from_csv, read_question_chunks, skip_rows, render_prompts, generate_prompt
+from response_cache import ResponseCache
+
+
+class TestHandleQuestionsConcurrently(unittest.TestCase):
+    @patch('send_messages.handle_question')
+    def test_results_keep_input_order(self, mock_handle):
+        # Earlier questions finish last so completion order is the reverse of input order
+        def answer(api_url, question, timeout, cache=None, stats=None):
+            time.sleep(0.01 * (5 - int(question)))
+            return f"reply {question}", f"ref {question}"
+        mock_handle.side_effect = answer
+
+        results = list(handle_questions_concurrently('http://fakeurl.com', ['0', '1', '2', '3', '4'], max_in_flight=5))
+        self.assertEqual(results, [(f"reply {i}", f"ref {i}") for i in range(5)])
+
+    @patch('send_messages.handle_question')
+    def test_in_flight_limit_is_respected(self, mock_handle):
+        lock = threading.Lock()
+        state = {'current': 0, 'peak': 0}
+
+        def answer(api_url, question, timeout, cache=None, stats=None):
+            with lock:
+                state['current'] += 1
+                state['peak'] = max(state['peak'], state['current'])
+            time.sleep(0.01)
+            with lock:
+                state['current'] -= 1
+            return 'reply', 'ref'
+        mock_handle.side_effect = answer
+
+        results = list(handle_questions_concurrently('http://fakeurl.com', [str(i) for i in range(12)], max_in_flight=3))
+        self.assertEqual(len(results), 12)
+        self.assertLessEqual(state['peak'], 3)
+
+    @patch('builtins.print')
+    @patch('send_messages.handle_question')
+    def test_deadline_reports_timeout(self, mock_handle, mock_print):
+        def answer(api_url, question, timeout, cache=None, stats=None):
+            if question == 'slow':
+                time.sleep(0.3)
+            return 'reply', 'ref'
+        mock_handle.side_effect = answer
+
+        results = list(handle_questions_concurrently('http://fakeurl.com', ['fast', 'slow', 'fast'], max_in_flight=3, deadline=0.05))
+        self.assertEqual(results[0], ('reply', 'ref'))
+        self.assertIn('deadline', results[1][0])
+        self.assertEqual(results[2], ('reply', 'ref'))
+
+
+    @patch('send_messages.handle_question', return_value=('reply', 'ref'))
+    def test_latency_is_reported_per_question(self, mock_handle):
+        results = list(handle_questions_concurrently('http://fakeurl.com', ['a', 'b'], with_latency=True))
+        self.assertEqual([result[:2] for result in results], [('reply', 'ref')] * 2)
+        self.assertTrue(all(result[2] >= 0 for result in results))
+
+
+    @patch('builtins.print')
+    def test_questions_queued_past_their_deadline_are_not_sent(self, mock_print):
+        send_messages.http_client.configure_limiters({'chat': {'initial': 1, 'maximum': 1, 'target': 60.0}})
+        self.addCleanup(send_messages.http_client.configure_limiters)
+        # Another caller, such as an interactive session, holds the only slot for the whole batch
+        limiter = send_messages.http_client.get_limiter('chat')
+        epoch = limiter.acquire()
+        self.addCleanup(limiter.release, epoch, 0.1, True)
+        session = MagicMock()
+        with patch('http_client.get_session', return_value=session):
+            results = list(handle_questions_concurrently('http://fakeurl.com', ['q1', 'q2'], max_in_flight=4, deadline=0.2,
+                                                         coalesce=False))
+        # Reported either by the batch deadline or by the request giving up on its slot, whichever comes first
+        self.assertEqual([reference for _, reference in results], ['Network error occurred'] * 2)
+        session.request.assert_not_called()
+
+    @patch('builtins.print')
+    def test_window_follows_the_adaptive_limit(self, mock_print):
+        send_messages.http_client.configure_limiters({'chat': {'initial': 1, 'maximum': 4, 'target': 60.0}})
+        self.addCleanup(send_messages.http_client.configure_limiters)
+        session = MagicMock()
+        session.request.side_effect = lambda *args, **kwargs: time.sleep(0.2) or MagicMock(
+            status_code=200, json=lambda: {'choices': [{'message': {'content': 'reply'}}]})
+        # Sequentially the four questions need 0.8s, but each one only runs for 0.2s once it is submitted
+        with patch('http_client.get_session', return_value=session):
+            results = list(handle_questions_concurrently('http://fakeurl.com', ['q1', 'q2', 'q3', 'q4'], max_in_flight=4,
+                                                         deadline=0.5, coalesce=False))
+        self.assertEqual([reply for reply, _ in results], ['reply'] * 4)
+        self.assertEqual(session.request.call_count, 4)
+
+
+class TestCoalescing(unittest.TestCase):
+    def test_normalize_question(self):
+        self.assertEqual(send_messages.normalize_question('  Where did  Emma\tgo? '), 'where did emma go?')
+
+    @patch('builtins.print')
+    @patch('send_messages.handle_question')
+    def test_repeated_questions_share_one_request(self, mock_handle, mock_print):
+        def answer(api_url, question, timeout, cache=None, stats=None):
+            time.sleep(0.02)
+            stats['ok'] = True
+            return f"reply {question}", 'ref'
+        mock_handle.side_effect = answer
+
+        questions = ['Who?', 'who? ', 'What?', ' WHO?', 'What?']
+        results = list(handle_questions_concurrently('http://fakeurl.com', questions, max_in_flight=2, with_latency=True))
+        self.assertEqual(mock_handle.call_count, 2)
+        self.assertEqual([result[:2] for result in results],
+                         [('reply Who?', 'ref')] * 2 + [('reply What?', 'ref'), ('reply Who?', 'ref'), ('reply What?', 'ref')])
+
+    @patch('builtins.print')
+    @patch('send_messages.handle_question')
+    def test_failures_are_not_shared_with_later_copies(self, mock_handle, mock_print):
+        replies = iter([('Missing data in response: choices', 'No reference data found', False),
+                        ('other', 'ref', True), ('reply', 'ref', True)])
+
+        def answer(api_url, question, timeout, cache=None, stats=None):
+            reply, reference, stats['ok'] = next(replies)
+            return reply, reference
+        mock_handle.side_effect = answer
+        results = list(handle_questions_concurrently('http://fakeurl.com', ['q', 'x', 'q'], max_in_flight=1))
+        self.assertEqual(mock_handle.call_count, 3)
+        self.assertEqual(results[2], ('reply', 'ref'))
+
+    @patch('builtins.print')
+    @patch('send_messages.send_prompt_to_chat_api')
+    def test_only_answered_replies_are_flagged_ok(self, mock_send, mock_print):
+        mock_send.return_value.status_code = 200
+        mock_send.return_value.json.return_value = {'choices': [{'message': {'content': 'Paris'}}]}
+        stats = {}
+        self.assertEqual(handle_question('http://fakeurl.com', 'Where?', stats=stats), ('Paris', 'No reference data found.'))
+        self.assertTrue(stats['ok'])
+        mock_send.return_value.json.side_effect = json.JSONDecodeError('Expecting value', '', 0)
+        handle_question('http://fakeurl.com', 'Where?', stats=stats)
+        self.assertFalse(stats['ok'])
+
+    @patch('send_messages.handle_question', return_value=('reply', 'ref'))
+    def test_coalescing_can_be_disabled(self, mock_handle):
+        list(handle_questions_concurrently('http://fakeurl.com', ['q', 'q', 'q'], coalesce=False))
+        self.assertEqual(mock_handle.call_count, 3)
+
+
+class TestStreamingReplies(unittest.TestCase):
+    @patch('builtins.print')
+    @patch('send_messages.send_prompt_to_chat_api')
+    def test_stream_is_reassembled_with_sources_and_timings(self, mock_send, mock_print):
+        sources = [{'document': {'doc_metadata': {'window': 'Emma lived in Yonville.'}}}]
+        events = [
+            b': keep-alive',
+            b'data: ' + json.dumps({'choices': [{'delta': {'content': 'Madame '}, 'sources': []}]}).encode(),
+            b'',
+            b'data: ' + json.dumps({'choices': [{'delta': {'content': 'Bovary'}, 'sources': sources}]}).encode(),
+            b'data: [DONE]',
+        ]
+        mock_send.return_value = MagicMock(status_code=200)
+        mock_send.return_value.iter_lines.return_value = iter(events)
+
+        stats = {}
+        reply, reference = handle_question('http://fakeurl.com', 'Which book?', stream=True, stats=stats)
+        self.assertEqual(reply, 'Madame Bovary')
+        self.assertEqual(reference, 'Emma lived in Yonville.')
+        self.assertTrue(mock_send.call_args.kwargs['stream'])
+        mock_print.assert_any_call('Madame ', end='', flush=True)
+        self.assertLessEqual(stats['ttft'], stats['latency'])
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.path = os.path.join(self.temp_dir.name, 'cache.sqlite')
+
+    @patch('builtins.print')
+    @patch('send_messages.send_prompt_to_chat_api')
+    def test_repeated_question_is_served_from_cache(self, mock_send, mock_print):
+        mock_send.return_value.status_code = 200
+        mock_send.return_value.json.return_value = {'choices': [{'message': {'content': 'Paris'}, 'sources': []}]}
+        cache = ResponseCache(self.path, fingerprint='corpus-v1')
+        self.addCleanup(cache.close)
+
+        first = handle_question('http://fakeurl.com', 'Where?', cache=cache)
+        second = handle_question('http://fakeurl.com', 'Where?', cache=cache)
+        self.assertEqual(first, second)
+        self.assertEqual(mock_send.call_count, 1)
+
+    def test_corpus_change_ttl_and_lru_eviction(self):
+        cache = ResponseCache(self.path, fingerprint='corpus-v1', max_entries=2)
+        self.addCleanup(cache.close)
+        key = cache.make_key('prompt')
+        self.assertNotEqual(key, ResponseCache(self.path, fingerprint='corpus-v2').make_key('prompt'))
+
+        cache.put(key, 'reply', 'ref')
+        cache.put('b', 'reply', 'ref')
+        self.assertEqual(cache.get(key), ('reply', 'ref'))  # Touch key so 'b' becomes least recently used
+        cache.put('c', 'reply', 'ref')
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get(key))
+
+        cache.ttl = -1
+        self.assertIsNone(cache.get(key))
+
+    def test_puts_do_not_count_the_table(self):
+        cache = ResponseCache(self.path, max_entries=3)
+        for n in range(3):
+            cache.put(f'old {n}', 'reply', 'ref')
+        cache.close()
+
+        # The count of a reopened cache picks up the entries stored before
+        cache = ResponseCache(self.path, max_entries=3)
+        self.addCleanup(cache.close)
+        statements = []
+        cache._conn.set_trace_callback(statements.append)
+        cache.put('old 2', 'new reply', 'ref')
+        cache.put('new', 'reply', 'ref')
+        self.assertFalse(any('COUNT' in statement for statement in statements))
+        self.assertEqual(cache.get('new'), ('reply', 'ref'))
+        self.assertEqual(cache.get('old 2'), ('new reply', 'ref'))
+        self.assertEqual(cache._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0], 3)
+
+
+class TestIncrementalResults(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'responses.csv')
+        patcher = patch('send_messages.get_results_path', return_value=self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.temp_dir.cleanup)
+
+    @patch('builtins.print')
+    def test_rows_reach_disk_before_run_ends(self, mock_print):
+        def rows():
+            yield {'Reply': 'first', 'Reference': 'ref', 'Question': 'q1'}
+            # The first row must already be readable while the run is still going
+            with open(self.path, encoding='utf-8') as f:
+                self.assertIn('first', f.read())
+            yield {'Reply': 'second', 'Reference': 'ref', 'Question': 'q2'}
+
+        self.assertEqual(stream_responses(rows(), 'responses.csv'), 2)
+
+    @patch('builtins.print')
+    def test_resume_skips_answered_prefix_and_drops_partial_row(self, mock_print):
+        stream_responses(iter([
+            {'Reply': 'a1', 'Reference': 'r1', 'Question': 'q1'},
+            {'Reply': 'a2', 'Reference': 'r2', 'Question': 'q2'},
+        ]), 'responses.csv')
+        # Simulate a crash in the middle of writing the third row
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('"a3 cut sh')
+
+        answered = resume_responses(['q1', 'q2', 'q3'], 'responses.csv')
+        self.assertEqual(answered, 2)
+        with open(self.path, newline='', encoding='utf-8') as f:
+            self.assertEqual([row['Question'] for row in csv.DictReader(f)], ['q1', 'q2'])
+
+    @patch('builtins.print')
+    def test_failed_rows_are_asked_again(self, mock_print):
+        stream_responses(iter([
+            {'Reply': 'a1', 'Reference': 'No reference data found.', 'Question': 'q1'},
+            {'Reply': 'JSON decoding failed: Expecting value', 'Reference': 'No reference data found', 'Question': 'q2'},
+            {'Reply': 'a3', 'Reference': 'r3', 'Question': 'q3'},
+        ]), 'responses.csv')
+        self.assertEqual(resume_responses(['q1', 'q2', 'q3'], 'responses.csv'), 1)
+        with open(self.path, newline='', encoding='utf-8') as f:
+            self.assertEqual([row['Question'] for row in csv.DictReader(f)], ['q1'])
+
+    @patch('builtins.print')
+    def test_matching_results_are_streamed_not_rewritten(self, mock_print):
+        stream_responses(iter({'Reply': f'a{n}', 'Reference': 'r', 'Question': f'q{n}', 'Latency': 0.1} for n in range(50)),
+                         'responses.csv')
+        questions = (f'q{n}' for n in range(100))
+        with patch('send_messages.os.replace') as mock_replace:
+            self.assertEqual(resume_responses(questions, 'responses.csv'), 50)
+        mock_replace.assert_not_called()
+        # Only the answered questions were taken from the question stream
+        self.assertEqual(next(questions), 'q50')
+
+    @patch('builtins.print')
+    def test_results_without_latency_column_are_upgraded_on_resume(self, mock_print):
+        with open(self.path, 'w', newline='', encoding='utf-8') as f:
+            f.write('Reply,Reference,Question\na1,r1,q1\n')
+        self.assertEqual(resume_responses(['q1', 'q2'], 'responses.csv'), 1)
+        stream_responses(iter([{'Reply': 'a2', 'Reference': 'r2', 'Question': 'q2', 'Latency': 0.5}]),
+                         'responses.csv', append=True)
+        with open(self.path, newline='', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([(row['Question'], row['Latency']) for row in rows], [('q1', ''), ('q2', '0.5')])
+
+
+class TestRetrievalRouting(unittest.TestCase):
+    @patch('builtins.print')
+    @patch('send_messages.send_prompt_to_chat_api')
+    def test_shortlist_is_added_and_unmatched_questions_skip_the_server(self, mock_send, mock_print):
+        mock_send.return_value = MagicMock(status_code=200, json=lambda: {'choices': [{'message': {'content': 'Rouen'}}]})
+        index = MagicMock()
+        index.shortlist.side_effect = lambda question: ['Madame Bovary'] if 'Emma' in question else []
+
+        self.assertEqual(handle_question('http://fakeurl.com', 'Where did Emma go?', index=index)[0], 'Rouen')
+        prompt = mock_send.call_args[0][1]
+        self.assertEqual(prompt, generate_prompt('Where did Emma go?', ['Madame Bovary']))
+        self.assertIn('Madame Bovary', prompt)
+
+        reply, _ = handle_question('http://fakeurl.com', 'What is this about?', index=index)
+        self.assertEqual(reply, send_messages.NO_MATCH_REPLY)
+        self.assertEqual(mock_send.call_count, 1)
+
+    @patch('send_messages.handle_question', side_effect=lambda api_url, question, timeout, cache=None, stats=None, index=None: (index.name, question))
+    def test_index_reaches_every_concurrent_question(self, mock_handle):
+        index = MagicMock()
+        index.name = 'bm25'
+        self.assertEqual(list(handle_questions_concurrently('http://fakeurl.com', ['q1', 'q2'], index=index)),
+                         [('bm25', 'q1'), ('bm25', 'q2')])
+
+    def test_prompt_without_shortlist_is_unchanged(self):
+        self.assertEqual(generate_prompt('q'), send_messages.PROMPT_TEMPLATE.format(question='q'))
+
+
+class TestChunkedQuestions(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        self.questions = pd.DataFrame({'Id': range(5), 'Question': [f'q{i}' for i in range(5)]})
+        patcher = patch('send_messages.get_results_path', side_effect=lambda name: os.path.join(self.dir, name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_questions_are_read_in_chunks_and_prompts_rendered_in_bulk(self):
+        path = os.path.join(self.dir, 'questions.csv')
+        self.questions.to_csv(path, index=False)
+        chunks = list(read_question_chunks(path, chunksize=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([list(chunk) for chunk in skip_rows(iter(chunks), 3)], [['q3'], ['q4']])
+        # Bulk rendering gives exactly the per-question prompt, so cached replies still match
+        self.assertEqual(render_prompts(chunks[0]), [generate_prompt('q0'), generate_prompt('q1')])
+
+    @patch('builtins.print')
+    def test_missing_question_column_is_reported(self, mock_print):
+        path = os.path.join(self.dir, 'questions.csv')
+        self.questions[['Id']].to_csv(path, index=False)
+        process_questions_from_csv(path, 'http://fakeurl.com')
+        mock_print.assert_called_with("Error: No 'Question' column found in the CSV file.")
+
+    @unittest.skipIf(send_messages.pq is None, "pyarrow is not installed")
+    @patch('builtins.print')
+    @patch('send_messages.handle_question', side_effect=lambda api_url, question, timeout, cache=None, stats=None, prompt=None: (f'reply {question}', prompt))
+    def test_parquet_questions_and_results(self, mock_handle, mock_print):
+        path = os.path.join(self.dir, 'questions.parquet')
+        self.questions.to_parquet(path)
+        with patch('send_messages.QUESTION_CHUNK_ROWS', 2):
+            process_questions_from_csv(path, 'http://fakeurl.com', output='responses.parquet')
+        results = pd.read_parquet(os.path.join(self.dir, 'responses.parquet'))
+        self.assertEqual(list(results['Reply']), [f'reply q{i}' for i in range(5)])
+        self.assertEqual(results['Reference'][4], generate_prompt('q4'))
+
+
+class TestSessionLog(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+        patcher = patch('send_messages.get_results_path', side_effect=lambda name: os.path.join(self.dir, name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def answer(api_url, question, stream=False, stats=None, index=None):
+        stats.update(ttft=0.1, latency=0.5)
+        return f'reply {question}', f'ref {question}'
+
+    @patch('builtins.print')
+    def test_turns_are_logged_and_compacted_periodically(self, mock_print):
+        log_path = os.path.join(self.dir, 'session_log.jsonl')
+        results_path = os.path.join(self.dir, 'responses.csv')
+
+        def ask(prompt):
+            # Checked before each question: every earlier turn is already in the log
+            self.assertEqual(len(read_session_log(log_path)), ask.turns)
+            if ask.turns == 3:
+                self.assertEqual(len(pd.read_csv(results_path)), 2)
+            ask.turns += 1
+            return 'exit' if ask.turns == 6 else f'q{ask.turns}'
+        ask.turns = 0
+
+        with patch('send_messages.handle_question', side_effect=self.answer), patch('builtins.input', side_effect=ask):
+            user_input_mode('http://fakeurl.com', output='responses.csv', compact_every=2)
+
+        results = pd.read_csv(results_path)
+        self.assertEqual(list(results['Reply']), [f'reply q{n}' for n in range(1, 6)])
+        self.assertEqual(list(results.columns), ['Reply', 'Reference', 'TTFT', 'Latency'])
+        self.assertFalse(os.path.exists(log_path))
+
+    @patch('builtins.print')
+    def test_interrupted_session_is_recovered(self, mock_print):
+        with open(os.path.join(self.dir, 'session_log.jsonl'), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'Reply': 'old', 'Reference': 'ref', 'TTFT': 0.1, 'Latency': 0.2}) + '\n')
+            f.write('{"Reply": "cut sho')
+
+        with patch('send_messages.handle_question', side_effect=self.answer), patch('builtins.input', side_effect=['new', 'exit']):
+            user_input_mode('http://fakeurl.com', output='responses.csv')
+
+        results = pd.read_csv(os.path.join(self.dir, 'responses.csv'))
+        self.assertEqual(list(results['Reply']), ['old', 'reply new'])
+
+    @patch('builtins.print')
+    def test_compaction_only_reads_new_turns(self, mock_print):
+        log_path = os.path.join(self.dir, 'session_log.jsonl')
+        with patch('send_messages.handle_question', side_effect=self.answer), \
+                patch('builtins.input', side_effect=[f'q{n}' for n in range(1, 6)] + ['exit']), \
+                patch('send_messages.iter_session_log', wraps=send_messages.iter_session_log) as mock_iter:
+            user_input_mode('http://fakeurl.com', output='responses.csv', compact_every=2)
+
+        # Recovery and the first compaction start at the beginning, every later one where the previous one stopped
+        offsets = [call.args[1] if len(call.args) > 1 else 0 for call in mock_iter.call_args_list]
+        self.assertEqual(offsets[:2], [0, 0])
+        self.assertTrue(0 < offsets[2] < offsets[3])
+        results = pd.read_csv(os.path.join(self.dir, 'responses.csv'))
+        self.assertEqual(list(results['Reply']), [f'reply q{n}' for n in range(1, 6)])
+        self.assertFalse(os.path.exists(log_path))
+
+
+if __name__ == '__main__':
+    unittest.main()